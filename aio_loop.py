@@ -0,0 +1,82 @@
+# aio_loop.py
+import asyncio
+import atexit
+import threading
+
+
+class LoopThread:
+    """
+    Один долгоживущий event loop в отдельном потоке.
+    Flask-обработчики (синхронные) отдают туда корутины через submit()/run(),
+    поэтому aiohttp-сессия бота и её keep-alive соединения с api.telegram.org
+    живут между запросами, а не пересоздаются в каждом asyncio.run().
+
+    Поток стартует лениво при первом обращении — после fork'а gunicorn-воркера,
+    у каждого воркера свой loop.
+    """
+
+    def __init__(self, name="aio-loop"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._shutdown_hooks = []   # корутинные функции без аргументов, вызываются в stop()
+
+    @property
+    def loop(self):
+        return self.start()
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None and self._thread.is_alive():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=_run, name=self.name, daemon=True)
+            thread.start()
+            ready.wait()
+            self._loop, self._thread = loop, thread
+            return loop
+
+    def submit(self, coro):
+        """Запланировать корутину в loop'е; возвращает concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro, timeout=None):
+        """Выполнить корутину в loop'е и дождаться результата из текущего (не loop'ового) потока."""
+        return self.submit(coro).result(timeout)
+
+    def add_shutdown_hook(self, hook):
+        self._shutdown_hooks.append(hook)
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None or not thread.is_alive():
+            return
+
+        async def _shutdown():
+            for hook in self._shutdown_hooks:
+                try:
+                    await hook()
+                except Exception as e:
+                    print(">>> shutdown hook failed:", e)
+
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), loop).result(timeout)
+        except Exception as e:
+            print(">>> loop shutdown error:", e)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+
+LOOP = LoopThread()
+atexit.register(LOOP.stop)
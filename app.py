@@ -1,47 +1,156 @@
 # app.py
-import os
+from startup import REPORT   # первым — отсчёт холодного старта
+
 import asyncio
-from datetime import datetime
+import os
 
 from flask import Flask, request, jsonify
 
 from aiogram import Bot, Dispatcher
-from aiogram.types import Update, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Update
 
 # наши модули
 from bot import (
-    dp, bot, read_rows, write_rows, next_id,
-    generate_unique_alias, parse_notification, FILE_LOCK,
-    create_lot_and_prompt
+    dp, bot, init_db, set_bot_commands, refresh_pricing_rules, run_db,
+    DB_POOL, OUTBOX, USER_STATE, ROUTER, PRICING_RULES, DESCRIPTIONS, DESC_RULES,
+    claim_update, release_update,
 )
-from lzt_scraper import poll_new_texts, debug_probe
+from notification_parser import parse_notification, parse_notifications, parser_stats
+from ingest import (
+    ingest_and_notify, purchase_from_payload, purchase_fingerprint, payload_fingerprint,
+    MAX_BATCH, NOTIFIER, FINGERPRINTS,
+)
+from aio_loop import LOOP
+from update_queue import UpdateQueue, update_chat_key
+from ttl_cache import TTLCache
 
 app = Flask(__name__)
+REPORT.mark("imported")
 
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0") or 0)
 
 STARTUP_DONE = False
+STARTUP_LOCK = asyncio.Lock()
+ASYNC_TIMEOUT = float(os.getenv("ASYNC_TIMEOUT", "60"))
+
+
+async def _in_bot_context(coro):
+    # Bot/Dispatcher.get_current() живут в contextvars — выставляем их внутри задачи loop'а
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    return await coro
+
+
+def run_async(coro, timeout=ASYNC_TIMEOUT):
+    """Выполнить корутину в постоянном loop'е (aio_loop.LOOP) и дождаться результата."""
+    return LOOP.run(_in_bot_context(coro), timeout)
+
+
+async def _process_update(update):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await ensure_startup()
+    await dp.process_update(update)
+
+
+# Вебхук только кладёт апдейт в очередь и сразу отвечает 200; обрабатывают воркеры в LOOP
+UPDATES = UpdateQueue(
+    _process_update,
+    workers=int(os.getenv("UPDATE_WORKERS", "4")),
+    maxsize=int(os.getenv("UPDATE_QUEUE_SIZE", "100")),
+    put_timeout=float(os.getenv("UPDATE_PUT_TIMEOUT", "2")),
+)
+
+
+# Повторные доставки одного update_id отбрасываем до разбора и диспетчеризации.
+# Память: последние UPDATE_DEDUP_SIZE id на UPDATE_DEDUP_TTL секунд;
+# UPDATE_DEDUP_PERSIST=1 — ещё и таблица processed_updates (переживает рестарт, общая для воркеров).
+SEEN_UPDATES = TTLCache(
+    maxsize=int(os.getenv("UPDATE_DEDUP_SIZE", "10000")),
+    ttl=float(os.getenv("UPDATE_DEDUP_TTL", "86400")),
+)
+DEDUP_PERSIST = os.getenv("UPDATE_DEDUP_PERSIST", "0") == "1"
+DEDUP_STATS = {"duplicates": 0}
+
+
+def _claim_update(update_id) -> bool:
+    if update_id is None:
+        return True
+    if not SEEN_UPDATES.add(update_id):
+        DEDUP_STATS["duplicates"] += 1
+        return False
+    if DEDUP_PERSIST:
+        try:
+            fresh = claim_update(update_id)
+        except Exception as e:
+            # БД недоступна — не теряем апдейт, остаётся дедуп в памяти
+            print(">>> claim_update failed:", e)
+            fresh = True
+        if not fresh:
+            DEDUP_STATS["duplicates"] += 1
+            return False
+    return True
+
+
+def _release_update(update_id):
+    if update_id is None:
+        return
+    SEEN_UPDATES.pop(update_id)
+    if DEDUP_PERSIST:
+        try:
+            release_update(update_id)
+        except Exception as e:
+            print(">>> release_update failed:", e)
+
+
+async def _drain_updates():
+    await UPDATES.drain(timeout=float(os.getenv("UPDATE_DRAIN_TIMEOUT", "25")))
+
+
+async def _close_bot_session():
+    await bot.close()
+
+# порядок важен: сначала дообрабатываем очередь и отправляем накопленные дайджесты,
+# потом закрываем сессию бота
+LOOP.add_shutdown_hook(_drain_updates)
+LOOP.add_shutdown_hook(NOTIFIER.flush_all)
+LOOP.add_shutdown_hook(_close_bot_session)
+
 
 async def ensure_startup():
-    """Ставим команды в ТГ один раз."""
+    """
+    Фаза старта — один раз на процесс, перед первой работой с БД/ботом (не при импорте):
+    миграции (при актуальной схеме — один SELECT), меню команд (только если изменилось)
+    правила цен и описания игр.
+    """
     global STARTUP_DONE
     if STARTUP_DONE:
         return
-    Bot.set_current(bot)
-    Dispatcher.set_current(dp)
-    await bot.set_my_commands([
-        BotCommand("start", "Показать список команд"),
-        BotCommand("add_buy", "Игра|Цена|Примечание — добавить вручную"),
-        BotCommand("list", "Показать лоты в наличии"),
-        BotCommand("generate_listing", "<id> <target_net> — расчёт цены"),
-        BotCommand("mark_published", "<id> — отметить опубликованным"),
-        BotCommand("sold", "<id>|<price> — отметить продажу"),
-        BotCommand("stats", "Общая статистика"),
-        BotCommand("monthly", "YYYY-MM — статистика за месяц"),
-        BotCommand("export", "Экспорт CSV"),
-    ])
-    STARTUP_DONE = True
+    async with STARTUP_LOCK:
+        if STARTUP_DONE:
+            return
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        with REPORT.phase("migrate"):
+            applied = await run_db(init_db)
+        with REPORT.phase("commands"):
+            registered = await set_bot_commands()
+        with REPORT.phase("caches"):
+            await refresh_pricing_rules()
+            await DESCRIPTIONS.refresh()
+        REPORT.mark("startup_done")
+        print(f">>> startup: migrations applied={applied} commands_registered={registered} "
+              f"{REPORT.as_dict()}")
+        STARTUP_DONE = True
+
+
+@app.after_request
+def _mark_first_ok(response):
+    if response.status_code == 200 and "first_200" not in REPORT.marks:
+        REPORT.mark("first_200")
+        print(">>> cold start:", REPORT.as_dict())
+    return response
 
 
 @app.get("/")
@@ -59,15 +168,15 @@ def telegram_webhook():
         if "message" not in data and "callback_query" not in data:
             return "IGNORED", 200
 
-        update = Update.to_object(data)
-        Bot.set_current(bot)
-        Dispatcher.set_current(dp)
-
-        async def _handle():
-            await ensure_startup()
-            await dp.process_update(update)
+        update_id = data.get("update_id")
+        if not _claim_update(update_id):
+            return "DUPLICATE", 200
 
-        asyncio.run(_handle())
+        update = Update.to_object(data)
+        if not LOOP.run(UPDATES.put(update, update_chat_key(data)), ASYNC_TIMEOUT):
+            # очередь забита — пусть Telegram повторит доставку позже
+            _release_update(update_id)
+            return "BUSY", 503
         return "OK", 200
 
     except Exception as e:
@@ -78,6 +187,34 @@ def telegram_webhook():
         return "OK", 200
 
 
+def _idempotency_key():
+    """Заголовок Idempotency-Key; для GET-эндпоинтов можно и параметром ?idempotency_key=."""
+    key = request.headers.get("Idempotency-Key") or request.args.get("idempotency_key") or ""
+    return key.strip() or None
+
+
+def _with_fingerprint(purchase, key=None):
+    """Отпечаток: Idempotency-Key (если прислали), id заказа или source_text покупки."""
+    purchase["fingerprint"] = purchase_fingerprint(purchase, key)
+    return purchase
+
+
+def _lot_reply(lot):
+    return jsonify({"ok": True, "id": lot["id"], "duplicate": lot["duplicate"]})
+
+
+def _ingest(purchases):
+    """
+    Записать покупки одной транзакцией и уведомить админа. Возвращает лоты в порядке purchases;
+    повторно присланные (тот же отпечаток) — уже существующие, с duplicate=True.
+    """
+    async def _work():
+        await ensure_startup()
+        return await ingest_and_notify(purchases, ADMIN_CHAT_ID)
+
+    return run_async(_work())
+
+
 # ---------- Ручной мост (POST /llz_hook?secret=...) ----------
 @app.post("/llz_hook")
 def llz_hook():
@@ -86,136 +223,71 @@ def llz_hook():
         return "Forbidden", 403
 
     data = request.get_json(force=True, silent=True) or {}
-    game = (data.get("game") or "").strip()
-    account_desc = (data.get("account_desc") or "").strip()
-
-    price_raw = data.get("price")
     try:
-        price = float(str(price_raw).replace(",", "."))
-    except Exception:
-        price = None
-
-    if not game or price is None:
+        purchase = purchase_from_payload(data)
+    except ValueError:
         return "Bad payload", 400
+    purchase["source_text"] = (
+        f"llz_hook:{purchase['game']}|{purchase['buy_price']:.2f}|{purchase['account_desc']}"
+    )
+    _with_fingerprint(purchase, _idempotency_key())
 
-    async def _work():
-        await ensure_startup()
-        async with FILE_LOCK:
-            rows = read_rows()
-            existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-            alias = generate_unique_alias(existing_aliases)
-            nid = next_id(rows)
-            new = {
-                "id": str(nid),
-                "alias": alias,
-                "source_text": f"llz_hook:{game}|{price:.2f}|{account_desc}",
-                "game": game,
-                "account_desc": account_desc,
-                "buy_price": f"{price:.2f}",
-                "buy_date": datetime.utcnow().isoformat(),
-                "status": "in_stock",
-                "min_sale_for_target": "",
-                "notes": "",
-                "sell_price": "",
-                "sell_date": "",
-                "net_profit": ""
-            }
-            rows.append(new)
-            write_rows(rows)
-
-        kb = InlineKeyboardMarkup(row_width=4)
-        kb.add(
-            InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-            InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-            InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-        )
-        kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
-        kb.add(
-            InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{nid}"),
-            InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{nid}")
-        )
-
-        text = (
-            f"🆕 Новый лот (ID {nid})\n"
-            f"Игра: {game}\n"
-            f"Описание: {account_desc}\n"
-            f"Куплено за: {price:.2f}$\n\n"
-            "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-        )
-
-        if ADMIN_CHAT_ID:
-            await bot.send_message(ADMIN_CHAT_ID, text, reply_markup=kb)
-
-    asyncio.run(_work())
-    return "OK", 200
+    return _lot_reply(_ingest([purchase])[0])
 
 
 # ---------- Вебхук от стороннего сервиса (если появится) ----------
 @app.post("/lolz/notify")
 def lolz_notify():
     data = request.get_json(silent=True) or {}
-    game = (data.get("game") or data.get("title") or "").strip()
-    account_desc = (data.get("description") or data.get("desc") or "").strip()
-    price_val = data.get("price") or data.get("amount") or data.get("buy_price")
-
-    if not game or price_val is None:
-        return jsonify({"ok": False, "error": "missing game or price"}), 400
-
     try:
-        price_f = float(str(price_val).replace(",", "."))
-    except Exception:
-        return jsonify({"ok": False, "error": "bad price"}), 400
-
-    rows = read_rows()
-    existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-    alias = generate_unique_alias(existing_aliases)
-    nid = next_id(rows)
-
-    new = {
-        "id": str(nid),
-        "alias": alias,
-        "source_text": "lolz:webhook",
-        "game": game,
-        "account_desc": account_desc,
-        "buy_price": f"{price_f:.2f}",
-        "buy_date": datetime.utcnow().isoformat(),
-        "status": "in_stock",
-        "min_sale_for_target": "",
-        "notes": "",
-        "sell_price": "",
-        "sell_date": "",
-        "net_profit": ""
-    }
-    rows.append(new)
-    write_rows(rows)
-
-    kb = InlineKeyboardMarkup(row_width=4)
-    kb.add(
-        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-    )
-    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
-    kb.add(
-        InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{nid}"),
-        InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{nid}")
+        purchase = purchase_from_payload(data, source_text="lolz:webhook")
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    # source_text здесь общий, поэтому отпечаток по содержимому берём от самого JSON
+    purchase["fingerprint"] = purchase_fingerprint(
+        purchase, _idempotency_key(), content=payload_fingerprint(data)
     )
 
-    draft_text = (
-        f"🆕 Новый лот (ID {nid})\n"
-        f"Игра: {game}\n"
-        f"Описание: {account_desc}\n"
-        f"Куплено за: {price_f:.2f}$\n\n"
-        "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-    )
+    return _lot_reply(_ingest([purchase])[0])
 
-    async def _send():
-        await ensure_startup()
-        if ADMIN_CHAT_ID:
-            await bot.send_message(ADMIN_CHAT_ID, draft_text, reply_markup=kb)
 
-    asyncio.run(_send())
-    return jsonify({"ok": True, "id": nid})
+# ---------- Пачка покупок одним запросом (автобай) ----------
+@app.post("/lolz/notify/batch")
+def lolz_notify_batch():
+    secret = request.headers.get("X-Secret") or request.args.get("secret", "")
+    cron_secret = os.getenv("CRON_SECRET", "")
+    if not cron_secret or secret != cron_secret:
+        return "forbidden", 403
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("items")
+    if not isinstance(data, list) or not data:
+        return jsonify({"ok": False, "error": "expected a non-empty JSON array"}), 400
+    if len(data) > MAX_BATCH:
+        return jsonify({"ok": False, "error": f"too many items (max {MAX_BATCH})"}), 400
+
+    key = _idempotency_key()
+    purchases, errors = [], []
+    for i, item in enumerate(data):
+        try:
+            purchase = purchase_from_payload(item, source_text="lolz:webhook")
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+            continue
+        purchase["fingerprint"] = purchase_fingerprint(
+            purchase, f"{key}:{i}" if key else None, content=payload_fingerprint(item)
+        )
+        purchases.append(purchase)
+    if errors:
+        return jsonify({"ok": False, "errors": errors}), 400
+
+    lots = _ingest(purchases)
+    return jsonify({
+        "ok": True,
+        "ids": [lot["id"] for lot in lots],
+        "duplicates": [lot["id"] for lot in lots if lot["duplicate"]],
+    })
 
 
 # ---------- Приём «сырого текста» (например, с почты) ----------
@@ -234,57 +306,9 @@ def lolz_email():
     parsed = parse_notification(text)
     if not parsed.get("buy_price"):
         return "IGNORED", 200
+    _with_fingerprint(parsed, _idempotency_key())
 
-    rows = read_rows()
-    existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-    alias = generate_unique_alias(existing_aliases)
-    nid = next_id(rows)
-
-    new = {
-        "id": str(nid),
-        "alias": alias,
-        "source_text": parsed["source_text"],
-        "game": parsed["game"],
-        "account_desc": parsed["account_desc"],
-        "buy_price": f"{float(parsed['buy_price']):.2f}",
-        "buy_date": datetime.utcnow().isoformat(),
-        "status": "in_stock",
-        "min_sale_for_target": "",
-        "notes": "",
-        "sell_price": "",
-        "sell_date": "",
-        "net_profit": ""
-    }
-    rows.append(new)
-    write_rows(rows)
-
-    kb = InlineKeyboardMarkup(row_width=4)
-    kb.add(
-        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-    )
-    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
-    kb.add(
-        InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{nid}"),
-        InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{nid}")
-    )
-
-    msg = (
-        f"🆕 Новый лот (ID {nid})\n"
-        f"Игра: {parsed['game']}\n"
-        f"Описание: {parsed['account_desc']}\n"
-        f"Куплено за: {float(parsed['buy_price']):.2f}$\n\n"
-        "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-    )
-
-    async def _send():
-        await ensure_startup()
-        if ADMIN_CHAT_ID:
-            await bot.send_message(ADMIN_CHAT_ID, msg, reply_markup=kb)
-
-    asyncio.run(_send())
-    return "OK", 200
+    return _lot_reply(_ingest([parsed])[0])
 
 
 # ---------- GET-версия теста ----------
@@ -294,67 +318,16 @@ def debug_push_buy_get():
     if secret != os.getenv("CRON_SECRET"):
         return "Forbidden", 403
 
-    game = (request.args.get("game") or "").strip()
-    account_desc = (request.args.get("account_desc") or request.args.get("desc") or "").strip()
-    price_raw = request.args.get("price") or request.args.get("buy_price")
-
     try:
-        price_f = float(str(price_raw).replace(",", "."))
-    except Exception:
-        return "Bad Request", 400
-    if not game:
+        purchase = purchase_from_payload(request.args.to_dict())
+    except ValueError:
         return "Bad Request", 400
-
-    rows = read_rows()
-    existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-    alias = generate_unique_alias(existing_aliases)
-    nid = next_id(rows)
-    new = {
-        "id": str(nid),
-        "alias": alias,
-        "source_text": f"debug_get:{game}|{price_f}|{account_desc}",
-        "game": game,
-        "account_desc": account_desc,
-        "buy_price": f"{price_f:.2f}",
-        "buy_date": datetime.utcnow().isoformat(),
-        "status": "in_stock",
-        "min_sale_for_target": "",
-        "notes": "",
-        "sell_price": "",
-        "sell_date": "",
-        "net_profit": ""
-    }
-    rows.append(new)
-    write_rows(rows)
-
-    kb = InlineKeyboardMarkup(row_width=4)
-    kb.add(
-        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-    )
-    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
-    kb.add(
-        InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{nid}"),
-        InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{nid}")
+    purchase["source_text"] = (
+        f"debug_get:{purchase['game']}|{purchase['buy_price']}|{purchase['account_desc']}"
     )
+    _with_fingerprint(purchase, _idempotency_key())
 
-    text = (
-        f"🆕 Новый лот (ID {nid})\n"
-        f"Игра: {game}\n"
-        f"Описание: {account_desc}\n"
-        f"Куплено за: {price_f:.2f}$\n\n"
-        "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-    )
-
-    async def _send():
-        await ensure_startup()
-        admin_id = int(os.getenv("ADMIN_CHAT_ID", "0") or 0)
-        if admin_id:
-            await bot.send_message(admin_id, text, reply_markup=kb)
-
-    asyncio.run(_send())
-    return "OK", 200
+    return _lot_reply(_ingest([purchase])[0])
 
 
 # ---------- Кнопка «потянуть вручную» (скрапер) ----------
@@ -363,20 +336,17 @@ def poll():
     if request.args.get("secret") != os.getenv("CRON_SECRET"):
         return "forbidden", 403
 
+    from lzt_scraper import poll_new_texts   # requests и т.п. грузим только когда нужен скрапер
     try:
         new_texts = poll_new_texts()
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-    async def _send():
-        await ensure_startup()
-        for t in new_texts:
-            parsed = parse_notification(t)
-            if parsed.get("buy_price"):
-                await create_lot_and_prompt(parsed, ADMIN_CHAT_ID)
-
-    asyncio.run(_send())
-    return jsonify({"ok": True, "delivered": len(new_texts)})
+    purchases = [p for p in parse_notifications(new_texts) if p.get("buy_price")]
+    duplicates = 0
+    for i in range(0, len(purchases), MAX_BATCH):
+        duplicates += sum(lot["duplicate"] for lot in _ingest(purchases[i:i + MAX_BATCH]))
+    return jsonify({"ok": True, "delivered": len(new_texts), "duplicates": duplicates})
 
 @app.get("/probe")
 def probe():
@@ -386,9 +356,31 @@ def probe():
     from lzt_scraper import debug_probe
     res = debug_probe()
     return jsonify(res)
+# ---------- Метрики: пул соединений с БД и т.п. ----------
+@app.get("/debug/stats")
+def debug_stats():
+    if request.args.get("secret") != os.getenv("CRON_SECRET"):
+        return "forbidden", 403
+    return jsonify({
+        "db_pool": DB_POOL.stats(),
+        "updates": UPDATES.stats(),
+        "outbox": OUTBOX.stats(),
+        "dedup": dict(DEDUP_STATS, cache=SEEN_UPDATES.stats(), persist=DEDUP_PERSIST),
+        "intake_fingerprints": FINGERPRINTS.stats(),
+        "startup": dict(REPORT.as_dict(), done=STARTUP_DONE),
+        "dialog_state": USER_STATE.stats(),
+        "routes": ROUTER.stats(),
+        "parser": parser_stats(),
+        "pricing_rules": {"count": len(PRICING_RULES), "signature": str(PRICING_RULES.signature)},
+        "descriptions": DESCRIPTIONS.stats(),
+        "desc_rules": DESC_RULES.stats(),
+    })
+
+
 # ---------- Диагностика скрапера ----------
 @app.get("/scraper_debug_open")
 def scraper_debug_open():
+    from lzt_scraper import debug_probe
     try:
         info = debug_probe()
         return jsonify(info)
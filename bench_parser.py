@@ -0,0 +1,65 @@
+# bench_parser.py
+"""
+Бенчмарк реестра шаблонов на смешанном корпусе уведомлений.
+
+    python bench_parser.py [кол-во текстов]
+
+Печатает время на текст для реестра и для старого русского парсера (без префильтра),
+а также счётчики попаданий/промахов по шаблонам.
+"""
+import random
+import sys
+import time
+
+import notification_parser as parser
+
+GAMES = ["Counter-Strike 2", "GTA V", "Dead by Daylight", "Rust", "Steam  Random"]
+ACCS = ["Prime, 120 часов", "без хаус-баннов", "10 lvl, медаль", "", "full access"]
+
+
+def make_corpus(n, seed=1):
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        game, acc, price = rnd.choice(GAMES), rnd.choice(ACCS), f"{rnd.uniform(0.5, 40):.2f}"
+        kind = rnd.random()
+        if kind < 0.7:      # обычный случай — русское уведомление
+            corpus.append(f'По вашей ссылке "{game}" куплен аккаунт {acc} за ${price}')
+        elif kind < 0.8:
+            corpus.append(f'Via your link "{game}" account purchased {acc} for ${price}')
+        elif kind < 0.85:
+            corpus.append(f'Account {acc} was purchased via your link "{game}" for ${price}')
+        elif kind < 0.92:
+            corpus.append(f"New order\nGame: {game}\nAccount: {acc}\nPrice: ${price}")
+        else:
+            corpus.append(rnd.choice(["Привет!", "Ваш баланс пополнен", "Login alert", game]))
+    return corpus
+
+
+def bench(fn, corpus, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best / len(corpus) * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    corpus = make_corpus(n)
+    ru = [t for t in corpus if t.startswith("По вашей ссылке")]
+
+    legacy = lambda t: parser._parse_notification_legacy(t.strip())
+    print(f"mixed corpus, {n} texts")
+    print(f"  registry: {bench(parser.parse_notification, corpus):7.2f} us/text")
+    print(f"  legacy:   {bench(legacy, corpus):7.2f} us/text")
+    print(f"russian only, {len(ru)} texts")
+    print(f"  registry: {bench(parser.parse_notification, ru):7.2f} us/text")
+    print(f"  legacy:   {bench(legacy, ru):7.2f} us/text")
+    print("stats:", parser.parser_stats())
+
+
+if __name__ == "__main__":
+    main()
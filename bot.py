@@ -1,302 +1,896 @@
 import os
-import csv
 import re
-from datetime import datetime
-from decimal import Decimal, InvalidOperation
+from datetime import datetime, timezone
+from decimal import Decimal
 import asyncio
+import functools
+import gzip
+import hashlib
+import json
 import random, string
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import psycopg2.extras
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
-FILE_LOCK = asyncio.Lock()
-# Память простых состояний диалога и последних описаний по игре
-USER_STATE = {}          # user_id -> {...}
-GAME_DEFAULT_DESC = {}   # game_title -> last_description
-
-# ==== ТОКЕН ТОЛЬКО ЗДЕСЬ: API_TOKEN ====
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
+
+from db_pool import ConnectionPool
+from migrations import migrate, SEARCH_DOC
+import pricing
+from send_queue import OutboundScheduler, RateLimitedBot
+from state_store import make_state_store
+from description_store import DescriptionStore
+from desc_rules import DescriptionRules
+from router import Router
+from notification_parser import to_decimal, parse_notification
+from list_open_feature import LIST_STATUSES, setup_list_open_feature
+FILE_LOCK = asyncio.Lock()
+# Память последних описаний по игре
+GAME_DEFAULT_DESC = {}   # game_title -> last_description
+
+# ==== ТОКЕН ТОЛЬКО ЗДЕСЬ: API_TOKEN ====
 API_TOKEN = os.getenv("BOT_TOKEN")
 if not API_TOKEN:
-    raise RuntimeError("Environment variable BOT_TOKEN is not set")
-
-
+    raise RuntimeError("Environment variable BOT_TOKEN is not set")
+
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("Environment variable DATABASE_URL is not set")
 
 
-def get_conn():
+# Один пул на процесс: без TLS-рукопожатия на каждое нажатие кнопки
+DB_POOL = ConnectionPool(
+    DATABASE_URL,
+    min_size=int(os.getenv("DB_POOL_MIN", "1")),
+    max_size=int(os.getenv("DB_POOL_MAX", "5")),
+    wait_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
     # Render обычно требует sslmode=require
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    sslmode="require",
+    keepalives=1,
+    keepalives_idle=30,
+)
+
+
+def get_conn():
+    """Соединение из пула: `with get_conn() as conn:` (commit на выходе, rollback при ошибке)."""
+    return DB_POOL.connection()
+
+
+# psycopg2 блокирующий — из async-хендлеров ходим в БД через ограниченный пул потоков.
+# Потоков столько же, сколько соединений: лишние запросы ждут здесь, а не внутри пула.
+DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DB_EXECUTOR_WORKERS", "0") or DB_POOL.max_size),
+    thread_name_prefix="db",
+)
+
+
+async def run_db(fn, *args, **kwargs):
+    """`await run_db(get_lot, nid)` — выполнить функцию БД в DB_EXECUTOR, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+# Состояния диалога (ввод профита/описания). postgres — общие для всех воркеров gunicorn,
+# memory — только в этом процессе. Брошенные диалоги истекают через STATE_TTL секунд.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "postgres")
+STATE_TTL = float(os.getenv("STATE_TTL", "3600"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))   # для memory
+
+
+def _state_store(namespace):
+    return make_state_store(
+        namespace, STATE_BACKEND, get_conn, run_db, ttl=STATE_TTL, maxsize=STATE_MAX_ENTRIES
+    )
+
+
+USER_STATE = _state_store("user_state")      # user_id -> {"mode": ..., "nid": ..., ...}
+
+
+async def _dialog_state(message):
+    """Ключ состояния для ROUTER.dispatch_text: режим USER_STATE или None (один запрос к хранилищу)."""
+    st = await USER_STATE.get(message.from_user.id) or {}
+    return st.get("mode"), st
 
 
 def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY,
-            alias TEXT,
-            source_text TEXT,
-            game TEXT,
-            account_desc TEXT,
-            buy_price TEXT,
-            buy_date TEXT,
-            status TEXT,
-            min_sale_for_target TEXT,
-            notes TEXT,
-            sell_price TEXT,
-            sell_date TEXT,
-            net_profit TEXT
-        )
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-# ====== HELP-текст и меню команд ======
-HELP_TEXT = (
-    "Привет! Я бот для учёта и подготовки листингов.\n\n"
-    "Работаю с CSV-хранилищем.\n\n"
-    "Присылай пересланные уведомления от автобая (или используй /add_buy).\n\n"
-    "Команды:\n"
-    "/add_buy Игра|Цена|Примечание — добавить вручную\n"
-    "/list — показать текущие не проданные лоты\n"
-    "/generate_listing <id> <target_net> — получить мин. цену и шаблон\n"
-    "/mark_published <id> — пометить как опубликованный\n"
-    "/sold <id>|<price> — отметить как проданный (пример: /sold 3|10)\n"
-    "/stats — общая статистика\n"
-    "/monthly YYYY-MM — статистика за месяц\n"
-    "/export — экспорт CSV\n"
-    "/reset_stats — очистить базу (нужно подтверждение)\n"
-)
-
-async def set_bot_commands():
-    commands = [
-        BotCommand("start", "помощь и список команд"),
-        BotCommand("add_buy", "Игра|Цена|Примечание"),
-        BotCommand("list", "лоты в наличии"),
-        BotCommand("generate_listing", "<id> <target_net>"),
-        BotCommand("mark_published", "<id>"),
-        BotCommand("sold", "<id>|<price>"),
-        BotCommand("stats", "общая статистика"),
-        BotCommand("monthly", "YYYY-MM"),
-        BotCommand("export", "выгрузка CSV"),
-        BotCommand("reset_stats", "очистить базу (подтверждение)"),
-    ]
-    await bot.set_my_commands(commands)
-# ======================================
-
-
-# ========== НАСТРОЙКИ ==========
-DATA_CSV = os.path.join(os.path.dirname(__file__), "inventory.csv")
-DESC_CSV = os.path.join(os.path.dirname(__file__), "descriptions.csv")
-COMMISSION = 0.06           # 6%
-PRICE_ENDING = "tenth_9"    # психологическое окончание
-# ==============================
-
-if not API_TOKEN:
-    raise RuntimeError("Environment variable BOT_TOKEN is not set")
-
-bot = Bot(token=API_TOKEN)
+    """
+    Довести схему БД до последней версии (см. migrations.py). Вызывается из фазы старта
+    (app.ensure_startup), а не при импорте. Возвращает список применённых версий.
+    """
+    with get_conn() as conn:
+        return migrate(conn)
+# ====== HELP-текст и меню команд ======
+HELP_TEXT = (
+    "Привет! Я бот для учёта и подготовки листингов.\n\n"
+    "Данные хранятся в PostgreSQL.\n\n"
+    "Присылай пересланные уведомления от автобая (или используй /add_buy).\n\n"
+    "Команды:\n"
+    "/add_buy Игра|Цена|Примечание[|Площадка] — добавить вручную\n"
+    "/list — показать текущие не проданные лоты\n"
+    "/find <запрос> — поиск по игре, алиасу, описанию и заметкам\n"
+    "/generate_listing <id> <target_net> — получить мин. цену и шаблон\n"
+    "/mark_published <id> — пометить как опубликованный\n"
+    "/sold <id>|<price> — отметить как проданный (пример: /sold 3|10)\n"
+    "/reprice <target_net> [статус] — пересчитать мин. цены всех лотов\n"
+    "/stats — общая статистика\n"
+    "/monthly YYYY-MM — статистика за месяц\n"
+    "/export [статус] [с] [по] — выгрузка CSV.gz из базы\n"
+    "/reset_stats — очистить базу (нужно подтверждение)\n"
+)
+
+BOT_COMMANDS = [
+    BotCommand("start", "Показать список команд"),
+    BotCommand("add_buy", "Игра|Цена|Примечание — добавить вручную"),
+    BotCommand("list", "Показать лоты в наличии"),
+    BotCommand("find", "<запрос> — поиск лотов"),
+    BotCommand("generate_listing", "<id> <target_net> — расчёт цены"),
+    BotCommand("mark_published", "<id> — отметить опубликованным"),
+    BotCommand("sold", "<id>|<price> — отметить продажу"),
+    BotCommand("reprice", "<target_net> [статус] — пересчитать мин. цены"),
+    BotCommand("stats", "Общая статистика"),
+    BotCommand("monthly", "YYYY-MM — статистика за месяц"),
+    BotCommand("export", "[статус] [с] [по] — выгрузка CSV.gz"),
+    BotCommand("reset_stats", "Очистить базу (нужно подтверждение)"),
+]
+
+
+def commands_hash(commands=BOT_COMMANDS):
+    # id бота входит в хэш: при смене токена меню регистрируется заново
+    payload = [API_TOKEN.split(":", 1)[0]] + [[c.command, c.description] for c in commands]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+async def set_bot_commands(force=False):
+    """
+    Зарегистрировать меню команд, только если список изменился с прошлой регистрации
+    (хэш хранится в bot_meta). True — если ходили в Telegram.
+    """
+    digest = commands_hash()
+    if not force and await run_db(get_meta, "commands_hash") == digest:
+        return False
+    await bot.set_my_commands(BOT_COMMANDS)
+    await run_db(set_meta, "commands_hash", digest)
+    return True
+# ======================================
+
+
+# ========== НАСТРОЙКИ ==========
+COMMISSION = 0.06           # 6% — по умолчанию, если в pricing_rules нет подходящего правила
+PRICE_ENDING = "tenth_9"    # психологическое окончание (по умолчанию)
+COMMISSION_BP = pricing.to_bp(COMMISSION)
+PRICING_RULES = pricing.PricingRules(pricing.PricingRule(COMMISSION_BP, PRICE_ENDING))
+PRICING_RULES_TTL = float(os.getenv("PRICING_RULES_TTL", "30"))   # как часто проверять изменения
+# ==============================
+
+if not API_TOKEN:
+    raise RuntimeError("Environment variable BOT_TOKEN is not set")
+
+# Все исходящие сообщения — через общий планировщик с лимитами Telegram (send_queue.py)
+OUTBOX = OutboundScheduler(
+    global_rate=float(os.getenv("TG_GLOBAL_RATE", "30")),
+    global_burst=int(os.getenv("TG_GLOBAL_BURST", "30")),
+    chat_rate=float(os.getenv("TG_CHAT_RATE", "1")),
+    chat_burst=int(os.getenv("TG_CHAT_BURST", "3")),
+)
+bot = RateLimitedBot(token=API_TOKEN, scheduler=OUTBOX)
 dp = Dispatcher(bot)
-init_db()
-
-# Создаём CSV если его нет
-FIELDNAMES = [
-    "id", "alias", "source_text", "game", "account_desc", "buy_price",
-    "buy_date", "status", "min_sale_for_target", "notes",
-    "sell_price", "sell_date", "net_profit"
-]
-# ====== Память описаний по игре (descriptions.csv) ======
-DESC_CSV = os.path.join(os.path.dirname(__file__), "descriptions.csv")
-DESC_FIELDS = ["game_key", "description", "updated_at"]
-
-if not os.path.exists(DESC_CSV):
-    with open(DESC_CSV, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=DESC_FIELDS)
-        writer.writeheader()
-
-# Кто сейчас «вводит описание»: key = chat_id -> контекст ввода
-WAITING_DESC = {}  # { chat_id: {"nid": str, "target": float, "min_sale": float, "game": str} }
-
-def _game_key(name: str) -> str:
-    return re.sub(r"\s+", " ", (name or "").strip().lower())
-
-def get_description_for_game(game: str):
-    key = _game_key(game)
-    try:
-        with open(DESC_CSV, newline="", encoding="utf-8") as f:
-            for row in csv.DictReader(f):
-                if row["game_key"] == key:
-                    return row["description"]
-    except FileNotFoundError:
-        pass
-    return None
-
-def save_description_for_game(game: str, description: str):
-    key = _game_key(game)
-    rows = []
-    if os.path.exists(DESC_CSV):
-        with open(DESC_CSV, newline="", encoding="utf-8") as f:
-            rows = list(csv.DictReader(f))
-
-    updated = False
-    for r in rows:
-        if r["game_key"] == key:
-            r["description"] = description
-            r["updated_at"] = datetime.utcnow().isoformat()
-            updated = True
-            break
-    if not updated:
-        rows.append({
-            "game_key": key,
-            "description": description,
-            "updated_at": datetime.utcnow().isoformat()
-        })
-
-    with open(DESC_CSV, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=DESC_FIELDS)
-        writer.writeheader()
-        writer.writerows(rows)
-
-
-# ---- Утилиты для CSV ----
-# ---- Утилиты для БД вместо CSV ----
-def read_rows():
-    """Считать все строки из таблицы inventory как list[dict] + привести id к str."""
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT * FROM inventory ORDER BY id ASC")
+# callback'и по action и текст в диалоге по состоянию — см. router.py; подключается в конце модуля
+ROUTER = Router()
+
+# Поля лота — колонки таблицы inventory
+FIELDNAMES = [
+    "id", "alias", "source_text", "game", "account_desc", "buy_price",
+    "buy_date", "status", "min_sale_for_target", "notes",
+    "sell_price", "sell_date", "net_profit", "marketplace", "commission"
+]
+# ====== Память описаний по игре: таблица game_descriptions + кэш в памяти (description_store.py) ======
+DESCRIPTIONS = DescriptionStore(get_conn, run_db, ttl=float(os.getenv("DESCRIPTIONS_TTL", "30")))
+
+def get_description_for_game(game: str):
+    return DESCRIPTIONS.get(game)
+
+async def save_description_for_game(game: str, description: str):
+    """Запомнить описание для игры; если оно не изменилось — без записи в БД."""
+    return await DESCRIPTIONS.save(game, description)
+
+
+# ---- Репозиторий лотов: один точечный SQL на операцию ----
+LOT_UPDATABLE = set(FIELDNAMES) - {"id"}
+MONEY_FIELDS = {"buy_price", "sell_price", "net_profit", "min_sale_for_target"}   # NUMERIC(12,2)
+RATE_FIELDS = {"commission"}                                                       # NUMERIC(6,4)
+DATE_FIELDS = {"buy_date", "sell_date"}                                            # TIMESTAMPTZ
+
+
+def _lot_value_from_db(v):
+    if v is None:
+        return ""
+    if isinstance(v, Decimal):
+        return str(v)                      # NUMERIC(12,2) -> '3.69'
+    if isinstance(v, datetime):
+        # как раньше: наивное UTC-время в ISO
+        return v.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+    return v
+
+
+def _lot_from_db(r):
+    """Строка из БД -> dict в формате CSV-версии (id и числа строками, даты ISO, None -> "")."""
+    d = {k: _lot_value_from_db(v) for k, v in dict(r).items()}
+    d["id"] = str(d["id"]) if d.get("id") != "" else ""
+    return d
+
+
+def _lot_to_db(fields):
+    """Обратное преобразование для INSERT/UPDATE: "" -> NULL, ISO-строки дат -> aware datetime (UTC)."""
+    out = {}
+    for k, v in fields.items():
+        if k in MONEY_FIELDS or k in RATE_FIELDS or k in DATE_FIELDS:
+            if v is None or (isinstance(v, str) and not v.strip()):
+                v = None
+            elif k in DATE_FIELDS and isinstance(v, str):
+                v = datetime.fromisoformat(v.strip())
+            if isinstance(v, datetime) and v.tzinfo is None:
+                v = v.replace(tzinfo=timezone.utc)
+        out[k] = v
+    return out
 
+
+def _lot_id(lot_id):
+    try:
+        return int(str(lot_id).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_lot(lot_id):
+    """Один лот по id или None."""
+    nid = _lot_id(lot_id)
+    if nid is None:
+        return None
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT * FROM inventory WHERE id = %s", (nid,))
+        r = cur.fetchone()
+        cur.close()
+    return _lot_from_db(r) if r else None
+
+
+def get_meta(key):
+    """Значение из bot_meta или None."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM bot_meta WHERE key = %s", (key,))
+        r = cur.fetchone()
+        cur.close()
+    return r[0] if r else None
+
+
+def set_meta(key, value):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO bot_meta (key, value) VALUES (%s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()",
+            (key, value),
+        )
+        cur.close()
+
+
+# Алиас — случайные буквы [a-z]; уникальность гарантирует индекс inventory_alias_key.
+# Если после ALIAS_MAX_CONFLICTS+ попыток доля конфликтов >= ALIAS_WIDEN_FILL, считаем
+# L-пространство почти заполненным и переходим на L+1 (3 буквы = 17 576 вариантов, 4 = 456 976, ...).
+ALIAS_MIN_LEN = 3
+ALIAS_MAX_CONFLICTS = 8
+ALIAS_WIDEN_FILL = 0.9
+_ALIAS_LEN = None   # текущая длина; при первом INSERT берём длину алиаса последнего лота
+INSERT_FIELDS = [key for key in FIELDNAMES if key != "id"] + ["fingerprint", "source_fp"]
+# лот с тем же отпечатком по содержимому (source_fp) за это окно — «возможный повтор»:
+# пишется всё равно (автобай может купить два одинаковых аккаунта подряд), но с предупреждением
+INTAKE_DEDUP_WINDOW = float(os.getenv("INTAKE_DEDUP_WINDOW", "600"))
+
+
+def generate_alias(length: int = ALIAS_MIN_LEN) -> str:
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def _current_alias_len(cur):
+    global _ALIAS_LEN
+    if _ALIAS_LEN is None:
+        cur.execute("SELECT length(alias) FROM inventory WHERE alias IS NOT NULL ORDER BY id DESC LIMIT 1")
+        r = cur.fetchone()
+        _ALIAS_LEN = max(ALIAS_MIN_LEN, r[0] if r else 0)
+    return _ALIAS_LEN
+
+
+def lots_by_fingerprint(cur, fingerprints):
+    """fingerprint -> лот для уже записанных отпечатков (точечный поиск по inventory_fingerprint_key)."""
+    fingerprints = [fp for fp in set(fingerprints) if fp]
+    if not fingerprints:
+        return {}
+    cur.execute("SELECT * FROM inventory WHERE fingerprint = ANY(%s)", (fingerprints,))
+    return {r["fingerprint"]: _lot_from_db(r) for r in cur.fetchall()}
+
+
+def recent_lots_by_source_fp(cur, source_fps, window=INTAKE_DEDUP_WINDOW):
+    """source_fp -> последний лот с этим отпечатком, принятый за последние window секунд."""
+    source_fps = list({fp for fp in source_fps if fp})
+    if not source_fps:
+        return {}
+    cur.execute(
+        "SELECT * FROM inventory WHERE source_fp = ANY(%s) "
+        "AND created_at > now() - %s * interval '1 second' ORDER BY id",
+        (source_fps, window),
+    )
+    return {r["source_fp"]: _lot_from_db(r) for r in cur.fetchall()}
+
+
+def insert_lots(items):
+    """
+    Вставить пачку лотов одной транзакцией. id берутся из inventory_id_seq, алиасы
+    подбираются пачкой через INSERT ... ON CONFLICT DO NOTHING; не вставшие
+    из-за конфликта алиаса повторяются с новыми алиасами — без чтения таблицы.
+
+    fingerprint (Idempotency-Key или id заказа у площадки) уникален навсегда: если такой уже
+    записан (в том числе в этой же пачке или параллельным запросом), новый лот не создаётся —
+    возвращается существующий. source_fp (отпечаток по содержимому) ничего не отсеивает: лот
+    пишется, а если за INTAKE_DEDUP_WINDOW уже был такой же — в логе предупреждение и
+    possible_duplicate_of=id того лота.
+    Возвращает строки в порядке items; у каждой duplicate=True/False.
+    """
+    global _ALIAS_LEN
     rows = []
-    for r in cur.fetchall():
-        d = dict(r)
-        # id из INTEGER -> строка, как было в CSV-версии
-        if d.get("id") is not None:
-            d["id"] = str(d["id"])
-        else:
-            d["id"] = ""
-        rows.append(d)
+    for fields in items:
+        unknown = set(fields) - (LOT_UPDATABLE - {"alias"} | {"fingerprint", "source_fp"})
+        if unknown:
+            raise ValueError(f"unknown lot fields: {sorted(unknown)}")
+        row = _lot_to_db({key: fields.get(key, "") for key in INSERT_FIELDS if key != "alias"})
+        row["status"] = row["status"] or "in_stock"
+        row["fingerprint"] = row["fingerprint"] or None
+        row["source_fp"] = row["source_fp"] or None
+        rows.append(row)
+    if not rows:
+        return []
 
-    cur.close()
-    conn.close()
-    return rows
+    result = [None] * len(rows)
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        known = lots_by_fingerprint(cur, [row["fingerprint"] for row in rows])
+        recent = recent_lots_by_source_fp(cur, [row["source_fp"] for row in rows])
+        pending, first_of = [], {}
+        for i, row in enumerate(rows):
+            fp = row["fingerprint"]
+            if fp in known:
+                result[i] = dict(known[fp], duplicate=True)
+            elif fp and fp in first_of:
+                continue        # повтор внутри пачки — заполним после вставки первого
+            else:
+                if fp:
+                    first_of[fp] = i
+                pending.append(i)
 
+        length = _current_alias_len(cur)
+        attempts = conflicts = 0
+        while pending:
+            taken = set()
+            for i in pending:
+                alias = generate_alias(length)
+                while alias in taken:
+                    alias = generate_alias(length)
+                taken.add(alias)
+                rows[i]["alias"] = alias
+            returned = psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO inventory ({', '.join(INSERT_FIELDS)}) VALUES %s "
+                "ON CONFLICT DO NOTHING RETURNING *",
+                [tuple(rows[i][key] for key in INSERT_FIELDS) for i in pending],
+                page_size=len(pending),
+                fetch=True,
+            )
+            by_alias = {r["alias"]: r for r in returned}
+            still = []
+            for i in pending:
+                r = by_alias.get(rows[i]["alias"])
+                if r is None:
+                    still.append(i)
+                else:
+                    result[i] = dict(_lot_from_db(r), duplicate=False)
+            # не вставшие могли упереться не в алиас, а в отпечаток (параллельный приём того же)
+            raced = lots_by_fingerprint(cur, [rows[i]["fingerprint"] for i in still])
+            if raced:
+                for i in still:
+                    if rows[i]["fingerprint"] in raced:
+                        result[i] = dict(raced[rows[i]["fingerprint"]], duplicate=True)
+                still = [i for i in still if result[i] is None]
+            attempts += len(pending)
+            conflicts += len(still)
+            if attempts >= ALIAS_MAX_CONFLICTS and conflicts >= ALIAS_WIDEN_FILL * attempts:
+                length += 1
+                attempts = conflicts = 0
+                _ALIAS_LEN = max(_ALIAS_LEN, length)
+            pending = still
+        cur.close()
+
+    for i, row in enumerate(rows):
+        if result[i] is None:
+            result[i] = dict(result[first_of[row["fingerprint"]]], duplicate=True)
+        elif not result[i]["duplicate"] and row["source_fp"] in recent:
+            prev = recent[row["source_fp"]]["id"]
+            result[i]["possible_duplicate_of"] = prev
+            print(
+                f">>> WARNING possible duplicate purchase: lot {result[i]['id']} "
+                f"has the same content as lot {prev}"
+            )
+    return result
+
+
+def insert_lot(**fields):
+    """Вставить один лот (см. insert_lots). Возвращает созданную строку."""
+    return insert_lots([fields])[0]
+
+
+def update_lot(lot_id, **fields):
+    """UPDATE только переданных полей. Возвращает обновлённую строку или None, если лота нет."""
+    unknown = set(fields) - LOT_UPDATABLE
+    if unknown:
+        raise ValueError(f"unknown lot fields: {sorted(unknown)}")
+    nid = _lot_id(lot_id)
+    if nid is None:
+        return None
+    if not fields:
+        return get_lot(nid)
+    cols = sorted(fields)
+    assignments = ", ".join(f"{c} = %({c})s" for c in cols)
+    params = dict(_lot_to_db(fields), _id=nid)
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(f"UPDATE inventory SET {assignments} WHERE id = %(_id)s RETURNING *", params)
+        r = cur.fetchone()
+        cur.close()
+    return _lot_from_db(r) if r else None
 
-def write_rows(rows):
+
+def _like_prefix(text):
+    """'cs_2' -> 'cs\\_2%' для LIKE: спецсимволы экранируются, ищется префикс."""
+    return re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+
+def list_lots(status=None, limit=None, after=None, before=None, game=None, ids=None):
     """
-    Полная перезапись таблицы inventory содержимым rows.
-    Это совместимо с твоей логикой:
-    - обычно: read_rows() -> что-то поменять -> write_rows(rows)
+    Лоты по возрастанию id.
+    status — строка или список статусов; after — вернуть только id > after; limit — сколько максимум.
+    before — только id < before: берутся ближайшие к курсору (страница «назад»), порядок тот же.
+    game — префикс названия игры без учёта регистра (индекс inventory_game_prefix_idx).
+    ids — только лоты с этими id.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM inventory")
-    for r in rows:
-        # гарантируем наличие всех ключей, чтобы INSERT не упал
-        for key in FIELDNAMES:
-            r.setdefault(key, "")
+    where, params = [], []
+    if ids is not None:
+        where.append("id = ANY(%s)")
+        params.append([int(i) for i in ids])
+    if status:
+        statuses = [status] if isinstance(status, str) else list(status)
+        where.append("status = ANY(%s)")
+        params.append(statuses)
+    if game:
+        where.append("lower(game) LIKE %s")
+        params.append(_like_prefix(game.strip().lower()))
+    if after is not None:
+        where.append("id > %s")
+        params.append(_lot_id(after) or 0)
+    if before is not None:
+        where.append("id < %s")
+        params.append(_lot_id(before) or 0)
+    sql = "SELECT * FROM inventory"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC" if before is not None else " ORDER BY id ASC"
+    if limit:
+        sql += " LIMIT %s"
+        params.append(int(limit))
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, params)
+        fetched = cur.fetchall()
+        cur.close()
+    if before is not None:
+        fetched.reverse()
+    return [_lot_from_db(r) for r in fetched]
+
+
+FIND_SIMILARITY = float(os.getenv("FIND_SIMILARITY", "0.4"))   # порог word_similarity для /find
+
+
+FIND_MIN_QUERY = 3     # короче pg_trgm не строит триграмм — LIKE '%ab%' идёт мимо индекса
+
+
+def _find_cursor(cursor):
+    """'1_0.5_42' -> (exact, rank, id) для keyset-сравнения в find_lots."""
+    exact, rank, nid = cursor.split("_")
+    return exact == "1", float(rank), int(nid)
+
+
+def find_lots(query, limit=10, after=None, before=None):
+    """
+    Нечёткий поиск по игре, описанию и заметкам (без учёта регистра): подстрока или похожее
+    слово (pg_trgm, индекс inventory_search_doc_trgm_idx) — от FIND_MIN_QUERY символов.
+    Алиас — только точное совпадение (без учёта регистра и крайних пробелов), число любой
+    длины — ещё и id.
+    Сначала точное совпадение алиаса/id, дальше по похожести, свежие выше.
+    Страницы — keyset по (точное, похожесть, id), как у list_lots: after/before — курсор
+    "_cursor" последней/первой строки соседней страницы; порядок строк всегда один.
+    """
+    q = " ".join(query.split()).lower()
+    nid = _lot_id(q) if q.isdigit() else None
+    match = ["alias = %(q)s"]
+    if len(q) >= FIND_MIN_QUERY:
+        match += [f"{SEARCH_DOC} LIKE %(like)s", f"%(q)s <%% {SEARCH_DOC}"]
+    if nid is not None:
+        match.append("id = %(id)s")
+    where = " OR ".join(match)
+    params = {"q": q, "like": "%" + _like_prefix(q), "id": nid, "limit": int(limit)}
+    page, order = "", "DESC"
+    cursor = after if after is not None else before
+    if cursor is not None:
+        params["c_exact"], params["c_rank"], params["c_id"] = _find_cursor(cursor)
+        page = "WHERE (_exact, _rank, id) {} (%(c_exact)s, %(c_rank)s::real, %(c_id)s)".format(
+            "<" if after is not None else ">"
+        )
+        order = "DESC" if after is not None else "ASC"
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(
+            "SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+            (str(FIND_SIMILARITY),),
+        )
+        cur.execute(
+            f"""
+            SELECT * FROM (
+                SELECT *, coalesce(alias = %(q)s OR id = %(id)s, false) AS _exact,
+                       word_similarity(%(q)s, {SEARCH_DOC}) AS _rank
+                FROM inventory WHERE {where}
+            ) found {page}
+            ORDER BY _exact {order}, _rank {order}, id {order}
+            LIMIT %(limit)s
+            """,
+            params,
+        )
+        fetched = cur.fetchall()
+        cur.close()
+    if before is not None:
+        fetched.reverse()
+    lots = []
+    for r in fetched:
+        lot = _lot_from_db(r)
+        exact, rank = lot.pop("_exact", False), lot.pop("_rank", 0.0)
+        lot["_cursor"] = f"{int(bool(exact))}_{float(rank)!r}_{lot['id']}"
+        lots.append(lot)
+    return lots
+
 
+REPRICE_STATUSES = ("in_stock", "listed")   # /reprice без статуса — все непроданные
+
+
+def reprice_lots(target_net, status=None, apply=False):
+    """
+    Пересчитать min_sale_for_target под профит target_net для всех лотов со статусом status
+    (по умолчанию REPRICE_STATUSES), каждый — по своему правилу из PRICING_RULES. Возвращает [(id, старая цена, новая цена)] в центах —
+    только изменившиеся. apply=True — записать их одним UPDATE ... FROM (VALUES ...)
+    в той же транзакции (строки блокируются, чтобы превью и запись считались по одним данным).
+    """
+    statuses = [status] if isinstance(status, str) else list(status or REPRICE_STATUSES)
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(
+            "SELECT id, game, marketplace, buy_price, min_sale_for_target FROM inventory "
+            "WHERE status = ANY(%s) AND buy_price IS NOT NULL ORDER BY id" + (" FOR UPDATE" if apply else ""),
+            (statuses,),
+        )
+        lots = [_lot_from_db(r) for r in cur.fetchall()]
+        changes = pricing.plan_reprice_by_rule(lots, pricing.exact_cents(target_net), lot_pricing_rule)
+        if apply and changes:
+            psycopg2.extras.execute_values(
+                cur,
+                "UPDATE inventory AS i SET min_sale_for_target = v.price "
+                "FROM (VALUES %s) AS v(id, price) WHERE i.id = v.id",
+                [(nid, Decimal(new) / 100) for nid, _, new in changes],
+                template="(%s::integer, %s::numeric)",
+                page_size=len(changes),
+            )
+        cur.close()
+    return changes
+
+
+# ---- Экспорт: COPY ... TO STDOUT -> gzip-части во временных файлах ----
+EXPORT_FIELDS = FIELDNAMES
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))   # лимит Telegram — 50 МБ
+
+
+class _GzipParts:
+    """
+    Файлоподобный приёмник для copy_expert: пишет CSV в gzip-файлы, начиная новую часть,
+    когда сжатый размер дошёл до part_bytes. COPY отдаёт данные построчно (сообщение
+    протокола = строка), поэтому части режутся между строками; заголовок — в каждой части.
+    """
+
+    def __init__(self, part_bytes):
+        self.part_bytes = part_bytes
+        self.parts = []         # [(путь, строк данных)]
+        self._header = None
+        self._raw = self._gz = None
+        self._rows = 0
+
+    def _open(self):
+        fd, path = tempfile.mkstemp(prefix="export-", suffix=".csv.gz")
+        self._raw = os.fdopen(fd, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self.parts.append([path, 0])
+        if self._header is not None:
+            self._gz.write(self._header)
+
+    def _close(self):
+        if self._gz is not None:
+            self._gz.close()
+            self._raw.close()
+            self._gz = self._raw = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self._header is None:
+            self._header = data
+            self._open()
+            return
+        if self._raw.tell() >= self.part_bytes and self.parts[-1][1]:
+            self._close()
+            self._open()
+        self._gz.write(data)
+        self.parts[-1][1] += 1
+
+    def finish(self):
+        if self._gz is None and not self.parts:
+            self._open()
+        self._close()
+        return [tuple(p) for p in self.parts]
+
+    def discard(self):
+        self._close()
+        for path, _ in self.parts:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def export_lots(status=None, since=None, until=None, part_bytes=EXPORT_PART_BYTES):
+    """
+    Выгрузить inventory в CSV.gz потоком (память не зависит от размера таблицы).
+    status — фильтр по статусу; since/until — по buy_date, [since, until).
+    Возвращает [(путь к временному файлу, строк)] — удалить после отправки.
+    """
+    where, params = [], []
+    if status:
+        where.append("status = %s")
+        params.append(status)
+    if since is not None:
+        where.append("buy_date >= %s")
+        params.append(since)
+    if until is not None:
+        where.append("buy_date < %s")
+        params.append(until)
+    sink = _GzipParts(part_bytes)
+    try:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            query = cur.mogrify(
+                f"SELECT {', '.join(EXPORT_FIELDS)} FROM inventory"
+                + (" WHERE " + " AND ".join(where) if where else "")
+                + " ORDER BY id",
+                params,
+            ).decode("utf-8")
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink)
+            cur.close()
+        return sink.finish()
+    except BaseException:
+        sink.discard()
+        raise
+
+
+# ---- Правила цен (pricing_rules): в памяти, перечитываются при изменении таблицы ----
+_pricing_checked_at = float("-inf")
+
+
+def load_pricing_rules(force=False):
+    """
+    Перечитать pricing_rules в PRICING_RULES, если таблица изменилась (число строк или
+    max(updated_at) — его обновляет триггер). True — если правила перезагружены.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT count(*) AS n, max(updated_at) AS ts FROM pricing_rules")
+        r = cur.fetchone()
+        signature = (r["n"], r["ts"])
+        if not force and signature == PRICING_RULES.signature:
+            cur.close()
+            return False
+        cur.execute(
+            "SELECT game_key, marketplace, commission, price_ending, min_margin FROM pricing_rules"
+        )
+        rows = cur.fetchall()
+        cur.close()
+    PRICING_RULES.load(rows, signature)
+    return True
+
+
+async def refresh_pricing_rules():
+    """Проверить pricing_rules не чаще раза в PRICING_RULES_TTL секунд."""
+    global _pricing_checked_at
+    now = time.monotonic()
+    if now - _pricing_checked_at < PRICING_RULES_TTL:
+        return
+    _pricing_checked_at = now
+    try:
+        if await run_db(load_pricing_rules):
+            print(f">>> pricing rules reloaded: {len(PRICING_RULES)}")
+    except Exception as e:
+        print(">>> ERROR reloading pricing rules:", e)
+
+
+class CacheRefreshMiddleware(BaseMiddleware):
+    """Перед каждым апдейтом — актуальные правила цен и описания (обычно без запроса в БД)."""
+
+    async def on_pre_process_update(self, update, data):
+        await refresh_pricing_rules()
+        await DESCRIPTIONS.refresh()
+
+
+dp.middleware.setup(CacheRefreshMiddleware())
+
+
+# ---- Агрегаты для /stats и /monthly: считает БД, по сети идёт одна строка ----
+def inventory_stats():
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("""
+            SELECT
+                COUNT(*)                                                              AS bought_count,
+                COALESCE(SUM(buy_price), 0)                                           AS total_spent,
+                COUNT(*) FILTER (WHERE status = 'sold' AND net_profit IS NOT NULL)    AS sold_count,
+                COALESCE(SUM(net_profit) FILTER (WHERE status = 'sold'), 0)           AS total_profit,
+                COALESCE(SUM(sell_price * commission) FILTER (WHERE status = 'sold'), 0) AS total_commission,
+                COUNT(*) FILTER (WHERE status = 'restored')                           AS restored_count,
+                COALESCE(SUM(buy_price) FILTER (WHERE status = 'restored'), 0)        AS total_losses
+            FROM inventory
+        """)
+        res = cur.fetchone()
+        cur.close()
+    return res
+
+
+def month_stats(year: int, month: int):
+    """Покупки по buy_date, продажи/восстановления по sell_date в пределах месяца (UTC)."""
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         cur.execute("""
-            INSERT INTO inventory (
-                id, alias, source_text, game, account_desc,
-                buy_price, buy_date, status, min_sale_for_target,
-                notes, sell_price, sell_date, net_profit
-            ) VALUES (
-                %(id)s, %(alias)s, %(source_text)s, %(game)s, %(account_desc)s,
-                %(buy_price)s, %(buy_date)s, %(status)s, %(min_sale_for_target)s,
-                %(notes)s, %(sell_price)s, %(sell_date)s, %(net_profit)s
+            SELECT
+                COUNT(*) FILTER (WHERE b)                                        AS bought_count,
+                COALESCE(SUM(buy_price) FILTER (WHERE b), 0)                     AS total_spent,
+                COUNT(*) FILTER (WHERE s AND status = 'sold')                    AS sold_count,
+                COALESCE(SUM(net_profit) FILTER (WHERE s AND status = 'sold'), 0) AS total_net_sales,
+                COUNT(*) FILTER (WHERE s AND status = 'restored')                AS restored_count,
+                COALESCE(SUM(buy_price) FILTER (WHERE s AND status = 'restored'), 0) AS total_losses
+            FROM (
+                SELECT status, buy_price, net_profit,
+                       (buy_date >= %(start)s AND buy_date < %(end)s)   AS b,
+                       (sell_date >= %(start)s AND sell_date < %(end)s) AS s
+                FROM inventory
+                WHERE (buy_date >= %(start)s AND buy_date < %(end)s)
+                   OR (sell_date >= %(start)s AND sell_date < %(end)s)
+            ) m
+        """, {"start": start, "end": end})
+        res = cur.fetchone()
+        cur.close()
+    return res
+
+
+# ---- Обработанные апдейты Telegram (персистентная часть дедупликации) ----
+PROCESSED_UPDATES_TTL = int(os.getenv("UPDATE_DEDUP_TTL", "86400"))
+_claims_since_cleanup = 0
+
+
+def claim_update(update_id) -> bool:
+    """Отметить update_id обработанным. False — если его уже видели (повторная доставка)."""
+    global _claims_since_cleanup
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING update_id",
+            (int(update_id),),
+        )
+        fresh = cur.fetchone() is not None
+        _claims_since_cleanup += 1
+        if _claims_since_cleanup >= 500:
+            _claims_since_cleanup = 0
+            cur.execute(
+                "DELETE FROM processed_updates WHERE seen_at < now() - %s * interval '1 second'",
+                (PROCESSED_UPDATES_TTL,),
             )
-        """, r)
-    conn.commit()
-    cur.close()
-    conn.close()
+        cur.close()
+    return fresh
+
+
+def release_update(update_id):
+    """Снять отметку (апдейт не приняли в обработку — пусть повторная доставка пройдёт)."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM processed_updates WHERE update_id = %s", (int(update_id),))
+        cur.close()
+
+
+# вызываются после очистки базы (сброс кэшей, ссылающихся на удалённые лоты)
+AFTER_WIPE_HOOKS = []
 
 
 def reset_csv():
     """Теперь просто очищаем таблицу inventory в базе."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM inventory")
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def next_id(rows):
-    if not rows:
-        return 1
-    return max(int(r["id"]) for r in rows) + 1
-
-def generate_unique_alias(existing: set, length: int = 3) -> str:
-    """Возвращает уникальные 3 буквы [a-z], которых нет в existing."""
-    while True:
-        alias = ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
-        if alias not in existing:
-            return alias
-
-def to_decimal(s):
-    """Преобразует строку с ',' или '.' в Decimal, убирает пробелы и NBSP."""
-    if s is None:
-        raise InvalidOperation
-    s = s.replace("\xa0", "").replace(" ", "").strip()
-    s = s.replace(",", ".")
-    return Decimal(s)
-
-def calc_min_sale(buy_price, target_net=1.0):
-    # sale = (target_net + buy) / (1 - COMMISSION)
-    buy = Decimal(str(buy_price))
-    target = Decimal(str(target_net))
-    denom = Decimal("1") - Decimal(str(COMMISSION))
-    sale = (target + buy) / denom
-    return float(sale.quantize(Decimal("0.01")))
-
-def calc_net_from_sale(sale_price, buy_price):
-    sale = Decimal(str(sale_price))
-    buy = Decimal(str(buy_price))
-    received = sale * (Decimal("1") - Decimal(str(COMMISSION)))
-    net = received - buy
-    return float(net.quantize(Decimal("0.01")))
-
-def apply_psychological_ending(amount, ending=PRICE_ENDING):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # как и раньше с CSV: после очистки нумерация начинается с 1
+        cur.execute("TRUNCATE inventory RESTART IDENTITY")
+        cur.close()
+
+
+def lot_pricing_rule(row):
+    """Правило цены для лота (PricingRule) по игре и площадке."""
+    return PRICING_RULES.resolve(row.get("game"), row.get("marketplace"))
+
+
+# Профит по умолчанию, когда цель не пришла из кнопки (старые кнопки editdesc:<id>)
+DEFAULT_TARGET_NET = 1.0
+
+def calc_min_sale(buy_price, target_net=DEFAULT_TARGET_NET, rule=None):
+    # sale = (target_net + buy) / (1 - комиссия); считается в центах, см. pricing.py
+    rule = rule or PRICING_RULES.default
+    target = max(pricing.exact_cents(target_net), rule.min_margin_cents)
+    return pricing.from_cents(pricing.min_sale_cents(
+        pricing.exact_cents(buy_price), target, rule.commission_bp
+    ))
+
+def calc_net_from_sale(sale_price, buy_price, rule=None):
+    rule = rule or PRICING_RULES.default
+    sale = Decimal(str(sale_price))
+    buy = Decimal(str(buy_price))
+    received = sale * (Decimal("1") - Decimal(rule.commission_bp) / pricing.BP)
+    net = received - buy
+    return float(net.quantize(Decimal("0.01")))
+
+def apply_psychological_ending(amount, ending=None):
     """
-    Режимы:
+    Режимы (см. pricing.psychological_ending_cents), по умолчанию — PRICE_ENDING:
       ending == "tenth_9": округлить вверх к следующей 0.1, затем -0.01
-        3.66 -> 3.69, 6.30 -> 6.39, 2.00 -> 2.09, 3.69 -> 3.69
+        3.66 -> 3.69, 3.69 -> 3.69
       ending in (".99", ".49"): округлить вверх к ближайшему X.99 или X.49
     """
     try:
-        d = Decimal(str(amount)).quantize(Decimal("0.01"))
+        cents = pricing.to_cents(amount)
     except Exception:
         return float(amount)
+    return pricing.from_cents(pricing.psychological_ending_cents(cents, ending or PRICE_ENDING))
+
+def min_sale_for_lot(row, target_net):
+    """Мин. цена продажи лота под профит target_net по его правилу (комиссия, мин. профит, окончание)."""
+    rule = lot_pricing_rule(row)
+    return apply_psychological_ending(
+        calc_min_sale(float(row["buy_price"]), target_net=target_net, rule=rule), rule.ending
+    )
+
+def set_description_for_game(game: str, desc: str) -> None:
+    if desc:
+        GAME_DEFAULT_DESC[game] = desc.strip()
 
-    if ending == "tenth_9":
-        cents = int(d * 100)                       # 3.66 -> 366
-        next_tenth_cents = ((cents + 9) // 10) * 10
-        candidate_cents = next_tenth_cents - 1     # 370 -> 369 => 3.69
-        return float(Decimal(candidate_cents) / Decimal(100))
-
-    if ending in (".99", ".49"):
-        end = Decimal(ending)
-        int_part = int(d)  # целая часть вниз
-        candidate = Decimal(int_part) + end
-        if candidate < d:
-            candidate = Decimal(int_part + 1) + end
-        return float(candidate.quantize(Decimal("0.01")))
-
-    return float(d)
-
-    end = Decimal(ending)
-    int_part = int(d)  # целая часть вниз
-    candidate = Decimal(int_part) + end
-    if candidate < d:
-        candidate = Decimal(int_part + 1) + end
-    return float(candidate.quantize(Decimal("0.01")))
-
-def set_description_for_game(game: str, desc: str) -> None:
-    if desc:
-        GAME_DEFAULT_DESC[game] = desc.strip()
-
 def compose_listing(row, nid, target, min_sale, desc: str) -> str:
     alias = (row.get("alias") or "").lower()
     prefix = f"{alias} | " if alias else ""
@@ -307,285 +901,150 @@ def compose_listing(row, nid, target, min_sale, desc: str) -> str:
         f"Мин. цена продажи: {min_sale}$\n\n"
         "Описание для лота:\n"
         f"{prefix}{desc.strip()}"
-    )
-
-# ---- Парсер уведомления ----
-RE_LINK = re.compile(r'По вашей ссылке\s*["“](?P<link>[^"”]+)["”]', re.IGNORECASE)
-RE_BUYPRICE = re.compile(r'за\s*(?:\$\s*)?([\d\.,]+)(?:\s*\$)?', re.IGNORECASE)
-RE_KUP = re.compile(r'куплен аккаунт\s*(?P<acc>.*?)\s*(?:В сети:|в сети:|за\s|$)', re.IGNORECASE)
-RE_GAME_QUOTE_FALLBACK = re.compile(r'["“](?P<g>[^"”]+)["”]')
-
-def parse_notification(text: str):
-    text = text.strip()
-    game = None
-    account_desc = ""
-    buy_price = None
-
-    m = RE_LINK.search(text)
-    if m:
-        game = m.group("link").strip()
-
-    m2 = RE_KUP.search(text)
-    if m2:
-        account_desc = m2.group("acc").strip()
-
-    m3 = RE_BUYPRICE.search(text)
-    if m3:
-        price_str = m3.group(1)
-        try:
-            buy_price = float(str(to_decimal(price_str)))
-        except Exception:
-            buy_price = None
-
-    if not game:
-        m4 = RE_GAME_QUOTE_FALLBACK.search(text)
-        if m4:
-            game = m4.group("g").strip()
-
-    if not game:
-        m5 = re.search(r'(.+?)куплен аккаунт', text, re.IGNORECASE)
-        if m5:
-            game = m5.group(1).strip().split()[-1]
-
-    return {
-        "game": game or "",
-        "account_desc": account_desc or "",
-        "buy_price": buy_price,
-        "source_text": text
-    }
+    )
+
+# ---- Парсер уведомления ----
 # --- Авто-описание по игре ---
+# Правила автоописания — desc_rules.json (см. desc_rules.py), перечитываются при изменении файла
+DESC_RULES = DescriptionRules(
+    os.getenv("DESC_RULES_PATH", os.path.join(os.path.dirname(__file__), "desc_rules.json")),
+    ttl=float(os.getenv("DESC_RULES_TTL", "10")),
+)
+
+
 def auto_desc_for_game(game: str, account_desc: str = "") -> str:
-    t = f"{game} {account_desc}".lower()
-
-    # CS2
-    if ("cs2" in t) or ("counter-strike 2" in t) or ("counter strike 2" in t):
-        return "CS2 PRIME | ПОЛНЫЙ ДОСТУП | МОЖНО СМЕНИТЬ ПОЧТУ"
-
-    # DBD
-    if ("dead by daylight" in t) or ("dbd" in t):
-        return "DEAD BY DAYLIGHT | HOURS"
-
-    # GTA: сохраняем оригинальное написание из уведомления
-    if ("gta 5" in t) or ("gta v" in t) or ("grand theft auto v" in t):
-        name = (game or "GTA 5").strip()
-        return f"{name} | 0 HOURS | СОШИАЛ МОЖНО ПРИВЯЗАТЬ САМОМУ"
-
-    # По умолчанию — капсом
-    return (game or "").upper()
-# ---- Команды/Handlers ----
-@dp.message_handler(commands=["start", "help"])
-async def cmd_start(message: types.Message):
-    await message.answer(HELP_TEXT)
-
-
-@dp.message_handler(commands=["add_buy"])
-async def cmd_add_buy(message: types.Message):
-    args = message.get_args()
-    if not args or "|" not in args:
-        await message.answer("Использование: /add_buy Игра|Цена|Примечание")
-        return
-    try:
-        game, price, notes = [p.strip() for p in args.split("|", 2)]
-        price_f = float(to_decimal(price))
-    except Exception:
-        await message.answer("Неверный формат цены.")
-        return
-
-    async with FILE_LOCK:
-        rows = read_rows()
-        nid = next_id(rows)
-        existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-        alias = generate_unique_alias(existing_aliases)
-        min_sale = apply_psychological_ending(calc_min_sale(price_f, target_net=1.0))
-        new = {
-            "id": str(nid),
-            "alias": alias,
-            "source_text": f"manual:{game}|{price_f}|{notes}",
-            "game": game,
-            "account_desc": "",
-            "buy_price": f"{price_f:.2f}",
-            "buy_date": datetime.utcnow().isoformat(),
-            "status": "in_stock",
-            "min_sale_for_target": f"{min_sale:.2f}",
-            "notes": notes,
-            "sell_price": "",
-            "sell_date": "",
-            "net_profit": ""
-            
-        }
-        rows.append(new)
-        write_rows(rows)
-
-    await message.answer(f"Добавлен лот ID {nid} — {game} за {price_f}$\nМин. цена для $1: {min_sale}$")
-
-
-@dp.message_handler(commands=["list"])
-async def cmd_list(message: types.Message):
-    rows = read_rows()
-    listed = [r for r in rows if (r.get("status") or "") == "listed"]
-
-    if not listed:
-        await message.answer("Пока нет опубликованных лотов.")
+    return DESC_RULES.describe(game, account_desc)
+# ---- Команды/Handlers ----
+@dp.message_handler(commands=["start", "help"])
+async def cmd_start(message: types.Message):
+    await message.answer(HELP_TEXT)
+
+
+@dp.message_handler(commands=["add_buy"])
+async def cmd_add_buy(message: types.Message):
+    args = message.get_args()
+    if not args or "|" not in args:
+        await message.answer("Использование: /add_buy Игра|Цена|Примечание[|Площадка]")
+        return
+    try:
+        parts = [p.strip() for p in args.split("|", 3)]
+        game, price = parts[0], parts[1]
+        notes = parts[2] if len(parts) > 2 else ""
+        marketplace = parts[3] if len(parts) > 3 else ""
+        price_f = float(to_decimal(price))
+    except Exception:
+        await message.answer("Неверный формат цены.")
         return
 
-    kb = InlineKeyboardMarkup(row_width=1)
-    for r in listed:
-        alias = (r.get("alias") or "").lower()
-        title = f'ID {r["id"]} — {(alias + " | ") if alias else ""}{r["game"]}'
-        kb.add(InlineKeyboardButton(title, callback_data=f"open:{r['id']}"))
-
-    await message.answer("Выберите лот:", reply_markup=kb)
-@dp.message_handler(lambda m: (m.text is not None) and m.chat.id in WAITING_DESC, content_types=types.ContentType.TEXT)
-async def receive_description(message: types.Message):
-    ctx = WAITING_DESC.pop(message.chat.id, None)
-    if not ctx:
-        return
-
-    desc = message.text.strip()
-    nid = ctx["nid"]
-    target = ctx["target"]
-    min_sale = ctx["min_sale"]
-    game = ctx["game"]
-
-    # Сохраняем «память» описания для этой игры
-    async with FILE_LOCK:
-        save_description_for_game(game, desc)
-
-    # Достаём ряд для сборки ответа
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        await message.answer("Лот не найден, попробуйте ещё раз.")
-        return
-
-    listing_text = compose_listing(row, nid, target, min_sale, desc)
-
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"editdesc:{nid}"))
-    kb.add(
-    InlineKeyboardButton("Отметить опубликованным",
-                         callback_data=f"posted:{nid}:{(row.get('alias') or '').lower()}"),
-    InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-)
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
-    await message.answer(listing_text, reply_markup=kb)
-# 3.1. Пользователь вводит описание для кастомного профита
-@dp.message_handler(lambda m: USER_STATE.get(m.from_user.id, {}).get("mode") == "custom_desc")
-async def wait_custom_description(message: types.Message):
-    st = USER_STATE.get(message.from_user.id)
-    if not st:
-        return
-    desc = (message.text or "").strip()
-    if not desc:
-        await message.answer("Опишите лот текстом, пожалуйста.")
-        return
-
-    # сохраним описание временно и попросим ввести профит
-    USER_STATE[message.from_user.id] = {"mode": "custom_profit", "nid": st["nid"], "desc": desc}
-    await message.answer("Ок! Теперь введите желаемый профит числом (например: 1.2).")
-
-
-# 3.2. Пользователь вводит сам профит (число)
-@dp.message_handler(lambda m: USER_STATE.get(m.from_user.id, {}).get("mode") == "custom_profit")
-async def wait_custom_profit(message: types.Message):
-    st = USER_STATE.get(message.from_user.id)
-    if not st:
-        return
-
-    text = (message.text or "").strip()
-    try:
-        target = float(to_decimal(text))
-    except Exception:
-        await message.answer("Не понял. Введите профит числом, например 1.5")
-        return
-
-    nid = st["nid"]
-    desc = st["desc"]
-
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        USER_STATE.pop(message.from_user.id, None)
-        await message.answer("Лот не найден.")
-        return
-
-    # посчитаем минимальную цену и сразу сохраним её в CSV
-    min_sale = apply_psychological_ending(
-        calc_min_sale(float(row["buy_price"]), target_net=target)
-    )
-    row["min_sale_for_target"] = f"{min_sale:.2f}"
-    write_rows(rows)
-
-
-    # запомним описание для этой игры на будущее
-    GAME_DEFAULT_DESC[row["game"]] = desc
-
-    # соберём ответ и кнопки
-    listing_text = compose_listing(row, nid, target, min_sale, desc)
-
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
+    min_sale = min_sale_for_lot({"game": game, "marketplace": marketplace, "buy_price": price_f}, 1.0)
+    new = await run_db(
+        insert_lot,
+        source_text=f"manual:{game}|{price_f}|{notes}",
+        game=game,
+        marketplace=marketplace,
+        account_desc="",
+        buy_price=f"{price_f:.2f}",
+        buy_date=datetime.utcnow().isoformat(),
+        status="in_stock",
+        min_sale_for_target=f"{min_sale:.2f}",
+        notes=notes,
+    )
+    nid = new["id"]
+
+    await message.answer(f"Добавлен лот ID {nid} — {game} за {price_f}$\nМин. цена для $1: {min_sale}$")
+
+
+# 3.1. Пользователь вводит описание для кастомного профита
+@ROUTER.state("custom_desc")
+async def wait_custom_description(message: types.Message, st):
+    desc = (message.text or "").strip()
+    if not desc:
+        await message.answer("Опишите лот текстом, пожалуйста.")
+        return
+
+    # сохраним описание временно и попросим ввести профит
+    await USER_STATE.set(message.from_user.id, {"mode": "custom_profit", "nid": st["nid"], "desc": desc})
+    await message.answer("Ок! Теперь введите желаемый профит числом (например: 1.2).")
+
+
+# 3.2. Пользователь вводит сам профит (число)
+@ROUTER.state("custom_profit")
+async def wait_custom_profit(message: types.Message, st):
+    text = (message.text or "").strip()
+    try:
+        target = float(to_decimal(text))
+    except Exception:
+        await message.answer("Не понял. Введите профит числом, например 1.5")
+        return
+
+    nid = st["nid"]
+    desc = st["desc"]
+
+    row = await run_db(get_lot, nid)
+    if not row:
+        await USER_STATE.pop(message.from_user.id)
+        await message.answer("Лот не найден.")
+        return
+
+    # посчитаем минимальную цену и сразу сохраним её в БД
+    min_sale = min_sale_for_lot(row, target)
+    row = await run_db(update_lot, nid, min_sale_for_target=f"{min_sale:.2f}") or row
+
+
+    # запомним описание для этой игры на будущее
+    GAME_DEFAULT_DESC[row["game"]] = desc
+
+    # соберём ответ и кнопки
+    listing_text = compose_listing(row, nid, target, min_sale, desc)
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
     kb.add(
     InlineKeyboardButton("Отметить опубликованным",
                          callback_data=f"posted:{nid}:{(row.get('alias') or '').lower()}"),
     InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-)
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
-    await message.answer(listing_text, reply_markup=kb)
-    USER_STATE.pop(message.from_user.id, None)
-# Пользователь ввёл описание после выбора фиксированного профита (0.5/1/2)
-@dp.message_handler(lambda m: USER_STATE.get(m.from_user.id, {}).get("mode") == "fixed_desc")
-async def wait_fixed_desc(message: types.Message):
-    st = USER_STATE.get(message.from_user.id)
-    if not st:
-        return
-
-    nid = st["nid"]
-    target = float(st["target"])
-    desc = (message.text or "").strip()
-    if not desc:
-        await message.answer("Опишите лот текстом, пожалуйста.")
-        return
-
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        USER_STATE.pop(message.from_user.id, None)
-        await message.answer("Лот не найден.")
-        return
-
-    min_sale = apply_psychological_ending(
-         calc_min_sale(float(row["buy_price"]), target_net=target)
-    )
-    row["min_sale_for_target"] = f"{min_sale:.2f}"
-    write_rows(rows)
-
-
-    # Запоминаем описание и в памяти, и в CSV
-    GAME_DEFAULT_DESC[row["game"]] = desc
-    save_description_for_game(row["game"], desc)
-
-    listing_text = compose_listing(row, nid, target, min_sale, desc)
-
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
+)
+    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
+    await message.answer(listing_text, reply_markup=kb)
+    await USER_STATE.pop(message.from_user.id)
+# Пользователь ввёл описание после выбора фиксированного профита (0.5/1/2)
+@ROUTER.state("fixed_desc")
+async def wait_fixed_desc(message: types.Message, st):
+    nid = st["nid"]
+    target = float(st["target"])
+    desc = (message.text or "").strip()
+    if not desc:
+        await message.answer("Опишите лот текстом, пожалуйста.")
+        return
+
+    row = await run_db(get_lot, nid)
+    if not row:
+        await USER_STATE.pop(message.from_user.id)
+        await message.answer("Лот не найден.")
+        return
+
+    min_sale = min_sale_for_lot(row, target)
+    row = await run_db(update_lot, nid, min_sale_for_target=f"{min_sale:.2f}") or row
+
+
+    # Запоминаем описание: словарь процесса и таблица game_descriptions (DESCRIPTIONS)
+    GAME_DEFAULT_DESC[row["game"]] = desc
+    await save_description_for_game(row["game"], desc)
+
+    listing_text = compose_listing(row, nid, target, min_sale, desc)
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
     kb.add(
     InlineKeyboardButton("Отметить опубликованным",
                          callback_data=f"posted:{nid}:{(row.get('alias') or '').lower()}"),
     InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-)
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
-    await message.answer(listing_text, reply_markup=kb)
-    USER_STATE.pop(message.from_user.id, None)
-@dp.message_handler(
-    lambda m: USER_STATE.get(m.from_user.id, {}).get("mode") == "await_profit_value",
-    content_types=types.ContentType.TEXT,
 )
-async def handle_custom_profit_value(message: types.Message):
-    st = USER_STATE.get(message.from_user.id)
-    if not st:
-        return
-
+    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
+    await message.answer(listing_text, reply_markup=kb)
+    await USER_STATE.pop(message.from_user.id)
+@ROUTER.state("await_profit_value")
+async def handle_custom_profit_value(message: types.Message, st):
     nid = st["nid"]
     text = (message.text or "").strip()
     try:
@@ -594,22 +1053,18 @@ async def handle_custom_profit_value(message: types.Message):
         await message.answer("Не понял число. Введите, например: 1.5")
         return
 
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
+    row = await run_db(get_lot, nid)
     if not row:
-        USER_STATE.pop(message.from_user.id, None)
+        await USER_STATE.pop(message.from_user.id)
         await message.answer("ID не найден. Начните заново.")
         return
 
-    min_sale = apply_psychological_ending(
-        calc_min_sale(float(row["buy_price"]), target_net=target)
-    )
-    row["min_sale_for_target"] = f"{min_sale:.2f}"
-    write_rows(rows)
+    min_sale = min_sale_for_lot(row, target)
+    row = await run_db(update_lot, nid, min_sale_for_target=f"{min_sale:.2f}") or row
 
     # Авто-описание по игре
     desc = auto_desc_for_game(row["game"], row.get("account_desc", ""))
-    save_description_for_game(row["game"], desc)
+    await save_description_for_game(row["game"], desc)
 
     listing_text = compose_listing(row, nid, target, min_sale, desc)
 
@@ -622,395 +1077,402 @@ async def handle_custom_profit_value(message: types.Message):
 )
     kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
 
-    USER_STATE.pop(message.from_user.id, None)
+    await USER_STATE.pop(message.from_user.id)
     await message.answer(listing_text, reply_markup=kb)
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("open:"))
-async def cb_open(call: types.CallbackQuery):
-    _, nid = call.data.split(":", 1)
-    rows = read_rows()
-    row = next((r for r in rows if r.get("id") == str(nid)), None)
+# Обычный текст вне диалога — пересланное уведомление о покупке
+@ROUTER.state(None)
+async def handle_text(message: types.Message, st):
+    text = message.text.strip()
+    if text.startswith("/"):
+        return
+
+    parsed = parse_notification(text)
+    if not parsed["buy_price"]:
+        return
+
+    from ingest import ingest_and_notify   # ingest импортирует bot — поэтому здесь
+    lot = (await ingest_and_notify([parsed], message.chat.id))[0]
+    if lot["duplicate"]:
+        await message.answer(f"Эта покупка уже добавлена: ID {lot['id']}.")
+
+
+@dp.message_handler(commands=["generate_listing"])
+async def cmd_generate_listing(message: types.Message):
+    args = message.get_args().split()
+    if len(args) < 2:
+        await message.answer("Использование: /generate_listing <id> <target_net>")
+        return
+
+    nid, target = args[0], args[1]
+    try:
+        target_f = float(target)
+    except Exception:
+        await message.answer("Неверный целевой профит.")
+        return
+
+    row = await run_db(get_lot, nid)
+    if not row:
+        await message.answer("ID не найден.")
+        return
+
+    min_sale = min_sale_for_lot(row, target_f)
+    desc_default = auto_desc_for_game(row["game"], row.get("account_desc", ""))
+    txt = compose_listing(row, nid, target_f, min_sale, desc_default)
+    await message.answer(txt)
+   
+
+@ROUTER.callback("profit")
+async def cb_profit(call: types.CallbackQuery, nid, profit):
+    row = await run_db(get_lot, nid)
     if not row:
         await call.answer("Лот не найден.", show_alert=True)
         return
 
-    # безошибочно читаем числа
-    try:
-        min_sale = float(row.get("min_sale_for_target") or 0)
-    except:
-        min_sale = 0.0
-    try:
-        buy_price = float(row.get("buy_price") or 0)
-    except:
-        buy_price = 0.0
+    # Если пользователь выбрал Custom — просто просим ввести число профита
+    if profit == "custom":
+        await USER_STATE.set(call.from_user.id, {"mode": "await_profit_value", "nid": nid})
+        await call.message.answer("Введите желаемый профит числом, например: 1.5")
+        await call.answer()
+        return
 
-    # оценим target для карточки (если min_sale/price есть)
-    target = calc_net_from_sale(min_sale, buy_price) if (min_sale and buy_price) else 1.0
+    # Фиксированные варианты (0.5 / 1 / 2)
+    try:
+        target = float(profit)
+    except Exception:
+        target = 1.0
 
-    # подтянем шаблон описания (или автоген)
-    desc = get_description_for_game(row["game"]) or auto_desc_for_game(
-        row["game"], row.get("account_desc", "")
-    )
+    min_sale = min_sale_for_lot(row, target)
+    row = await run_db(update_lot, nid, min_sale_for_target=f"{min_sale:.2f}") or row
 
-    text = compose_listing(row, row["id"], target, min_sale, desc)
-    alias = (row.get("alias") or "").lower()
+    # Текст описания теперь всегда = название игры (alias подставится в compose_listing)
+    desc = auto_desc_for_game(row["game"], row.get("account_desc", ""))
+    await save_description_for_game(row["game"], desc)
+    listing_text = compose_listing(row, nid, target, min_sale, desc)
 
     kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{row['id']}:{target}"))
-    kb.add(
-        InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{row['id']}:{alias}"),
-        InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{row['id']}")
-    )
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{row['id']}"))
-
-    await call.message.answer(text, reply_markup=kb)
-    await call.answer()
-@dp.message_handler(
-    lambda m: (
-        m.text is not None
-        and not m.text.startswith('/')
-        and m.chat.id not in WAITING_DESC
-        and USER_STATE.get(m.from_user.id, {}).get("mode") is None  # <— важно
-    ),
-    content_types=types.ContentType.TEXT,
-)
-async def handle_text(message: types.Message):
-    text = message.text.strip()
-    if text.startswith("/"):
-        return
-
-    parsed = parse_notification(text)
-    if not parsed["buy_price"]:
-        return
-
-    async with FILE_LOCK:
-        rows = read_rows()
-        existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-        alias = generate_unique_alias(existing_aliases)
-        nid = next_id(rows)
-        new = {
-            "id": str(nid),
-            "alias": alias,
-            "source_text": parsed["source_text"],
-            "game": parsed["game"],
-            "account_desc": parsed["account_desc"],
-            "buy_price": f"{float(parsed['buy_price']):.2f}",
-            "buy_date": datetime.utcnow().isoformat(),
-            "status": "in_stock",
-            "min_sale_for_target": "",
-            "notes": "",
-            "sell_price": "",
-            "sell_date": "",
-            "net_profit": ""
-        }
-        rows.append(new)
-        write_rows(rows)
-
-    kb = InlineKeyboardMarkup(row_width=4)
-    kb.add(
-        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-    )
-    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
-    kb.add(
-    InlineKeyboardButton("Отметить опубликованным",
-                         callback_data=f"posted:{nid}:{alias}"),
-    InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-    )
-
-    draft_text = (
-        f"🆕 Новый лот (ID {nid})\n"
-        f"Игра: {parsed['game']}\n"
-        f"Описание: {parsed['account_desc']}\n"
-        f"Куплено за: {float(parsed['buy_price']):.2f}$\n\n"
-        "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-    )
-    await message.answer(draft_text, reply_markup=kb)
-
-
-@dp.message_handler(commands=["generate_listing"])
-async def cmd_generate_listing(message: types.Message):
-    args = message.get_args().split()
-    if len(args) < 2:
-        await message.answer("Использование: /generate_listing <id> <target_net>")
-        return
-
-    nid, target = args[0], args[1]
-    try:
-        target_f = float(target)
-    except Exception:
-        await message.answer("Неверный целевой профит.")
-        return
-
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == nid), None)
-    if not row:
-        await message.answer("ID не найден.")
-        return
-
-    min_sale = apply_psychological_ending(
-        calc_min_sale(float(row["buy_price"]), target_net=target_f)
-    )
-    desc_default = auto_desc_for_game(row["game"], row.get("account_desc", ""))
-    txt = compose_listing(row, nid, target_f, min_sale, desc_default)
-    await message.answer(txt)
-   
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("profit:"))
-async def cb_profit(call: types.CallbackQuery):
-    _, nid, profit = call.data.split(":", 2)
-
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        await call.answer("Лот не найден.", show_alert=True)
-        return
-
-    # Если пользователь выбрал Custom — просто просим ввести число профита
-    if profit == "custom":
-        USER_STATE[call.from_user.id] = {"mode": "await_profit_value", "nid": nid}
-        await call.message.answer("Введите желаемый профит числом, например: 1.5")
-        await call.answer()
-        return
-
-    # Фиксированные варианты (0.5 / 1 / 2)
-    try:
-        target = float(profit)
-    except Exception:
-        target = 1.0
-
-    min_sale = apply_psychological_ending(
-        calc_min_sale(float(row["buy_price"]), target_net=target)
-    )
-    row["min_sale_for_target"] = f"{min_sale:.2f}"
-    write_rows(rows)
-
-    # Текст описания теперь всегда = название игры (alias подставится в compose_listing)
-    desc = auto_desc_for_game(row["game"], row.get("account_desc", ""))
-    save_description_for_game(row["game"], desc)
-    listing_text = compose_listing(row, nid, target, min_sale, desc)
-
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
+    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
     kb.add(
     InlineKeyboardButton("Отметить опубликованным",
                          callback_data=f"posted:{nid}:{(row.get('alias') or '').lower()}"),
     InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-)
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
-
-    await call.message.answer(listing_text, reply_markup=kb)
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("posted:"))
-async def cb_posted(call: types.CallbackQuery):
-    parts = call.data.split(":")
-    # варианты: ["posted", nid] (старые кнопки) или ["posted", nid, alias] (новые)
-    if len(parts) == 3:
-        _, nid, alias = parts
-        alias = (alias or "").lower().strip()
-    else:
-        _, nid = parts
-        alias = None
+)
+    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
 
-    nid = str(nid).strip()
+    await call.message.answer(listing_text, reply_markup=kb)
+    await call.answer()
 
-    async with FILE_LOCK:
-        rows = read_rows()
+@ROUTER.callback("posted")
+async def cb_posted(call: types.CallbackQuery, nid, alias=None):
+    # варианты: posted:nid (старые кнопки) или posted:nid:alias (новые)
+    alias = (alias or "").lower().strip()
+    nid = str(nid).strip()
 
+    row = await run_db(get_lot, nid)
+    # Жёстко по паре id+alias (для старых сообщений без alias — только по id)
+    if row and alias and (row.get("alias") or "").lower() != alias:
         row = None
-        if alias:
-            # Жёстко по паре id+alias
-            for r in rows:
-                if r.get("id") == nid and (r.get("alias") or "").lower() == alias:
-                    row = r
-                    break
-        else:
-            # Фолбэк для старых сообщений без alias
-            row = next((r for r in rows if r.get("id") == nid), None)
 
-        if not row:
-            await call.answer("Лот не найден.", show_alert=True)
-            return
+    if not row:
+        await call.answer("Лот не найден.", show_alert=True)
+        return
 
-        row["status"] = "listed"
-        write_rows(rows)
+    await run_db(update_lot, nid, status="listed")
 
     await call.message.answer(f"✅ Лот {nid} помечен как опубликованный (alias: {(row.get('alias') or '').lower()}).")
-    await call.answer()
-
-    
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("editdesc:"))
-async def cb_editdesc(call: types.CallbackQuery):
-    _, nid = call.data.split(":", 1)
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        await call.answer("Лот не найден.", show_alert=True)
-        return
-
-    saved = get_description_for_game(row["game"])
-    hint = f'\n(текущий шаблон: {saved})' if saved else ""
-    USER_STATE[call.from_user.id] = {"mode": "edit_desc", "nid": nid}
-    await call.message.answer(f'Введите новый текст для описания лота для «{row["game"]}».{hint}')
-    await call.answer()
-
-        
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("wipe:"))
-async def cb_wipe(call: types.CallbackQuery):
-    if call.data == "wipe:yes":
-        async with FILE_LOCK:
-            reset_csv()
-        await call.message.answer("✅ Готово. База очищена (inventory.csv перезаписан заголовком).")
-    else:
-        await call.message.answer("Отменено.")
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("sold_direct:"))
-async def cb_sold_direct(call: types.CallbackQuery):
-    _, nid = call.data.split(":", 1)
-    await call.message.answer(f"Чтобы отметить лот {nid} как проданный, отправь: /sold {nid}|<цена_продажи>\nПример: /sold {nid}|10")
-    await call.answer()
-    
-
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("restored:"))
-async def cb_restored(call: types.CallbackQuery):
-    _, nid = call.data.split(":", 1)
-
-    async with FILE_LOCK:
-        rows = read_rows()
-        row = next((r for r in rows if r["id"] == str(nid)), None)
-        if not row:
-            await call.answer("Лот не найден.", show_alert=True)
-            return
-
-        if row["status"] == "sold":
-            await call.answer("Этот лот уже отмечен как проданный.", show_alert=True)
-            return
-        if row["status"] == "restored":
-            await call.answer("Этот лот уже отмечен как восстановленный.", show_alert=True)
-            return
-
-        loss = float(row["buy_price"])
-        row["status"] = "restored"
-        row["sell_price"] = ""
-        row["sell_date"] = datetime.utcnow().isoformat()
-        # фиксируем убыток отрицательным нетто, чтобы можно было считать итоги
-        row["net_profit"] = f"{-loss:.2f}"
-        write_rows(rows)
-
-    await call.message.answer(f"Лот {nid} помечен как восстановленный.\nПотеря: {loss:.2f}$")
-    await call.answer()
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("edit_desc:"))
-async def cb_edit_desc(call: types.CallbackQuery):
-    _, nid, target = call.data.split(":", 2)
-    USER_STATE[call.from_user.id] = {"mode": "edit_desc", "nid": nid, "target": float(target)}
-    await call.message.answer("Введите новый текст описания лота.")
-    await call.answer()
-
-
-# Пришёл новый текст — пересобираем листинг с тем же профитом
-@dp.message_handler(lambda m: USER_STATE.get(m.from_user.id, {}).get("mode") == "edit_desc")
-async def handle_edit_desc(message: types.Message):
-    st = USER_STATE.get(message.from_user.id)
-    if not st:
-        return
-    nid = st["nid"]
-    target = st["target"]
-    desc = (message.text or "").strip()
-    if not desc:
-        await message.answer("Опишите лот текстом, пожалуйста.")
-        return
-
-    rows = read_rows()
-    row = next((r for r in rows if r["id"] == str(nid)), None)
-    if not row:
-        USER_STATE.pop(message.from_user.id, None)
-        await message.answer("Лот не найден.")
-        return
-
-    min_sale = apply_psychological_ending(
-    calc_min_sale(float(row["buy_price"]), target_net=target)
-    )
-    GAME_DEFAULT_DESC[row["game"]] = desc
-
-    listing_text = compose_listing(row, nid, target, min_sale, desc)
-
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
+    await call.answer()
+
+    
+@ROUTER.callback("editdesc")
+async def cb_editdesc(call: types.CallbackQuery, nid):
+    row = await run_db(get_lot, nid)
+    if not row:
+        await call.answer("Лот не найден.", show_alert=True)
+        return
+
+    saved = get_description_for_game(row["game"])
+    hint = f'\n(текущий шаблон: {saved})' if saved else ""
+    await USER_STATE.set(call.from_user.id, {"mode": "edit_desc", "nid": nid, "target": DEFAULT_TARGET_NET})
+    await call.message.answer(f'Введите новый текст для описания лота для «{row["game"]}».{hint}')
+    await call.answer()
+
+        
+@ROUTER.callback("wipe")
+async def cb_wipe(call: types.CallbackQuery, answer=""):
+    if answer == "yes":
+        async with FILE_LOCK:
+            await run_db(reset_csv)
+            for hook in AFTER_WIPE_HOOKS:
+                result = hook()
+                if asyncio.iscoroutine(result):
+                    await result
+        await call.message.answer("✅ Готово. База очищена.")
+    else:
+        await call.message.answer("Отменено.")
+    await call.answer()
+
+@ROUTER.callback("sold_direct")
+async def cb_sold_direct(call: types.CallbackQuery, nid):
+    await call.message.answer(f"Чтобы отметить лот {nid} как проданный, отправь: /sold {nid}|<цена_продажи>\nПример: /sold {nid}|10")
+    await call.answer()
+    
+
+
+@ROUTER.callback("restored")
+async def cb_restored(call: types.CallbackQuery, nid):
+    row = await run_db(get_lot, nid)
+    if not row:
+        await call.answer("Лот не найден.", show_alert=True)
+        return
+
+    if row["status"] == "sold":
+        await call.answer("Этот лот уже отмечен как проданный.", show_alert=True)
+        return
+    if row["status"] == "restored":
+        await call.answer("Этот лот уже отмечен как восстановленный.", show_alert=True)
+        return
+
+    loss = float(row["buy_price"])
+    await run_db(
+        update_lot,
+        nid,
+        status="restored",
+        sell_price="",
+        sell_date=datetime.utcnow().isoformat(),
+        # фиксируем убыток отрицательным нетто, чтобы можно было считать итоги
+        net_profit=f"{-loss:.2f}",
+    )
+
+    await call.message.answer(f"Лот {nid} помечен как восстановленный.\nПотеря: {loss:.2f}$")
+    await call.answer()
+@ROUTER.callback("edit_desc")
+async def cb_edit_desc(call: types.CallbackQuery, nid, target):
+    await USER_STATE.set(call.from_user.id, {"mode": "edit_desc", "nid": nid, "target": float(target)})
+    await call.message.answer("Введите новый текст описания лота.")
+    await call.answer()
+
+
+# Пришёл новый текст — пересобираем листинг с тем же профитом
+@ROUTER.state("edit_desc")
+async def handle_edit_desc(message: types.Message, st):
+    nid = st["nid"]
+    target = st.get("target", DEFAULT_TARGET_NET)
+    desc = (message.text or "").strip()
+    if not desc:
+        await message.answer("Опишите лот текстом, пожалуйста.")
+        return
+
+    row = await run_db(get_lot, nid)
+    if not row:
+        await USER_STATE.pop(message.from_user.id)
+        await message.answer("Лот не найден.")
+        return
+
+    min_sale = min_sale_for_lot(row, target)
+    GAME_DEFAULT_DESC[row["game"]] = desc
+
+    listing_text = compose_listing(row, nid, target, min_sale, desc)
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("Изменить текст", callback_data=f"edit_desc:{nid}:{target}"))
     kb.add(
     InlineKeyboardButton("Отметить опубликованным",
                          callback_data=f"posted:{nid}:{(row.get('alias') or '').lower()}"),
     InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-)
-    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
-    
-    await message.answer(listing_text, reply_markup=kb)
-    USER_STATE.pop(message.from_user.id, None)
-
-@dp.message_handler(commands=["mark_published"])
-async def cmd_mark_published(message: types.Message):
-    nid = message.get_args().strip()
-    if not nid:
-        await message.answer("Использование: /mark_published <id>")
-        return
-
-    async with FILE_LOCK:
-        rows = read_rows()
-        row = next((r for r in rows if r["id"] == nid), None)
-        if not row:
-            await message.answer("ID не найден.")
-            return
-        row["status"] = "listed"
-        write_rows(rows)
-
-    await message.answer(f"ID {nid} помечен как опубликованный.")
-
-
-@dp.message_handler(commands=["sold"])
-async def cmd_sold(message: types.Message):
-    args = message.get_args()
-    if not args or "|" not in args:
-        await message.answer("Использование: /sold <id>|<price>\nПример: /sold 3|10")
-        return
-    nid, price = [p.strip() for p in args.split("|", 1)]
-    try:
-        price_f = float(to_decimal(price))
-    except:
-        await message.answer("Неверная цена.")
-        return
-
-    async with FILE_LOCK:
-        rows = read_rows()
-        row = next((r for r in rows if r["id"] == nid), None)
-        if not row:
-            await message.answer("ID не найден.")
-            return
-        net = calc_net_from_sale(price_f, float(row["buy_price"]))
-        row["status"] = "sold"
-        row["sell_price"] = f"{price_f:.2f}"
-        row["sell_date"] = datetime.utcnow().isoformat()
-        row["net_profit"] = f"{net:.2f}"
-        write_rows(rows)
-
-    await message.answer(f"ID {nid} отмечен как проданный. Чистая прибыль: {net:.2f}$")
-
-
-@dp.message_handler(commands=["stats"])
-async def cmd_stats(message: types.Message):
-    rows = read_rows()
+)
+    kb.add(InlineKeyboardButton("Восстановлен", callback_data=f"restored:{nid}"))
+    
+    await message.answer(listing_text, reply_markup=kb)
+    await USER_STATE.pop(message.from_user.id)
+
+@dp.message_handler(commands=["mark_published"])
+async def cmd_mark_published(message: types.Message):
+    nid = message.get_args().strip()
+    if not nid:
+        await message.answer("Использование: /mark_published <id>")
+        return
+
+    if not await run_db(update_lot, nid, status="listed"):
+        await message.answer("ID не найден.")
+        return
+
+    await message.answer(f"ID {nid} помечен как опубликованный.")
+
+
+@dp.message_handler(commands=["sold"])
+async def cmd_sold(message: types.Message):
+    args = message.get_args()
+    if not args or "|" not in args:
+        await message.answer("Использование: /sold <id>|<price>\nПример: /sold 3|10")
+        return
+    nid, price = [p.strip() for p in args.split("|", 1)]
+    try:
+        price_f = float(to_decimal(price))
+    except:
+        await message.answer("Неверная цена.")
+        return
+
+    row = await run_db(get_lot, nid)
+    if not row:
+        await message.answer("ID не найден.")
+        return
+    rule = lot_pricing_rule(row)
+    net = calc_net_from_sale(price_f, float(row["buy_price"]), rule=rule)
+    await run_db(
+        update_lot,
+        nid,
+        status="sold",
+        commission=f"{rule.commission_bp / pricing.BP:.4f}",
+        sell_price=f"{price_f:.2f}",
+        sell_date=datetime.utcnow().isoformat(),
+        net_profit=f"{net:.2f}",
+    )
+
+    await message.answer(f"ID {nid} отмечен как проданный. Чистая прибыль: {net:.2f}$")
+
 
-    bought_count = len(rows)
-    total_spent = sum(float(r["buy_price"]) for r in rows if r.get("buy_price"))
+REPRICE_PREVIEW_LINES = 15
 
-    sold = [r for r in rows if r.get("status") == "sold" and r.get("net_profit")]
-    sold_count = len(sold)
-    total_profit = sum(float(r["net_profit"]) for r in sold) if sold else 0.0  # ← Прибыль с проданных
 
-    restored = [r for r in rows if r.get("status") == "restored"]
-    restored_count = len(restored)
-    total_losses = sum(float(r["buy_price"]) for r in restored)  # Потери = цена покупки восстановленных
+def _fmt_cents(cents):
+    return "—" if cents is None else f"{pricing.from_cents(cents):.2f}$"
+
+
+@dp.message_handler(commands=["reprice"])
+async def cmd_reprice(message: types.Message):
+    parts = message.get_args().split()
+    if not parts or len(parts) > 2:
+        await message.answer(
+            "Использование: /reprice <target_net> [статус]\n"
+            f"По умолчанию — все непроданные ({', '.join(REPRICE_STATUSES)})."
+        )
+        return
+    try:
+        target = float(to_decimal(parts[0]))
+    except Exception:
+        await message.answer("Неверный формат профита.")
+        return
+    status = parts[1].lower() if len(parts) > 1 else ""
+    if status and status not in LIST_STATUSES:
+        # статус уходит в callback_data (лимит 64 байта) — только известные
+        await message.answer(f"Неизвестный статус. Статусы: {', '.join(LIST_STATUSES)}.")
+        return
+
+    changes = await run_db(reprice_lots, target, status or None)
+    scope = status or ", ".join(REPRICE_STATUSES)
+    if not changes:
+        await message.answer(f"Для профита {target:.2f}$ ({scope}) все цены уже актуальны.")
+        return
+
+    lines = [f"Пересчёт мин. цен под профит {target:.2f}$ ({scope}): изменится {len(changes)} шт."]
+    for nid, old, new in changes[:REPRICE_PREVIEW_LINES]:
+        lines.append(f"ID {nid}: {_fmt_cents(old)} → {_fmt_cents(new)}")
+    if len(changes) > REPRICE_PREVIEW_LINES:
+        lines.append(f"… и ещё {len(changes) - REPRICE_PREVIEW_LINES}")
+
+    kb = InlineKeyboardMarkup()
+    kb.add(
+        InlineKeyboardButton("Применить", callback_data=f"reprice:{target}:{status}"),
+        InlineKeyboardButton("Отмена", callback_data="reprice:cancel"),
+    )
+    await message.answer("\n".join(lines), reply_markup=kb)
+
+
+@ROUTER.callback("reprice")
+async def cb_reprice(call: types.CallbackQuery, target, status=""):
+    if target == "cancel":
+        await call.message.answer("Отменено.")
+        await call.answer()
+        return
+    if status and status not in LIST_STATUSES:
+        await call.answer("Кнопка устарела.", show_alert=True)
+        return
+    # пересчёт заново под блокировкой строк: лоты могли измениться после превью
+    changes = await run_db(reprice_lots, float(target), status or None, apply=True)
+    await call.message.answer(f"✅ Обновлено цен: {len(changes)}.")
+    await call.answer()
+
+
+FIND_PAGE_SIZE = int(os.getenv("FIND_PAGE_SIZE", "10"))
+
+
+# запрос целиком не влезает в callback_data (64 байта) — кнопки листания несут короткий токен
+FIND_QUERIES = _state_store("find_query")     # token -> запрос
+
+
+def find_token(query):
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+
+
+async def send_find_page(message, query, after=None, before=None, edit=False):
+    # +1 строка — узнать, есть ли страница дальше в направлении запроса (как в /list)
+    rows = await run_db(find_lots, query, limit=FIND_PAGE_SIZE + 1, after=after, before=before)
+    more = len(rows) > FIND_PAGE_SIZE
+    if before is not None:
+        rows = rows[-FIND_PAGE_SIZE:]
+        has_prev, has_next = more, True
+    else:
+        rows = rows[:FIND_PAGE_SIZE]
+        has_prev, has_next = after is not None, more
+    if not rows:
+        text = f"По запросу «{query}» ничего не найдено."
+        await (message.edit_text(text) if edit else message.answer(text))
+        return
+
+    token = find_token(query)
+    kb = InlineKeyboardMarkup(row_width=2)
+    for r in rows:
+        alias = (r.get("alias") or "").lower()
+        title = f'ID {r["id"]} — {(alias + " | ") if alias else ""}{r["game"]} ({r["status"]})'
+        kb.row(InlineKeyboardButton(title, callback_data=f"open:{r['id']}"))
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"find:<:{rows[0]['_cursor']}:{token}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"find:>:{rows[-1]['_cursor']}:{token}"))
+    if nav:
+        kb.row(*nav)
+
+    text = f"Поиск «{query}»:"
+    await (message.edit_text(text, reply_markup=kb) if edit else message.answer(text, reply_markup=kb))
+
+
+@dp.message_handler(commands=["find"])
+async def cmd_find(message: types.Message):
+    query = " ".join(message.get_args().split())
+    if len(query) < FIND_MIN_QUERY and not query.isdigit():
+        await message.answer(
+            "Использование: /find <запрос> — игра, алиас, описание или заметка "
+            f"(от {FIND_MIN_QUERY} символов) или id лота."
+        )
+        return
+    await FIND_QUERIES.set(find_token(query), query)
+    await send_find_page(message, query)
+
+
+@ROUTER.callback("find")
+async def cb_find(call: types.CallbackQuery, direction, cursor, token):
+    query = await FIND_QUERIES.get(token)
+    if not query or direction not in ("<", ">"):
+        await call.answer("Поиск устарел, повтори /find.", show_alert=True)
+        return
+    if direction == "<":
+        await send_find_page(call.message, query, before=cursor, edit=True)
+    else:
+        await send_find_page(call.message, query, after=cursor, edit=True)
+    await call.answer()
+
+
+@dp.message_handler(commands=["stats"])
+async def cmd_stats(message: types.Message):
+    st = await run_db(inventory_stats)
+
+    bought_count = st["bought_count"]
+    total_spent = st["total_spent"]
+    sold_count = st["sold_count"]
+    total_profit = st["total_profit"]          # ← Прибыль с проданных
+    total_commission = st["total_commission"]  # комиссия площадок, по ставке каждого лота
+    restored_count = st["restored_count"]
+    total_losses = st["total_losses"]          # Потери = цена покупки восстановленных
 
     # Итоговый результат = прибыль с продаж - потери от восстановленных
     real_result = total_profit - total_losses
@@ -1022,141 +1484,116 @@ async def cmd_stats(message: types.Message):
         f"Восстановлено: {restored_count}\n"
         f"Потрачено всего: {total_spent:.2f}$\n"
         f"Прибыль (проданное): {total_profit:.2f}$\n"          # ← ВОТ ЭТА СТРОКА
+        f"Комиссия площадок: {total_commission:.2f}$\n"
         f"Потери (восстановленные): {total_losses:.2f}$\n"
         f"ИТОГ (прибыль - потери): {real_result:.2f}$\n"
     )
-    await message.answer(text)
-@dp.message_handler(commands=["reset_stats"])
-async def cmd_reset_stats(message: types.Message):
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton("Да, удалить ВСЁ", callback_data="wipe:yes"),
-        InlineKeyboardButton("Отмена", callback_data="wipe:no"),
-    )
-    await message.answer(
-        "⚠️ Подтвердите очистку базы.\n"
-        "Будут удалены ВСЕ записи (инвентарь и статистика) без возможности восстановления.",
-        reply_markup=kb
-    )
-
-@dp.message_handler(commands=["monthly"])
-async def cmd_monthly(message: types.Message):
-    arg = message.get_args().strip()
-    if not arg:
-        await message.answer("Использование: /monthly YYYY-MM")
-        return
-    try:
-        year, month = arg.split("-", 1)
-        year = int(year); month = int(month)
-    except:
-        await message.answer("Неверный формат. Пример: /monthly 2025-10")
-        return
-
-    rows = read_rows()
-
-    bought = [r for r in rows if r.get("buy_date") and r["buy_date"].startswith(f"{year:04d}-{month:02d}")]
-    sold = [r for r in rows if r.get("sell_date") and r["sell_date"].startswith(f"{year:04d}-{month:02d}") and r["status"] == "sold"]
-    restored = [r for r in rows if r.get("sell_date") and r["sell_date"].startswith(f"{year:04d}-{month:02d}") and r["status"] == "restored"]
-
-    total_spent = sum(float(r["buy_price"]) for r in bought if r.get("buy_price"))
-    total_net_sales = sum(float(r["net_profit"]) for r in sold if r.get("net_profit"))
-    total_losses = sum(float(r["buy_price"]) for r in restored if r.get("buy_price"))
-
-    real_result = total_net_sales - total_losses
-
-    res = (
-        f"Месяц {year}-{month:02d}:\n"
-        f"Куплено: {len(bought)} шт., потрачено: {total_spent:.2f}$\n"
-        f"Продано: {len(sold)} шт., чистая прибыль: {total_net_sales:.2f}$\n"
-        f"Восстановлено: {len(restored)} шт., потери: {total_losses:.2f}$\n"
-        f"ИТОГ (прибыль - потери): {real_result:.2f}$\n"
-    )
-    await message.answer(res)
-
-@dp.message_handler(commands=["export"])
-async def cmd_export(message: types.Message):
-    if not os.path.exists(DATA_CSV):
-        await message.answer("Файл не найден.")
-        return
-    await message.answer_document(open(DATA_CSV, "rb"))
-
-# ВАЖНО: никаких executor.start_polling здесь нет!
-# dp и bot импортирует app.py (Flask) и гоняет webhook.
-# === helper: создать лот и отправить сообщение "Новый лот" с кнопками ===
-async def create_lot_and_prompt(parsed: dict, chat_id: int):
-    """
-    parsed = {"game": str, "account_desc": str, "buy_price": float, "source_text": str}
-    chat_id = куда отправлять сообщение
-    """
-    async with FILE_LOCK:
-        rows = read_rows()
-        existing_aliases = {(r.get("alias") or "").lower() for r in rows if r.get("alias")}
-        alias = generate_unique_alias(existing_aliases)
-        nid = next_id(rows)
-        new = {
-            "id": str(nid),
-            "alias": alias,
-            "source_text": parsed.get("source_text", ""),
-            "game": parsed.get("game", ""),
-            "account_desc": parsed.get("account_desc", ""),
-            "buy_price": f"{float(parsed['buy_price']):.2f}",
-            "buy_date": datetime.utcnow().isoformat(),
-            "status": "in_stock",
-            "min_sale_for_target": "",
-            "notes": "",
-            "sell_price": "",
-            "sell_date": "",
-            "net_profit": ""
-        }
-        rows.append(new)
-        write_rows(rows)
-
-    kb = InlineKeyboardMarkup(row_width=4)
-    kb.add(
-        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
-        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
-        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
-    )
-    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
+    await message.answer(text)
+@dp.message_handler(commands=["reset_stats"])
+async def cmd_reset_stats(message: types.Message):
+    kb = InlineKeyboardMarkup()
     kb.add(
-    InlineKeyboardButton("Отметить опубликованным",
-                         callback_data=f"posted:{nid}:{alias}"),
-    InlineKeyboardButton("Отметить проданным", callback_data=f"sold_direct:{nid}")
-    )
-
-    draft_text = (
-        f"🆕 Новый лот (ID {nid})\n"
-        f"Игра: {parsed.get('game','')}\n"
-        f"Описание: {parsed.get('account_desc','')}\n"
-        f"Куплено за: {float(parsed['buy_price']):.2f}$\n\n"
-        "Выбери целевой профит, чтобы получить мин. цену продажи и шаблон."
-    )
-    await bot.send_message(chat_id, draft_text, reply_markup=kb)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        InlineKeyboardButton("Да, удалить ВСЁ", callback_data="wipe:yes"),
+        InlineKeyboardButton("Отмена", callback_data="wipe:no"),
+    )
+    await message.answer(
+        "⚠️ Подтвердите очистку базы.\n"
+        "Будут удалены ВСЕ записи (инвентарь и статистика) без возможности восстановления.",
+        reply_markup=kb
+    )
+
+@dp.message_handler(commands=["monthly"])
+async def cmd_monthly(message: types.Message):
+    arg = message.get_args().strip()
+    if not arg:
+        await message.answer("Использование: /monthly YYYY-MM")
+        return
+    try:
+        year, month = arg.split("-", 1)
+        year = int(year); month = int(month)
+    except:
+        await message.answer("Неверный формат. Пример: /monthly 2025-10")
+        return
+
+    try:
+        st = await run_db(month_stats, year, month)
+    except ValueError:
+        await message.answer("Неверный формат. Пример: /monthly 2025-10")
+        return
+
+    total_spent = st["total_spent"]
+    total_net_sales = st["total_net_sales"]
+    total_losses = st["total_losses"]
+
+    real_result = total_net_sales - total_losses
+
+    res = (
+        f"Месяц {year}-{month:02d}:\n"
+        f"Куплено: {st['bought_count']} шт., потрачено: {total_spent:.2f}$\n"
+        f"Продано: {st['sold_count']} шт., чистая прибыль: {total_net_sales:.2f}$\n"
+        f"Восстановлено: {st['restored_count']} шт., потери: {total_losses:.2f}$\n"
+        f"ИТОГ (прибыль - потери): {real_result:.2f}$\n"
+    )
+    await message.answer(res)
+
+EXPORT_USAGE = (
+    "Использование: /export [статус] [с YYYY-MM-DD] [по YYYY-MM-DD]\n"
+    "Даты — по дате покупки, «по» не включительно. Пример: /export sold 2025-10-01 2025-11-01"
+)
+
+
+@dp.message_handler(commands=["export"])
+async def cmd_export(message: types.Message):
+    status, dates = None, []
+    for arg in message.get_args().split():
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg):
+            dates.append(arg)
+        elif status is None and re.fullmatch(r"[a-z_]+", arg):
+            status = arg
+        else:
+            await message.answer(EXPORT_USAGE)
+            return
+    try:
+        if len(dates) > 2:
+            raise ValueError("too many dates")
+        bounds = [datetime.strptime(d, "%Y-%m-%d").replace(tzinfo=timezone.utc) for d in dates]
+    except ValueError:
+        await message.answer(EXPORT_USAGE)
+        return
+    since, until = (bounds + [None, None])[:2]
+
+    parts = await run_db(export_lots, status=status, since=since, until=until)
+    try:
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M")
+        for i, (path, rows) in enumerate(parts, 1):
+            suffix = f"-part{i}" if len(parts) > 1 else ""
+            caption = f"Часть {i}/{len(parts)}, строк: {rows}" if len(parts) > 1 else f"Строк: {rows}"
+            await message.answer_document(
+                types.InputFile(path, filename=f"inventory-{stamp}{suffix}.csv.gz"), caption=caption
+            )
+    finally:
+        for path, _ in parts:
+            os.unlink(path)
+
+
+# /list и карточка лота (open:) — одна регистрация, в list_open_feature
+setup_list_open_feature(
+    dp, ROUTER,
+    get_lot, list_lots, run_db,
+    get_description_for_game, auto_desc_for_game,
+    compose_listing, calc_net_from_sale, lot_pricing_rule,
+)
+# Диспетчер callback'ов и текста — после всех команд, чтобы /команды не уходили в диалог
+ROUTER.setup(dp, _dialog_state)
+
+# ВАЖНО: никаких executor.start_polling здесь нет!
+# dp и bot импортирует app.py (Flask) и гоняет webhook.
+# === helper: создать лот и отправить сообщение "Новый лот" с кнопками ===
+async def create_lot_and_prompt(parsed: dict, chat_id: int):
+    """
+    parsed = {"game": str, "account_desc": str, "buy_price": float, "source_text": str}
+    chat_id = куда отправлять сообщение
+    """
+    from ingest import ingest_and_notify   # ingest импортирует bot — поэтому здесь
+    lots = await ingest_and_notify([parsed], chat_id)
+    return lots[0]
@@ -0,0 +1,204 @@
+# db_pool.py
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(RuntimeError):
+    """Не дождались свободного соединения за wait_timeout секунд."""
+
+
+class ConnectionPool:
+    """
+    Пул соединений с Postgres на весь процесс (потокобезопасный).
+
+    - одновременно открыто не больше max_size соединений, остальные ждут;
+    - простаивающие сверх min_size закрываются через max_idle секунд;
+    - перед выдачей соединение проверяется (SELECT 1), если простаивало дольше check_after;
+    - битые соединения закрываются и открываются заново.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=5, wait_timeout=10.0,
+                 check_after=30.0, max_idle=300.0, **connect_kwargs):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError("bad pool size: min=%s max=%s" % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = []    # [(conn, время возврата в пул)] — берём с конца (LIFO)
+        self._size = 0     # всего открыто: свободные + выданные
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "connect_time": 0.0,
+            "health_checks": 0,
+            "recycled": 0,
+        }
+
+    # ---- открытие / проверка ----
+    def _connect(self):
+        started = time.monotonic()
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        elapsed = time.monotonic() - started
+        with self._cond:
+            self._stats["connects"] += 1
+            self._stats["connect_time"] += elapsed
+        return conn
+
+    def _alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_after:
+            return True
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reap_idle(self):
+        """Закрыть лишние (сверх min_size) соединения, простаивающие дольше max_idle. Под self._cond."""
+        now = time.monotonic()
+        keep, stale = [], []
+        for conn, ts in self._idle:
+            if len(keep) < self.min_size or now - ts < self.max_idle:
+                keep.append((conn, ts))
+            else:
+                stale.append(conn)
+        if stale:
+            self._idle = keep
+            self._size -= len(stale)
+        return stale
+
+    # ---- выдача / возврат ----
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.wait_timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"no free DB connection in {self.wait_timeout}s")
+                self._cond.wait(remaining)
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["wait_time"] += time.monotonic() - started
+
+        if conn is not None and not self._alive(conn, idle_since):
+            with self._cond:
+                self._stats["recycled"] += 1
+            self._close_quietly(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+        if broken or conn.closed:
+            self._close_quietly(conn)
+            with self._cond:
+                self._size -= 1
+                self._stats["recycled"] += 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            stale = self._reap_idle()
+            self._cond.notify()
+        for c in stale:
+            self._close_quietly(c)
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: ...
+        Успешный выход — commit, исключение — rollback;
+        при ошибке соединения (OperationalError/InterfaceError) соединение выбрасывается из пула.
+        """
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["size"] = self._size
+            s["idle"] = len(self._idle)
+            s["in_use"] = self._size - len(self._idle)
+            s["min_size"] = self.min_size
+            s["max_size"] = self.max_size
+        s["avg_connect_ms"] = round(s["connect_time"] / s["connects"] * 1000, 2) if s["connects"] else 0.0
+        s["avg_wait_ms"] = round(s["wait_time"] / s["waits"] * 1000, 2) if s["waits"] else 0.0
+        s["connect_time"] = round(s["connect_time"], 4)
+        s["wait_time"] = round(s["wait_time"], 4)
+        return s
@@ -0,0 +1,190 @@
+# desc_rules.py
+"""
+Правила автоописания лота по игре (auto_desc_for_game) из desc_rules.json.
+
+Правило: name, priority (больше — важнее; при равенстве — кто раньше в файле),
+aliases — подстроки без учёта регистра, patterns — регэкспы (необязательно),
+template — текст с {name} (название игры из лота без крайних пробелов) / {NAME} (капсом),
+default_name — что подставить в {name}, если игра пустая. "default" — шаблон, когда
+ничего не подошло.
+
+Все aliases — один KeywordMatcher, все patterns — один регэксп с группой на правило.
+Без кэша поиск всё равно растёт с числом правил (до DIRECT_MAX_KEYWORDS ключей — проверка
+каждого через `in`, дальше — альтернатива в одном регэкспе), поэтому результат (какое правило
+подошло) кэшируется по нормализованному тексту. Файл перечитывается, если сменился его
+mtime (проверка не чаще раза в ttl секунд); битый файл (не JSON, не та структура, ошибка
+в регэкспе) — остаются прежние правила.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+from keyword_matcher import KeywordMatcher
+from ttl_cache import TTLCache
+
+_NO_RULE = -1
+CACHE_TTL = 24 * 3600.0   # кэш и так сбрасывается при перезагрузке правил
+
+
+def _normalize(text):
+    return " ".join(text.split()).lower()
+
+
+class DescRule:
+    __slots__ = ("name", "priority", "template", "default_name")
+
+    def __init__(self, name, priority, template, default_name=""):
+        self.name = name
+        self.priority = priority
+        self.template = template
+        self.default_name = default_name
+
+
+def _check_strings(value, what):
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError(f"{what} must be a list of strings")
+
+
+def validate_config(config):
+    """Проверить структуру desc_rules.json; ValueError с понятным текстом, если что-то не так."""
+    if not isinstance(config, dict):
+        raise ValueError("config must be an object")
+    if not isinstance(config.get("default", ""), str):
+        raise ValueError("default must be a string")
+    rules = config.get("rules", [])
+    if not isinstance(rules, list):
+        raise ValueError("rules must be a list")
+    for i, r in enumerate(rules):
+        if not isinstance(r, dict):
+            raise ValueError(f"rules[{i}] must be an object")
+        where = f"rule {r.get('name', i)!r}"
+        if not isinstance(r.get("name", ""), str):
+            raise ValueError(f"{where}: name must be a string")
+        priority = r.get("priority", 0)
+        if isinstance(priority, bool) or not isinstance(priority, int):
+            raise ValueError(f"{where}: priority must be an integer")
+        if not isinstance(r.get("template"), str) or not r["template"]:
+            raise ValueError(f"{where}: template is required")
+        if not isinstance(r.get("default_name", ""), str):
+            raise ValueError(f"{where}: default_name must be a string")
+        _check_strings(r.get("aliases", []), f"{where}: aliases")
+        _check_strings(r.get("patterns", []), f"{where}: patterns")
+
+
+def render(template, game, default_name=""):
+    name = (game or default_name).strip()
+    return template.replace("{name}", name).replace("{NAME}", name.upper())
+
+
+class CompiledRules:
+    """Правила, отсортированные по важности, и их общий матчер."""
+
+    def __init__(self, config):
+        validate_config(config)
+        items = [
+            (-int(r.get("priority", 0)), i, r) for i, r in enumerate(config.get("rules", []))
+        ]
+        items.sort(key=lambda x: x[:2])
+        self.default = config.get("default", "{NAME}")
+        self.rules = []
+        self._alias_rank = {}          # alias -> лучший (меньший) ранг правила
+        group_patterns = []
+        for rank, (_, _, r) in enumerate(items):
+            self.rules.append(DescRule(
+                r.get("name") or f"rule{rank}", -items[rank][0], r["template"], r.get("default_name", "")
+            ))
+            for alias in r.get("aliases", []):
+                alias = _normalize(alias)
+                if alias:
+                    self._alias_rank.setdefault(alias, rank)
+            for pattern in r.get("patterns", []):
+                re.compile(pattern)     # ошибка в правиле — с понятным текстом, до сборки общего
+                group_patterns.append(f"(?P<r{rank}_{len(group_patterns)}>{pattern})")
+        self._matcher = KeywordMatcher(self._alias_rank)
+        # lookahead на каждой позиции: из подходящих там паттернов берётся самый важный
+        self._pattern = (
+            re.compile("(?=" + "|".join(group_patterns) + ")", re.IGNORECASE)
+            if group_patterns else None
+        )
+
+    def match(self, text):
+        """Ранг самого важного подходящего правила или _NO_RULE. text — нормализован."""
+        best = _NO_RULE
+        for alias in self._matcher.find(text, lowered=True):
+            rank = self._alias_rank[alias]
+            if best == _NO_RULE or rank < best:
+                best = rank
+        if self._pattern is not None:
+            for m in self._pattern.finditer(text):
+                rank = int(m.lastgroup[1:].split("_", 1)[0])
+                if best == _NO_RULE or rank < best:
+                    best = rank
+        return best
+
+
+class DescriptionRules:
+    def __init__(self, path, ttl=10.0, cache_size=2000):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._compiled = CompiledRules({})
+        self._cache = TTLCache(maxsize=cache_size, ttl=CACHE_TTL)
+        self._mtime = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.reload(force=True)
+
+    def reload(self, force=False):
+        """Перечитать файл, если изменился. True — если правила заменены."""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if not force and mtime == self._mtime:
+                return False
+            self._mtime = mtime
+            if mtime is None:
+                compiled = CompiledRules({})
+            else:
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        compiled = CompiledRules(json.load(f))
+                except Exception as e:
+                    # любая ошибка разбора/сборки — правила не подменяем, describe() не падает
+                    print(f">>> ERROR loading {self.path}, keeping previous rules:", repr(e))
+                    return False
+            self._compiled = compiled
+            self._cache = TTLCache(maxsize=self.cache_size, ttl=CACHE_TTL)
+            self.reloads += 1
+            return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.ttl:
+            self._checked_at = now
+            self.reload()
+
+    def describe(self, game, account_desc=""):
+        self._maybe_reload()
+        compiled, cache = self._compiled, self._cache
+        key = _normalize(f"{game or ''} {account_desc or ''}")
+        rank = cache.get(key)
+        if rank is None:
+            rank = compiled.match(key)
+            cache.set(key, rank)
+        if rank == _NO_RULE:
+            return render(compiled.default, game)
+        rule = compiled.rules[rank]
+        return render(rule.template, game, rule.default_name)
+
+    def stats(self):
+        return dict(
+            self._cache.stats(),
+            rules=len(self._compiled.rules),
+            reloads=self.reloads,
+            path=self.path,
+        )
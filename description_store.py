@@ -0,0 +1,104 @@
+# description_store.py
+"""
+Память описаний по игре: таблица game_descriptions + словарь в памяти процесса.
+
+Чтение — из словаря (без I/O). Запись — всегда в БД (UPSERT сам пропускает неизменённое
+описание, словарь мог устареть), затем в словарь (write-through). Изменения из других
+воркеров подхватываются при refresh(): раз в ttl секунд сверяется (число строк,
+max(updated_at)), и только при расхождении таблица перечитывается целиком — она маленькая
+(строка на игру). Запись и перечитывание идут под одним замком, чтобы перечитанная до
+записи таблица не затёрла в словаре только что сохранённое описание.
+"""
+import re
+import threading
+import time
+
+
+def game_key(name):
+    return re.sub(r"\s+", " ", (name or "").strip().lower())
+
+
+class DescriptionStore:
+    def __init__(self, get_conn, run_db, ttl=30.0):
+        self.get_conn = get_conn
+        self.run_db = run_db
+        self.ttl = ttl
+        self._cache = {}            # game_key -> description
+        self._signature = None      # (кол-во строк, max(updated_at)) загруженной версии
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()   # _save и load_if_changed (оба — в потоках БД)
+        self._hits = self._writes = self._skipped = self._reloads = 0
+
+    # ---- чтение ----
+    def get(self, game):
+        value = self._cache.get(game_key(game))
+        if value is not None:
+            self._hits += 1
+        return value
+
+    # ---- запись ----
+    def _save(self, key, description):
+        """UPSERT и обновление словаря под замком. True — если строка в БД изменилась."""
+        with self._lock:
+            with self.get_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    "INSERT INTO game_descriptions (game_key, description, updated_at) "
+                    "VALUES (%s, %s, now()) "
+                    "ON CONFLICT (game_key) DO UPDATE "
+                    "SET description = EXCLUDED.description, updated_at = EXCLUDED.updated_at "
+                    "WHERE game_descriptions.description IS DISTINCT FROM EXCLUDED.description",
+                    (key, description),
+                )
+                changed = cur.rowcount > 0
+                cur.close()
+            self._cache[key] = description
+        return changed
+
+    async def save(self, game, description):
+        """Запомнить описание для игры. False — если в БД уже такое же (записи не было)."""
+        changed = await self.run_db(self._save, game_key(game), description)
+        if changed:
+            self._writes += 1
+        else:
+            self._skipped += 1
+        return changed
+
+    # ---- синхронизация с таблицей ----
+    def load_if_changed(self, force=False):
+        """Перечитать таблицу, если она изменилась. True — если перечитали."""
+        with self._lock:
+            with self.get_conn() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT count(*), max(updated_at) FROM game_descriptions")
+                signature = tuple(cur.fetchone())
+                if not force and signature == self._signature:
+                    cur.close()
+                    return False
+                cur.execute("SELECT game_key, description FROM game_descriptions")
+                rows = cur.fetchall()
+                cur.close()
+            self._cache = dict(rows)
+            self._signature = signature
+            self._reloads += 1
+        return True
+
+    async def refresh(self):
+        """Проверить таблицу не чаще раза в ttl секунд."""
+        now = time.monotonic()
+        if now - self._checked_at < self.ttl:
+            return
+        self._checked_at = now
+        try:
+            await self.run_db(self.load_if_changed)
+        except Exception as e:
+            print(">>> ERROR reloading game descriptions:", e)
+
+    def stats(self):
+        return {
+            "size": len(self._cache),
+            "hits": self._hits,
+            "writes": self._writes,
+            "skipped_writes": self._skipped,
+            "reloads": self._reloads,
+        }
@@ -0,0 +1,335 @@
+# ingest.py
+"""
+Единый конвейер приёма покупок: /llz_hook, /lolz/notify(/batch), /lolz/email,
+/debug/push_buy_get, /poll и пересланные в бота уведомления.
+
+покупки -> один INSERT пачкой (id и алиасы выдаёт БД) -> сообщения «🆕 Новый лот» админу
+(при всплесках — дайджестом, см. NewLotNotifier).
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+from aiogram import types
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from bot import (
+    bot, ROUTER, AFTER_WIPE_HOOKS, STATE_BACKEND, STATE_MAX_ENTRIES,
+    get_conn, insert_lots, get_lot, list_lots, run_db, to_decimal,
+)
+from state_store import make_state_store
+from ttl_cache import TTLCache
+
+MAX_BATCH = 200
+# площадка покупок без явного "marketplace": все каналы приёма здесь — автобай LZT
+# (уведомления «по вашей ссылке … куплен аккаунт», /lolz/*, /llz_hook); по ней ищутся pricing_rules
+INTAKE_MARKETPLACE = os.getenv("INTAKE_MARKETPLACE", "lolz")
+
+# Idempotency-Key / id заказа -> лот: повторы в пределах часа отвечаются без похода в БД
+# (отпечатки по содержимому не кэшируются — по ним лоты не отсеиваются)
+FINGERPRINTS = TTLCache(
+    int(os.getenv("INTAKE_FINGERPRINT_CACHE", "5000")),
+    float(os.getenv("INTAKE_FINGERPRINT_TTL", "3600")),
+)
+AFTER_WIPE_HOOKS.append(FINGERPRINTS.clear)    # после /reset_stats id из кэша указывали бы на удалённые лоты
+
+
+def parse_price(value):
+    """'3,5' / 3.5 / '$ 3.50' -> 3.5; None, если это не число."""
+    if value is None:
+        return None
+    try:
+        return float(to_decimal(str(value).replace("$", "")))
+    except Exception:
+        return None
+
+
+def purchase_from_payload(data: dict, source_text=None):
+    """
+    JSON вида {"game"|"title", "account_desc"|"description"|"desc", "price"|"amount"|"buy_price",
+    "marketplace"?, "order_id"|"purchase_id"|"item_id"?} -> покупка для ingest_purchases.
+    ValueError, если нет игры или цены.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("item must be an object")
+    game = str(data.get("game") or data.get("title") or "").strip()
+    account_desc = str(
+        data.get("account_desc") or data.get("description") or data.get("desc") or ""
+    ).strip()
+    price_raw = data.get("price")
+    if price_raw is None:
+        price_raw = data.get("amount") if data.get("amount") is not None else data.get("buy_price")
+    if not game or price_raw is None:
+        raise ValueError("missing game or price")
+    price = parse_price(price_raw)
+    if price is None:
+        raise ValueError("bad price")
+    return {
+        "game": game,
+        "account_desc": account_desc,
+        "buy_price": price,
+        "source_text": source_text if source_text is not None else "lolz:webhook",
+        "marketplace": str(data.get("marketplace") or "").strip(),
+        "order_id": str(
+            data.get("order_id") or data.get("purchase_id") or data.get("item_id") or ""
+        ).strip(),
+    }
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def purchase_fingerprint(purchase, idempotency_key=None, content=None):
+    """
+    Отпечаток покупки. Навсегда уникальны (is_idempotency_key) только явные: Idempotency-Key
+    или id заказа у площадки (order_id). Иначе — отпечаток по содержимому: content, если
+    передан, или sha256 от source_text (пробелы нормализуются); по нему лоты не отсеиваются —
+    две одинаковые покупки подряд бывают настоящими.
+    """
+    if idempotency_key:
+        return "key:" + _sha256(str(idempotency_key).strip())
+    if purchase.get("fingerprint"):
+        return purchase["fingerprint"]
+    if purchase.get("order_id"):
+        market = purchase.get("marketplace") or INTAKE_MARKETPLACE
+        return "key:" + _sha256(f"order:{market}:{purchase['order_id']}")
+    if content:
+        return content
+    return "src:" + _sha256(" ".join(str(purchase.get("source_text") or "").split()))
+
+
+def is_idempotency_key(fingerprint):
+    return fingerprint.startswith("key:")
+
+
+def payload_fingerprint(data):
+    """Отпечаток по исходному JSON — для эндпоинтов, где source_text общий для всех покупок."""
+    return "json:" + _sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str))
+
+
+def ingest_purchases(purchases):
+    """
+    Записать покупки одной транзакцией. Возвращает лоты (dict) в том же порядке;
+    уже принятые (тот же Idempotency-Key или id заказа) возвращаются как есть, с duplicate=True.
+    """
+    if len(purchases) > MAX_BATCH:
+        raise ValueError(f"batch too large: {len(purchases)} > {MAX_BATCH}")
+    now = datetime.utcnow().isoformat()
+    fps = [purchase_fingerprint(p) for p in purchases]
+    return insert_lots([
+        {
+            "fingerprint": fp if is_idempotency_key(fp) else None,
+            "source_fp": None if is_idempotency_key(fp) else fp,
+            "source_text": p.get("source_text", ""),
+            "marketplace": p.get("marketplace") or INTAKE_MARKETPLACE,
+            "game": p.get("game", ""),
+            "account_desc": p.get("account_desc", ""),
+            "buy_price": f"{float(p['buy_price']):.2f}",
+            "buy_date": now,
+            "status": "in_stock",
+            "notes": p.get("notes", ""),
+        }
+        for p, fp in zip(purchases, fps)
+    ])
+
+
+# ---- Уведомление «Новый лот» ----
+def new_lot_keyboard(lot):
+    nid, alias = lot["id"], (lot.get("alias") or "").lower()
+    kb = InlineKeyboardMarkup(row_width=4)
+    kb.add(
+        InlineKeyboardButton("Профит $0.5", callback_data=f"profit:{nid}:0.5"),
+        InlineKeyboardButton("Профит $1",   callback_data=f"profit:{nid}:1"),
+        InlineKeyboardButton("Профит $2",   callback_data=f"profit:{nid}:2"),
+    )
+    kb.add(InlineKeyboardButton("Custom", callback_data=f"profit:{nid}:custom"))
+    kb.add(
+        InlineKeyboardButton("Отметить опубликованным", callback_data=f"posted:{nid}:{alias}"),
+        InlineKeyboardButton("Отметить проданным",      callback_data=f"sold_direct:{nid}")
+    )
+    return kb
+
+
+def new_lot_text(lot):
+    return (
+        f"🆕 Новый лот (ID {lot['id']})\n"
+        f"Игра: {lot.get('game', '')}\n"
+        f"Описание: {lot.get('account_desc', '')}\n"
+        f"Куплено за: {float(lot['buy_price']):.2f}$\n"
+        + (
+            f"⚠️ Возможный повтор лота ID {lot['possible_duplicate_of']} (то же уведомление недавно)\n"
+            if lot.get("possible_duplicate_of") else ""
+        )
+        + "\nВыбери целевой профит, чтобы получить мин. цену продажи и шаблон."
+    )
+
+
+def digest_text(lots):
+    lines = [f"🆕 Новые лоты: {len(lots)} шт."]
+    for lot in lots:
+        alias = (lot.get("alias") or "").lower()
+        lines.append(
+            f"ID {lot['id']} · {alias} · {lot.get('game', '')} · {float(lot['buy_price']):.2f}$"
+        )
+    lines.append("\nНажми на ID, чтобы выбрать профит, или «Разобрать пачку».")
+    return "\n".join(lines)
+
+
+# состав каждого дайджеста: id лотов пачки не влезают в callback_data, а по диапазону
+# min..max попали бы и чужие лоты между ними. Ключ — наименьший id пачки.
+DIGESTS = make_state_store(
+    "new_lot_digest", STATE_BACKEND, get_conn, run_db,
+    ttl=float(os.getenv("NEW_LOT_DIGEST_TTL", str(7 * 24 * 3600))), maxsize=STATE_MAX_ENTRIES,
+)
+AFTER_WIPE_HOOKS.append(DIGESTS.clear)      # после /reset_stats id нумеруются заново
+
+
+def digest_keyboard(lots, key):
+    kb = InlineKeyboardMarkup(row_width=5)
+    kb.add(*[
+        InlineKeyboardButton(f"ID {lot['id']}", callback_data=f"newlot:{lot['id']}")
+        for lot in lots
+    ])
+    kb.add(InlineKeyboardButton("Разобрать пачку", callback_data=f"newlots:{key}"))
+    return kb
+
+
+class NewLotNotifier:
+    """
+    Уведомления о новых лотах с дайджестом при всплесках.
+
+    Тихо (в чат ничего не уходило последние window секунд и буфер пуст) — лот отправляется
+    сразу обычной карточкой. Иначе лоты копятся и через window секунд уходят одним
+    дайджестом (по digest_max лотов в сообщении) с компактной клавиатурой.
+    Пачка из нескольких лотов (batch-эндпоинт, /poll) сразу идёт дайджестом.
+    window <= 0 — дайджест выключен, каждый лот отдельным сообщением.
+    """
+
+    def __init__(self, window=5.0, digest_max=20):
+        self.window = window
+        self.digest_max = digest_max
+        self._pending = {}      # chat_id -> [lot, ...]
+        self._flush_tasks = {}  # chat_id -> asyncio.Task
+        self._last_sent = {}    # chat_id -> monotonic
+
+    async def _send_cards(self, chat_id, lots):
+        for lot in lots:
+            await bot.send_message(chat_id, new_lot_text(lot), reply_markup=new_lot_keyboard(lot))
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def _send_digest(self, chat_id, lots):
+        if len(lots) == 1:
+            await self._send_cards(chat_id, lots)
+            return
+        for i in range(0, len(lots), self.digest_max):
+            chunk = lots[i:i + self.digest_max]
+            ids = sorted(int(lot["id"]) for lot in chunk)
+            key = str(ids[0])     # строкой — как придёт из callback_data
+            await DIGESTS.set(key, {"ids": ids})
+            await bot.send_message(chat_id, digest_text(chunk), reply_markup=digest_keyboard(chunk, key))
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def notify(self, lots, chat_id):
+        if not chat_id or not lots:
+            return
+        if self.window <= 0:
+            await self._send_cards(chat_id, lots)
+            return
+
+        quiet = (
+            chat_id not in self._pending
+            and time.monotonic() - self._last_sent.get(chat_id, float("-inf")) >= self.window
+        )
+        if quiet and len(lots) == 1:
+            await self._send_cards(chat_id, lots)
+            return
+        if quiet:
+            await self._send_digest(chat_id, list(lots))
+            return
+
+        self._pending.setdefault(chat_id, []).extend(lots)
+        if chat_id not in self._flush_tasks:
+            self._flush_tasks[chat_id] = asyncio.get_running_loop().create_task(
+                self._flush_later(chat_id)
+            )
+
+    async def _flush_later(self, chat_id):
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            pass    # flush_all(): отправляем сразу
+        self._flush_tasks.pop(chat_id, None)
+        lots = self._pending.pop(chat_id, [])
+        if lots:
+            try:
+                await self._send_digest(chat_id, lots)
+            except Exception as e:
+                print(">>> ERROR sending new-lot digest:", e)
+
+    async def flush_all(self):
+        """Отправить всё накопленное сразу (при остановке)."""
+        for task in list(self._flush_tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._flush_tasks.values(), return_exceptions=True)
+
+
+NOTIFIER = NewLotNotifier(
+    window=float(os.getenv("NEW_LOT_DIGEST_WINDOW", "5")),
+    digest_max=int(os.getenv("NEW_LOT_DIGEST_MAX", "20")),
+)
+
+
+async def notify_new_lots(lots, chat_id):
+    await NOTIFIER.notify(lots, chat_id)
+
+
+# ---- Кнопки дайджеста ----
+@ROUTER.callback("newlot")
+async def cb_newlot(call: types.CallbackQuery, nid):
+    lot = await run_db(get_lot, nid)
+    if not lot:
+        await call.answer("Лот не найден.", show_alert=True)
+        return
+    await call.message.answer(new_lot_text(lot), reply_markup=new_lot_keyboard(lot))
+    await call.answer()
+
+
+@ROUTER.callback("newlots")
+async def cb_newlots(call: types.CallbackQuery, key):
+    digest = await DIGESTS.get(key)
+    if not digest:
+        await call.answer("Кнопка устарела.", show_alert=True)
+        return
+    lots = await run_db(list_lots, ids=digest["ids"])
+    if not lots:
+        await call.answer("Лоты не найдены.", show_alert=True)
+        return
+    await call.answer()
+    for lot in lots:
+        await call.message.answer(new_lot_text(lot), reply_markup=new_lot_keyboard(lot))
+
+
+async def ingest_and_notify(purchases, chat_id):
+    """
+    Записать пачку покупок (в потоке БД) и отправить уведомления. Возвращает лоты в порядке
+    purchases; повторы (duplicate=True) не пишутся и не уведомляются.
+    """
+    purchases = [dict(p, fingerprint=purchase_fingerprint(p)) for p in purchases]
+    result = [
+        FINGERPRINTS.get(p["fingerprint"]) if is_idempotency_key(p["fingerprint"]) else None
+        for p in purchases
+    ]
+    result = [dict(lot, duplicate=True) if lot else None for lot in result]
+    todo = [i for i, lot in enumerate(result) if lot is None]
+    if todo:
+        lots = await run_db(ingest_purchases, [purchases[i] for i in todo])
+        for i, lot in zip(todo, lots):
+            if lot.get("fingerprint"):
+                FINGERPRINTS.set(lot["fingerprint"], lot)
+            result[i] = lot
+        await notify_new_lots([lot for lot in lots if not lot["duplicate"]], chat_id)
+    return result
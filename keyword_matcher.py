@@ -0,0 +1,60 @@
+# keyword_matcher.py
+"""
+Поиск набора литеральных ключевых слов в тексте за один проход.
+
+Классический Aho-Corasick на чистом Python идёт по тексту посимвольно в интерпретаторе и на
+коротких уведомлениях медленнее самого регэкспа, который он должен отсекать. Поэтому автомат
+строит модуль re: все ключи — одна скомпилированная альтернатива (сканирование в C),
+длинные раньше коротких. Ключи, целиком входящие в найденный, добавляются по заранее
+посчитанной таблице. Непересекающийся поиск может пропустить ключ, начало которого совпадает
+с концом другого («bc» в «abc» после «ab») — такие ключи заранее известны и дополнительно
+проверяются обычным `in`.
+
+Для небольшого набора (до DIRECT_MAX_KEYWORDS ключей) быстрее просто проверить каждый ключ
+через `in` (тоже поиск в C) — так и делаем; альтернатива включается на больших наборах.
+"""
+import re
+
+DIRECT_MAX_KEYWORDS = 24
+
+
+def _straddling(keywords):
+    """Ключи b, которые могут начинаться внутри найденного ключа a и выходить за его конец."""
+    return [
+        b for b in keywords
+        if any(a != b and any(a.endswith(b[:i]) for i in range(1, min(len(a), len(b))))
+               for a in keywords)
+    ]
+
+
+class KeywordMatcher:
+    def __init__(self, keywords):
+        self.keywords = sorted({k.lower() for k in keywords if k}, key=lambda k: (-len(k), k))
+        self._pattern = re.compile(
+            "|".join(re.escape(k) for k in self.keywords)
+        ) if self.keywords else None
+        self._contained = {
+            k: [p for p in self.keywords if p != k and p in k] for k in self.keywords
+        }
+        self._direct = len(self.keywords) <= DIRECT_MAX_KEYWORDS
+        self._straddling = [] if self._direct else _straddling(self.keywords)
+
+    def find(self, text, lowered=False):
+        """Множество ключей (в нижнем регистре), которые встречаются в тексте."""
+        if self._pattern is None or not text:
+            return set()
+        low = text if lowered else text.lower()
+        if self._direct:
+            return {k for k in self.keywords if k in low}
+        found = set()
+        for k in self._pattern.findall(low):
+            if k not in found:
+                found.add(k)
+                found.update(self._contained[k])
+        for k in self._straddling:
+            if k not in found and k in low:
+                found.add(k)
+        return found
+
+    def __contains__(self, keyword):
+        return keyword.lower() in self._contained
@@ -1,34 +1,101 @@
 # list_open_feature.py
+import os
+
 from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "20"))
+LIST_STATUSES = ("listed", "in_stock", "sold", "restored")
+CALLBACK_DATA_MAX = 64   # лимит Telegram на callback_data, в байтах
+
+
+def _list_cb(direction, cursor, status, game):
+    """callback_data кнопки ◀/▶: list:<направление>:<id-курсор>:<статус>:<префикс игры>."""
+    head = f"list:{direction}:{cursor}:{status}:"
+    room = CALLBACK_DATA_MAX - len(head.encode("utf-8"))
+    # слишком длинный префикс укорачиваем — фильтр станет шире, но кнопка останется рабочей
+    game = game.encode("utf-8")[:room].decode("utf-8", "ignore")
+    return head + game
+
+
 def setup_list_open_feature(
-    dp, bot,
-    read_rows, write_rows,
+    dp, router,
+    get_lot, list_lots, run_db,
     get_description_for_game, auto_desc_for_game,
-    compose_listing, calc_net_from_sale
+    compose_listing, calc_net_from_sale, lot_pricing_rule
 ):
-    @dp.message_handler(commands=["list"])
-    async def cmd_list(message: types.Message):
-        rows = read_rows()
-        listed = [r for r in rows if (r.get("status") or "") == "listed"]
-        if not listed:
-            await message.answer("Пока нет опубликованных лотов.")
+    async def send_page(message, status, game, after=None, before=None, edit=False):
+        # +1 строка — узнать, есть ли страница дальше в направлении запроса
+        rows = await run_db(
+            list_lots, status=status, game=game or None,
+            after=after, before=before, limit=LIST_PAGE_SIZE + 1,
+        )
+        more = len(rows) > LIST_PAGE_SIZE
+        if before is not None:
+            rows = rows[-LIST_PAGE_SIZE:]
+            has_prev, has_next = more, True
+        else:
+            rows = rows[:LIST_PAGE_SIZE]
+            has_prev, has_next = bool(after), more
+
+        if not rows:
+            text = "Пока нет опубликованных лотов." if (status == "listed" and not game) else "Лотов не найдено."
+            if edit:
+                await message.edit_text(text)
+            else:
+                await message.answer(text)
             return
 
-        kb = InlineKeyboardMarkup(row_width=1)
-        for r in listed:
+        kb = InlineKeyboardMarkup(row_width=2)
+        for r in rows:
             alias = (r.get("alias") or "").lower()
             title = f'ID {r["id"]} — {(alias + " | ") if alias else ""}{r["game"]}'
-            kb.add(InlineKeyboardButton(title, callback_data=f"open:{r['id']}"))
+            kb.row(InlineKeyboardButton(title, callback_data=f"open:{r['id']}"))
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton("◀", callback_data=_list_cb("<", rows[0]["id"], status, game)))
+        if has_next:
+            nav.append(InlineKeyboardButton("▶", callback_data=_list_cb(">", rows[-1]["id"], status, game)))
+        if nav:
+            kb.row(*nav)
+
+        scope = status + (f", игра: {game}*" if game else "")
+        text = f"Выберите лот ({scope}):"
+        if edit:
+            await message.edit_text(text, reply_markup=kb)
+        else:
+            await message.answer(text, reply_markup=kb)
 
-        await message.answer("Выберите лот:", reply_markup=kb)
+    @dp.message_handler(commands=["list"])
+    async def cmd_list(message: types.Message):
+        # всё после game= — префикс игры (может быть с пробелами)
+        args, _, game = message.get_args().partition("game=")
+        status, game = "listed", " ".join(game.split())
+        for arg in args.split():
+            if arg.lower() in LIST_STATUSES:
+                status = arg.lower()
+            else:
+                await message.answer(
+                    "Использование: /list [статус] [game=префикс]\n"
+                    f"Статусы: {', '.join(LIST_STATUSES)}. Пример: /list in_stock game=cs2"
+                )
+                return
+        await send_page(message, status, game)
 
-    @dp.callback_query_handler(lambda c: c.data and c.data.startswith("open:"))
-    async def cb_open(call: types.CallbackQuery):
-        _, nid = call.data.split(":", 1)
-        rows = read_rows()
-        row = next((r for r in rows if r.get("id") == str(nid)), None)
+    @router.callback("list")
+    async def cb_list(call: types.CallbackQuery, direction, cursor, status, game=""):
+        if status not in LIST_STATUSES:
+            await call.answer("Кнопка устарела.", show_alert=True)
+            return
+        if direction == "<":
+            await send_page(call.message, status, game, before=cursor, edit=True)
+        else:
+            await send_page(call.message, status, game, after=cursor, edit=True)
+        await call.answer()
+
+    @router.callback("open")
+    async def cb_open(call: types.CallbackQuery, nid):
+        row = await run_db(get_lot, nid)
         if not row:
             await call.answer("Лот не найден.", show_alert=True)
             return
@@ -42,7 +109,10 @@ def setup_list_open_feature(
         except:
             buy_price = 0.0
 
-        target = calc_net_from_sale(min_sale, buy_price) if (min_sale and buy_price) else 1.0
+        target = (
+            calc_net_from_sale(min_sale, buy_price, lot_pricing_rule(row))
+            if (min_sale and buy_price) else 1.0
+        )
         desc = get_description_for_game(row["game"]) or auto_desc_for_game(
             row["game"], row.get("account_desc", "")
         )
@@ -0,0 +1,471 @@
+# migrations.py
+"""
+Версионированные миграции схемы.
+
+Каждая миграция — (версия, название, шаги, в_транзакции).
+Шаг — строка SQL или функция f(cur). Применённые версии пишутся в schema_migrations,
+поэтому migrate() можно спокойно звать на каждом старте: уже применённое пропускается.
+Параллельные воркеры не мешают друг другу — весь прогон под advisory lock.
+
+Миграции с в_транзакции=False выполняются в autocommit (нужно для CREATE INDEX CONCURRENTLY,
+чтобы не блокировать запись в таблицу, пока строится индекс).
+"""
+import csv
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+MIGRATIONS_LOCK_ID = 72150401   # произвольная константа для pg_advisory_lock
+
+
+# ---- SQL-выражения для переноса TEXT -> типизированные колонки ----
+def _numeric_from_text(col):
+    # '3,5' -> 3.5; пусто/мусор -> NULL (сырые значения остаются в inventory_pre_v4)
+    v = f"btrim(replace({col}, ',', '.'))"
+    return f"CASE WHEN {v} ~ '^-?[0-9]+(\\.[0-9]+)?$' THEN round({v}::numeric, 2) END"
+
+
+def _timestamptz_from_text(col):
+    # даты писались как datetime.utcnow().isoformat() — наивное UTC-время
+    return (
+        f"CASE WHEN btrim({col}) ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}([T ][0-9:.]+)?$' "
+        f"THEN btrim({col})::timestamp AT TIME ZONE 'UTC' END"
+    )
+
+
+V4_MONEY = ("buy_price", "sell_price", "net_profit", "min_sale_for_target")
+V4_DATES = ("buy_date", "sell_date")
+V4_BATCH = 5000     # строк на UPDATE при заполнении новых колонок (каждая пачка — своя транзакция)
+
+
+def _typed_columns_online(cur):
+    """
+    TEXT -> NUMERIC/TIMESTAMPTZ без перезаписи таблицы под ACCESS EXCLUSIVE (миграция 4, autocommit):
+    новые nullable-колонки *_v4, триггер держит их в синхроне с записью старых воркеров,
+    заполнение пачками по id, NOT NULL у status — через CHECK NOT VALID + VALIDATE, и в конце
+    короткая подмена колонок в одной транзакции (lock_timeout — не висим в очереди за блокировкой).
+    Повторный запуск после обрыва продолжает с того места, где остановился.
+    """
+    cur.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'inventory' AND column_name = 'buy_price'"
+    )
+    r = cur.fetchone()
+    if r and r[0] != "text":
+        return      # колонки уже типизированы
+
+    cur.execute("CREATE TABLE IF NOT EXISTS inventory_pre_v4 AS SELECT * FROM inventory")
+    cur.execute(
+        "ALTER TABLE inventory "
+        + ", ".join(f"ADD COLUMN IF NOT EXISTS {c}_v4 NUMERIC(12,2)" for c in V4_MONEY) + ", "
+        + ", ".join(f"ADD COLUMN IF NOT EXISTS {c}_v4 TIMESTAMPTZ" for c in V4_DATES)
+        + ", ALTER COLUMN status SET DEFAULT 'in_stock'"
+    )
+    assignments = "\n".join(
+        [f"            NEW.{c}_v4 := {_numeric_from_text('NEW.' + c)};" for c in V4_MONEY]
+        + [f"            NEW.{c}_v4 := {_timestamptz_from_text('NEW.' + c)};" for c in V4_DATES]
+    )
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION inventory_v4_sync() RETURNS trigger AS $$
+        BEGIN
+            NEW.status := coalesce(nullif(NEW.status, ''), 'in_stock');
+{assignments}
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS inventory_v4_sync ON inventory")
+    cur.execute(
+        "CREATE TRIGGER inventory_v4_sync BEFORE INSERT OR UPDATE ON inventory "
+        "FOR EACH ROW EXECUTE PROCEDURE inventory_v4_sync()"
+    )
+
+    # заполнение: UPDATE пачкой по диапазону id, значения считает триггер
+    cur.execute("SELECT coalesce(min(id), 1), coalesce(max(id), 0) FROM inventory")
+    lo, hi = cur.fetchone()
+    for start in range(lo - 1, hi, V4_BATCH):
+        cur.execute(
+            "UPDATE inventory SET status = status WHERE id > %s AND id <= %s",
+            (start, start + V4_BATCH),
+        )
+
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'inventory_status_not_null') THEN
+                ALTER TABLE inventory ADD CONSTRAINT inventory_status_not_null
+                    CHECK (status IS NOT NULL) NOT VALID;
+            END IF;
+        END $$
+    """)
+    # проверка без блокировки записи (SHARE UPDATE EXCLUSIVE); после неё SET NOT NULL не сканирует таблицу
+    cur.execute("ALTER TABLE inventory VALIDATE CONSTRAINT inventory_status_not_null")
+
+    renames = "\n".join(
+        f"            ALTER TABLE inventory RENAME COLUMN {c}_v4 TO {c};" for c in V4_MONEY + V4_DATES
+    )
+    cur.execute(f"""
+        DO $$
+        BEGIN
+            PERFORM set_config('lock_timeout', '5s', true);
+            LOCK TABLE inventory IN ACCESS EXCLUSIVE MODE;
+            DROP TRIGGER inventory_v4_sync ON inventory;
+            ALTER TABLE inventory {", ".join(f"DROP COLUMN {c}" for c in V4_MONEY + V4_DATES)},
+                ALTER COLUMN status SET NOT NULL;
+            ALTER TABLE inventory DROP CONSTRAINT inventory_status_not_null;
+{renames}
+            DROP FUNCTION inventory_v4_sync();
+        END $$
+    """)
+
+
+DESCRIPTIONS_CSV = os.path.join(os.path.dirname(__file__), "descriptions.csv")
+
+
+def _import_descriptions_csv(cur):
+    # что успело накопиться в файле на этом инстансе; файл остаётся как есть
+    try:
+        with open(DESCRIPTIONS_CSV, newline="", encoding="utf-8") as f:
+            rows = [r for r in csv.DictReader(f) if r.get("game_key") and r.get("description")]
+    except FileNotFoundError:
+        return
+    for r in rows:
+        try:
+            # писалось как datetime.utcnow().isoformat() — наивное UTC-время
+            updated_at = datetime.fromisoformat(r.get("updated_at") or "").replace(tzinfo=timezone.utc)
+        except ValueError:
+            updated_at = None
+        cur.execute(
+            "INSERT INTO game_descriptions (game_key, description, updated_at) "
+            "VALUES (%s, %s, COALESCE(%s, now())) "
+            "ON CONFLICT (game_key) DO NOTHING",
+            (r["game_key"], r["description"], updated_at),
+        )
+
+
+# текст лота для /find; запрос должен использовать ровно это выражение, иначе индекс не подхватится.
+# Алиаса в нём нет: это 3-4 случайные буквы, и нечёткое сравнение цепляло бы их к похожим
+# названиям («rus» к «rust») — алиас ищется только точным совпадением.
+SEARCH_DOC = (
+    "lower(coalesce(game, '') || ' ' || "
+    "coalesce(account_desc, '') || ' ' || coalesce(notes, ''))"
+)
+# выражение индекса миграции 12 (с алиасом) — заменено в миграции 16
+_SEARCH_DOC_V12 = (
+    "lower(coalesce(game, '') || ' ' || coalesce(alias, '') || ' ' || "
+    "coalesce(account_desc, '') || ' ' || coalesce(notes, ''))"
+)
+
+
+MIGRATIONS = [
+    (1, "inventory table", [
+        """
+        CREATE TABLE IF NOT EXISTS inventory (
+            id INTEGER PRIMARY KEY,
+            alias TEXT,
+            source_text TEXT,
+            game TEXT,
+            account_desc TEXT,
+            buy_price TEXT,
+            buy_date TEXT,
+            status TEXT,
+            min_sale_for_target TEXT,
+            notes TEXT,
+            sell_price TEXT,
+            sell_date TEXT,
+            net_profit TEXT
+        )
+        """,
+    ], True),
+
+    # id выдаёт последовательность; старые базы переводим один раз, продолжая с max(id)+1
+    (2, "inventory id sequence", [
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('inventory_id_seq') IS NULL THEN
+                CREATE SEQUENCE inventory_id_seq OWNED BY inventory.id;
+                PERFORM setval('inventory_id_seq', COALESCE((SELECT MAX(id) FROM inventory), 0) + 1, false);
+                ALTER TABLE inventory ALTER COLUMN id SET DEFAULT nextval('inventory_id_seq');
+            END IF;
+        END $$;
+        """,
+    ], True),
+
+    # алиасы уникальны на уровне БД; перед созданием индекса чистим пустые и дубли
+    (3, "unique alias", [
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('inventory_alias_key') IS NULL THEN
+                UPDATE inventory SET alias = lower(alias) WHERE alias <> lower(alias);
+                UPDATE inventory i SET alias = NULL
+                 WHERE i.alias = ''
+                    OR EXISTS (SELECT 1 FROM inventory j WHERE j.alias = i.alias AND j.id < i.id);
+                CREATE UNIQUE INDEX inventory_alias_key ON inventory (alias);
+            END IF;
+        END $$;
+        """,
+    ], True),
+
+    # деньги -> NUMERIC(12,2), даты -> TIMESTAMPTZ; копия исходных строк остаётся в inventory_pre_v4.
+    # Онлайн: без перезаписи таблицы под эксклюзивной блокировкой (см. _typed_columns_online)
+    (4, "typed money and date columns", [
+        _typed_columns_online,
+    ], False),
+
+    (5, "inventory indexes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_status_idx ON inventory (status)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_buy_date_idx ON inventory (buy_date)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_sell_date_idx ON inventory (sell_date)",
+        # живые лоты (в наличии / выставлены) — их читают чаще всего
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_live_idx ON inventory (id) "
+        "WHERE status IN ('in_stock', 'listed')",
+    ], False),
+
+    # уже обработанные update_id Telegram — чтобы дедупликация переживала рестарт
+    (6, "processed updates", [
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS processed_updates_seen_at_idx ON processed_updates (seen_at)",
+    ], True),
+
+    # отпечаток покупки (Idempotency-Key или хэш source_text): повторный приём не создаёт дубль
+    (7, "purchase fingerprint", [
+        "ALTER TABLE inventory ADD COLUMN IF NOT EXISTS fingerprint TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS inventory_fingerprint_key ON inventory (fingerprint)",
+    ], True),
+
+    # служебные значения бота (например, хэш зарегистрированного меню команд)
+    (8, "bot meta", [
+        """
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ], True),
+
+    # состояния диалога (ввод профита/описания) — общие для всех воркеров
+    (9, "dialog state", [
+        """
+        CREATE TABLE IF NOT EXISTS dialog_state (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (namespace, key)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS dialog_state_expires_at_idx ON dialog_state (expires_at)",
+    ], True),
+
+    # комиссия/окончание цены/мин. профит по игре и площадке; у лота — площадка и
+    # комиссия, с которой он продан (до этой версии комиссия везде была 6%)
+    (10, "pricing rules", [
+        """
+        CREATE TABLE IF NOT EXISTS pricing_rules (
+            id SERIAL PRIMARY KEY,
+            game_key TEXT NOT NULL DEFAULT '',
+            marketplace TEXT NOT NULL DEFAULT '',
+            commission NUMERIC(6,4) CHECK (commission >= 0 AND commission < 1),
+            price_ending TEXT,
+            min_margin NUMERIC(12,2),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            UNIQUE (game_key, marketplace)
+        )
+        """,
+        # ручной UPDATE правила тоже двигает updated_at — по нему бот замечает изменения
+        """
+        CREATE OR REPLACE FUNCTION pricing_rules_touch() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS pricing_rules_touch ON pricing_rules",
+        "CREATE TRIGGER pricing_rules_touch BEFORE UPDATE ON pricing_rules "
+        "FOR EACH ROW EXECUTE PROCEDURE pricing_rules_touch()",
+        "ALTER TABLE inventory ADD COLUMN IF NOT EXISTS marketplace TEXT, "
+        "ADD COLUMN IF NOT EXISTS commission NUMERIC(6,4)",
+        "UPDATE inventory SET commission = 0.06 WHERE status = 'sold' AND commission IS NULL",
+    ], True),
+
+    # постраничный /list: страница по статусу или префиксу игры — один проход по индексу от курсора
+    (11, "list pagination indexes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_status_id_idx ON inventory (status, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_game_prefix_idx "
+        "ON inventory (lower(game) text_pattern_ops, id)",
+    ], False),
+
+    # /find: нечёткий поиск по игре, алиасу, описанию и заметкам (триграммы pg_trgm)
+    (12, "lot search", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_search_trgm_idx "
+        f"ON inventory USING gin (({_SEARCH_DOC_V12}) gin_trgm_ops)",
+    ], False),
+
+    # память описаний по игре — из descriptions.csv (был локальным для контейнера) в БД
+    (13, "game descriptions", [
+        """
+        CREATE TABLE IF NOT EXISTS game_descriptions (
+            game_key TEXT PRIMARY KEY,
+            description TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        _import_descriptions_csv,
+    ], True),
+
+    # навсегда уникален только Idempotency-Key / id заказа; отпечаток по содержимому (source_text/JSON)
+    # лишь помечает возможный повтор в коротком окне — одинаковые покупки бывают настоящими
+    (14, "content fingerprint window", [
+        "ALTER TABLE inventory ADD COLUMN IF NOT EXISTS source_fp TEXT, "
+        "ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
+        "UPDATE inventory SET created_at = buy_date WHERE created_at IS NULL",
+        "ALTER TABLE inventory ALTER COLUMN created_at SET DEFAULT now()",
+        "UPDATE inventory SET source_fp = fingerprint, fingerprint = NULL "
+        "WHERE fingerprint IS NOT NULL AND fingerprint NOT LIKE 'key:%'",
+        "CREATE INDEX IF NOT EXISTS inventory_source_fp_idx ON inventory (source_fp, created_at) "
+        "WHERE source_fp IS NOT NULL",
+    ], True),
+
+    # площадка у уже принятых лотов: всё, кроме ручных /add_buy, пришло с автобая LZT
+    (15, "lot marketplace backfill", [
+        "UPDATE inventory SET marketplace = 'lolz' "
+        "WHERE coalesce(marketplace, '') = '' AND coalesce(source_text, '') NOT LIKE 'manual:%'",
+    ], True),
+
+    # /find: алиас — только точным совпадением, из триграммного документа убран
+    (16, "lot search without alias", [
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_search_doc_trgm_idx "
+        f"ON inventory USING gin (({SEARCH_DOC}) gin_trgm_ops)",
+        "DROP INDEX CONCURRENTLY IF EXISTS inventory_search_trgm_idx",
+    ], False),
+]
+
+
+def _run_steps(cur, steps):
+    for step in steps:
+        if callable(step):
+            step(cur)
+        else:
+            cur.execute(step)
+
+
+LOCK_POLL_INTERVAL = 0.5     # секунд между попытками взять MIGRATIONS_LOCK_ID
+_CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE
+)
+
+
+def _acquire_lock(conn, cur):
+    """
+    Взять advisory lock миграций. Ждём опросом pg_try_advisory_lock в autocommit: ждущий
+    воркер не держит открытую транзакцию со снимком, иначе CREATE INDEX CONCURRENTLY у
+    держателя лока ждал бы его снимок, а он — лок (взаимная блокировка, одну сторону
+    Postgres обрывает, и после CIC остаётся INVALID-индекс).
+    """
+    conn.autocommit = True
+    try:
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            if cur.fetchone()[0]:
+                return
+            time.sleep(LOCK_POLL_INTERVAL)
+    finally:
+        conn.autocommit = False
+
+
+def _concurrent_indexes(steps):
+    return [m.group(1) for step in steps if isinstance(step, str) for m in _CONCURRENT_INDEX.finditer(step)]
+
+
+def _drop_invalid_indexes(cur, names):
+    """Удалить INVALID-индексы из names (след оборванного CIC). Возвращает их имена. Только в autocommit."""
+    if not names:
+        return []
+    cur.execute(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = ANY(%s) AND NOT i.indisvalid",
+        (names,),
+    )
+    invalid = [r[0] for r in cur.fetchall()]
+    for name in invalid:
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    return invalid
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Применить все недостающие миграции. Возвращает список применённых версий."""
+    applied_now = []
+    cur = conn.cursor()
+
+    # быстрый путь для обычного рестарта: схема актуальна — ни DDL, ни advisory lock
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT version FROM schema_migrations")
+        if {m[0] for m in migrations} <= {r[0] for r in cur.fetchall()}:
+            conn.commit()
+            cur.close()
+            return applied_now
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    conn.commit()
+
+    _acquire_lock(conn, cur)
+    try:
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {r[0] for r in cur.fetchall()}
+        conn.commit()
+
+        for version, name, steps, transactional in sorted(migrations, key=lambda m: m[0]):
+            if version in done:
+                continue
+            if transactional:
+                _run_steps(cur, steps)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+                conn.commit()
+            else:
+                conn.autocommit = True
+                try:
+                    # IF NOT EXISTS пропустил бы INVALID-индекс от прошлой оборванной попытки
+                    indexes = _concurrent_indexes(steps)
+                    _drop_invalid_indexes(cur, indexes)
+                    _run_steps(cur, steps)
+                    invalid = _drop_invalid_indexes(cur, indexes)
+                    if invalid:
+                        raise RuntimeError(f"migration {version}: indexes left invalid: {invalid}")
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name),
+                    )
+                finally:
+                    conn.autocommit = False
+            applied_now.append(version)
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+        conn.commit()
+        cur.close()
+    return applied_now
+
@@ -0,0 +1,236 @@
+# notification_parser.py
+"""
+Разбор уведомлений о покупке: реестр шаблонов с префильтром по ключевым словам.
+
+Каждый шаблон объявляет обязательные ключевые слова (строка или кортеж «любое из»).
+Один проход KeywordMatcher по тексту выбирает кандидатов, регэкспы запускаются только у них.
+Если ни один кандидат не дал цену — старый русский парсер (как было до реестра).
+
+Новый формат — функция text -> dict|None под декоратором @template(...).
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+from keyword_matcher import KeywordMatcher
+
+
+def to_decimal(s):
+    """Преобразует строку с ',' или '.' в Decimal, убирает пробелы и NBSP."""
+    if s is None:
+        raise InvalidOperation
+    s = s.replace("\xa0", "").replace(" ", "").strip()
+    s = s.replace(",", ".")
+    return Decimal(s)
+
+
+RE_LINK = re.compile(r'По вашей ссылке\s*["“](?P<link>[^"”]+)["”]', re.IGNORECASE)
+RE_BUYPRICE = re.compile(r'за\s*(?:\$\s*)?([\d\.,]+)(?:\s*\$)?', re.IGNORECASE)
+RE_KUP = re.compile(r'куплен аккаунт\s*(?P<acc>.*?)\s*(?:В сети:|в сети:|за\s|$)', re.IGNORECASE)
+RE_GAME_QUOTE_FALLBACK = re.compile(r'["“](?P<g>[^"”]+)["”]')
+RE_GAME_BEFORE_KUP = re.compile(r'(.+?)куплен аккаунт', re.IGNORECASE)
+
+def _price_from_str(price_str):
+    try:
+        return float(str(to_decimal(price_str)))
+    except Exception:
+        return None
+
+
+# Канонический вид уведомления (так же его собирает lzt_scraper):
+#     По вашей ссылке "GAME" куплен аккаунт ACC за $PRICE
+# Один якорный match() по text.lower(). Условия, при которых результат совпадает со старым
+# парсером, — часть шаблона: до «по вашей ссылке» нет ни её самой, ни «куплен аккаунт», ни «за»;
+# в названии игры нет «за» и «куплен аккаунт»; описание — до первого «за», без «в сети:»
+# и переводов строки.
+# Запрещённые подстроки проверяются только на буквах, с которых они начинаются (п/к/з/в),
+# остальной текст пропускается классом символов целиком — без lookahead на каждой позиции.
+RE_NOTIFICATION = re.compile(
+    r'[^пкз]*(?:(?!по вашей ссылке|куплен аккаунт|за)[пкз][^пкз]*)*'
+    r'по вашей ссылке\s*["“]'
+    r'(?P<link>[^"”кз]*(?:(?!куплен аккаунт|за)[кз][^"”кз]*)*)'
+    r'["”]\s*куплен аккаунт'
+    r'(?P<acc>[^\nвз]*(?:(?!в сети:|за)[вз][^\nвз]*)*)'
+    r'за\s+(?:\$\s*)?(?P<price>[\d\.,]+)'
+)
+
+
+def _parse_fast(text: str, low=None):
+    """
+    Канонический текст одним проходом RE_NOTIFICATION. Возвращает None, если нельзя
+    гарантировать тот же результат, что у _parse_notification_legacy (тогда парсим по-старому).
+    """
+    if low is None:
+        low = text.lower()
+    if len(low) != len(text):       # lower() изменил длину — индексы не совпадут
+        return None
+    m = RE_NOTIFICATION.match(low)
+    if not m:
+        return None
+    game = text[m.start("link"):m.end("link")].strip()
+    if not game:
+        return None
+    return {
+        "game": game,
+        "account_desc": text[m.start("acc"):m.end("acc")].strip(),
+        "buy_price": _price_from_str(m.group("price")),
+        "source_text": text,
+    }
+
+
+def _parse_notification_legacy(text: str):
+    game = None
+    account_desc = ""
+    buy_price = None
+
+    m = RE_LINK.search(text)
+    if m:
+        game = m.group("link").strip()
+
+    m2 = RE_KUP.search(text)
+    if m2:
+        account_desc = m2.group("acc").strip()
+
+    m3 = RE_BUYPRICE.search(text)
+    if m3:
+        buy_price = _price_from_str(m3.group(1))
+
+    if not game:
+        m4 = RE_GAME_QUOTE_FALLBACK.search(text)
+        if m4:
+            game = m4.group("g").strip()
+
+    if not game:
+        m5 = RE_GAME_BEFORE_KUP.search(text)
+        if m5:
+            game = m5.group(1).strip().split()[-1]
+
+    return {
+        "game": game or "",
+        "account_desc": account_desc or "",
+        "buy_price": buy_price,
+        "source_text": text
+    }
+
+
+# ---- EN: Via your link "GAME" account purchased ACC for $3.50 ----
+RE_EN_LINK_FIRST = re.compile(
+    r'(?:via|by|using|through) your link\s*["“](?P<link>[^"”]+)["”][,:]?\s*'
+    r'(?:an?\s+)?account\s+(?:was\s+|has been\s+)?(?:purchased|bought)\s*:?\s*(?P<acc>.*?)\s*'
+    r'for\s+(?:\$\s*)?(?P<price>\d[\d.,]*)',
+    re.IGNORECASE,
+)
+# ---- EN: Account ACC was purchased via your link "GAME" for $3.50 ----
+RE_EN_ACC_FIRST = re.compile(
+    r'account\s+(?P<acc>.*?)\s*(?:was|has been)\s+(?:purchased|bought)\s+'
+    r'(?:via|by|using|through) your link\s*["“](?P<link>[^"”]+)["”]\s*'
+    r'for\s+(?:\$\s*)?(?P<price>\d[\d.,]*)',
+    re.IGNORECASE,
+)
+# ---- «ключ: значение» построчно (другие площадки, письма) ----
+RE_KV_GAME = re.compile(r'^\s*(?:game|title|игра)\s*:\s*(?P<v>.+?)\s*$', re.IGNORECASE | re.MULTILINE)
+RE_KV_ACC = re.compile(
+    r'^\s*(?:account|description|аккаунт|описание)\s*:\s*(?P<v>.+?)\s*$', re.IGNORECASE | re.MULTILINE
+)
+RE_KV_PRICE = re.compile(
+    r'^\s*(?:price|amount|total|цена|сумма)\s*:\s*(?:\$\s*)?(?P<v>\d[\d.,]*)', re.IGNORECASE | re.MULTILINE
+)
+
+
+class NotificationTemplate:
+    """parse(text, low) -> dict|None; low — text.lower(), уже посчитанный для префильтра."""
+
+    def __init__(self, name, keywords, parse):
+        self.name = name
+        # [("a", "b"), ("c",)] — из каждой группы должно встретиться хотя бы одно слово
+        self.groups = [tuple(k.lower() for k in ((g,) if isinstance(g, str) else g)) for g in keywords]
+        self.parse = parse
+        self.hits = 0
+        self.misses = 0
+
+    def accepts(self, found):
+        for group in self.groups:
+            for k in group:
+                if k in found:
+                    break
+            else:
+                return False
+        return True
+
+
+TEMPLATES = []          # в порядке приоритета
+_MATCHER = None         # пересобирается при регистрации шаблона
+FALLBACK_STATS = {"fallback": 0, "no_candidates": 0}
+
+
+def template(name, keywords):
+    """Зарегистрировать шаблон: @template("en_link", ["your link", "account"])."""
+    def decorator(parse):
+        global _MATCHER
+        if any(t.name == name for t in TEMPLATES):
+            raise ValueError(f"template {name!r} is already registered")
+        TEMPLATES.append(NotificationTemplate(name, keywords, parse))
+        _MATCHER = KeywordMatcher(k for t in TEMPLATES for group in t.groups for k in group)
+        return parse
+    return decorator
+
+
+def _result(game, account_desc, price_str, text):
+    return {
+        "game": game,
+        "account_desc": account_desc,
+        "buy_price": _price_from_str(price_str),
+        "source_text": text,
+    }
+
+
+@template("ru_link", ["по вашей ссылке", "куплен аккаунт"])
+def _parse_ru_link(text, low):
+    return _parse_fast(text, low)
+
+
+@template("en_link", ["your link", "account"])
+def _parse_en_link(text, low):
+    m = RE_EN_LINK_FIRST.search(text) or RE_EN_ACC_FIRST.search(text)
+    if not m or not m.group("link").strip():
+        return None
+    return _result(m.group("link").strip(), m.group("acc").strip(), m.group("price"), text)
+
+
+@template("key_value", [("game:", "title:", "игра:"), ("price:", "amount:", "total:", "цена:", "сумма:")])
+def _parse_key_value(text, low):
+    game, price = RE_KV_GAME.search(text), RE_KV_PRICE.search(text)
+    if not game or not price:
+        return None
+    acc = RE_KV_ACC.search(text)
+    return _result(game.group("v"), acc.group("v") if acc else "", price.group("v"), text)
+
+
+def parse_notification(text: str):
+    text = text.strip()
+    low = text.lower()
+    found = _MATCHER.find(low, lowered=True)
+    if not found:
+        FALLBACK_STATS["no_candidates"] += 1
+    else:
+        for t in TEMPLATES:
+            if not t.accepts(found):
+                continue
+            parsed = t.parse(text, low)
+            if parsed and parsed["buy_price"] is not None:
+                t.hits += 1
+                return parsed
+            t.misses += 1
+    FALLBACK_STATS["fallback"] += 1
+    return _parse_notification_legacy(text)
+
+
+def parse_notifications(texts):
+    """Пачка уведомлений (например, /poll) -> список результатов parse_notification в том же порядке."""
+    return [parse_notification(t) for t in texts]
+
+
+def parser_stats():
+    return dict(
+        FALLBACK_STATS,
+        templates={t.name: {"hits": t.hits, "misses": t.misses} for t in TEMPLATES},
+    )
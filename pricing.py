@@ -0,0 +1,194 @@
+# pricing.py
+"""
+Расчёт цен в целых центах.
+
+Комиссия — в базисных пунктах (6% = 600 bp), цены и профит — в центах (int). Деление
+округляется как Decimal.quantize(Decimal("0.01")) (банковское округление), поэтому
+результат совпадает со старым calc_min_sale/apply_psychological_ending, но без
+Decimal(str(...)) на каждый вызов — пачку из тысяч лотов можно пересчитать за один проход.
+Входы формулы (профит, закупка) не округляются заранее: exact_cents даёт int для целых
+центов и Fraction для долей цента, округляется только итоговая цена.
+"""
+from decimal import Decimal, ROUND_HALF_EVEN
+from fractions import Fraction
+
+BP = 10000      # 100% в базисных пунктах
+
+
+def to_cents(value):
+    """3.5 / '3.50' / Decimal -> 350 (округление до цента, как у Decimal.quantize)."""
+    d = value if isinstance(value, Decimal) else Decimal(str(value))
+    return int(d.quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN) * 100)
+
+
+def exact_cents(value):
+    """0.5 -> 50, '0.505' -> Fraction(101, 2): центы без округления (для входов формулы)."""
+    d = value if isinstance(value, Decimal) else Decimal(str(value))
+    cents = Fraction(d) * 100
+    return cents.numerator if cents.denominator == 1 else cents
+
+
+def to_bp(rate):
+    """0.06 -> 600."""
+    d = rate if isinstance(rate, Decimal) else Decimal(str(rate))
+    return int((d * BP).quantize(Decimal("1"), rounding=ROUND_HALF_EVEN))
+
+
+def from_cents(cents):
+    return cents / 100
+
+
+def _div_round(num, den):
+    """num / den до целого с банковским округлением (den > 0; num — int или Fraction)."""
+    q, r = divmod(num, den)
+    if 2 * r > den or (2 * r == den and q % 2):
+        q += 1
+    return q
+
+
+def min_sale_cents(buy_cents, target_cents, commission_bp):
+    """sale = (target + buy) / (1 - commission), в центах."""
+    return _div_round((target_cents + buy_cents) * BP, BP - commission_bp)
+
+
+def net_from_sale_cents(sale_cents, buy_cents, commission_bp):
+    """net = sale * (1 - commission) - buy, в центах."""
+    return _div_round(sale_cents * (BP - commission_bp), BP) - buy_cents
+
+
+def psychological_ending_cents(cents, ending):
+    """
+    tenth_9     — вверх к следующей 0.1, затем -0.01 (366 -> 369, 369 -> 369);
+    .99 / .49   — вверх к ближайшему X.99 / X.49; иное — без изменений.
+    """
+    if ending == "tenth_9":
+        return ((cents + 9) // 10) * 10 - 1
+    if ending in (".99", ".49"):
+        end = int(ending[1:])
+        candidate = (cents // 100) * 100 + end
+        if candidate < cents:
+            candidate += 100
+        return candidate
+    return cents
+
+
+def min_sale_batch(buy_cents, target_cents, commission_bp, ending):
+    """
+    Мин. цена продажи с окончанием для списка закупочных цен (в центах) за один проход.
+    target_cents — одно значение на всю пачку (int или Fraction из exact_cents).
+    """
+    den = BP - commission_bp
+    out = []
+    for buy in buy_cents:
+        q, r = divmod((target_cents + buy) * BP, den)
+        if 2 * r > den or (2 * r == den and q % 2):
+            q += 1
+        out.append(psychological_ending_cents(q, ending))
+    return out
+
+
+def plan_reprice(lots, target_cents, commission_bp, ending):
+    """
+    Новые min_sale_for_target для лотов. Возвращает [(id, старая цена в центах или None,
+    новая в центах)] только для лотов, у которых цена меняется.
+    """
+    buys = [to_cents(lot["buy_price"]) for lot in lots]
+    new = min_sale_batch(buys, target_cents, commission_bp, ending)
+    changes = []
+    for lot, cents in zip(lots, new):
+        old = lot.get("min_sale_for_target")
+        old = to_cents(old) if old not in (None, "") else None
+        if old != cents:
+            changes.append((int(lot["id"]), old, cents))
+    return changes
+
+
+# ---- Правила комиссии и округления по игре / площадке ----
+class PricingRule:
+    __slots__ = ("commission_bp", "ending", "min_margin_cents")
+
+    def __init__(self, commission_bp, ending, min_margin_cents=0):
+        self.commission_bp = commission_bp
+        self.ending = ending
+        self.min_margin_cents = min_margin_cents
+
+    def as_dict(self):
+        return {
+            "commission": self.commission_bp / BP,
+            "price_ending": self.ending,
+            "min_margin": from_cents(self.min_margin_cents),
+        }
+
+
+def rule_key(value):
+    """Ключ игры/площадки: регистр и лишние пробелы не важны."""
+    return " ".join(str(value or "").split()).lower()
+
+
+class PricingRules:
+    """
+    Правила из таблицы pricing_rules: (game_key, marketplace) -> комиссия, окончание цены,
+    минимальный профит.
+
+    Пустой game_key / marketplace — «любая». Незаполненное поле берётся из более общего
+    правила: (игра, площадка) <- (игра, *) <- (*, площадка) <- (*, *) <- значения по умолчанию.
+    Результат слияния для пары кэшируется, так что resolve() — одно обращение к словарю;
+    load() подменяет правила целиком и сбрасывает кэш.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self._raw = {}
+        self._resolved = {}
+        self.signature = None   # (кол-во строк, max(updated_at)) загруженной версии
+
+    def load(self, rows, signature=None):
+        """rows — dict с game_key, marketplace, commission, price_ending, min_margin (None — наследовать)."""
+        self._raw = {(rule_key(r.get("game_key")), rule_key(r.get("marketplace"))): r for r in rows}
+        self._resolved = {}
+        self.signature = signature
+
+    def _merge(self, game, market):
+        keys = dict.fromkeys([(game, market), (game, ""), ("", market), ("", "")])
+        chain = [self._raw[k] for k in keys if k in self._raw]
+
+        def pick(field):
+            for r in chain:
+                if r.get(field) not in (None, ""):
+                    return r[field]
+            return None
+
+        commission, ending, margin = pick("commission"), pick("price_ending"), pick("min_margin")
+        return PricingRule(
+            to_bp(commission) if commission is not None else self.default.commission_bp,
+            ending or self.default.ending,
+            to_cents(margin) if margin is not None else self.default.min_margin_cents,
+        )
+
+    def resolve(self, game=None, marketplace=None):
+        if not self._raw:
+            return self.default
+        key = (rule_key(game), rule_key(marketplace))
+        rule = self._resolved.get(key)
+        if rule is None:
+            rule = self._resolved[key] = self._merge(*key)
+        return rule
+
+    def __len__(self):
+        return len(self._raw)
+
+
+def plan_reprice_by_rule(lots, target_cents, rule_for):
+    """
+    plan_reprice с правилом на каждый лот: rule_for(lot) -> PricingRule. Лоты группируются
+    по правилу, каждая группа считается одним min_sale_batch; min_margin поднимает профит.
+    """
+    groups = {}
+    for lot in lots:
+        groups.setdefault(rule_for(lot), []).append(lot)
+    changes = []
+    for rule, group in groups.items():
+        target = max(target_cents, rule.min_margin_cents)
+        changes.extend(plan_reprice(group, target, rule.commission_bp, rule.ending))
+    changes.sort(key=lambda c: c[0])
+    return changes
@@ -0,0 +1,106 @@
+# router.py
+"""
+Маршрутизация апдейтов по словарю вместо цепочки lambda-фильтров.
+
+callback_data вида "action:arg1:arg2" разбирается один раз и уходит в handler(call, *args),
+найденный по action. Текстовые ответы в диалоге — по ключу состояния (режим USER_STATE и т.п.),
+которое читается один раз на сообщение. По каждому маршруту копится время обработки.
+"""
+import inspect
+import time
+
+from aiogram import types
+
+
+class Router:
+    def __init__(self):
+        self.callbacks = {}      # action -> (handler, min_args, max_args)
+        self.states = {}         # ключ состояния (None — диалога нет) -> handler(message, state)
+        self.get_state = None    # async (message) -> (ключ, данные состояния)
+        self._stats = {}         # маршрут -> {"calls", "errors", "total_ms", "max_ms"}
+
+    # ---- регистрация ----
+    def callback(self, action):
+        """@router.callback("profit") async def cb(call, nid, profit): ..."""
+        def decorator(handler):
+            if action in self.callbacks:
+                raise ValueError(f"callback action {action!r} is already routed")
+            params = list(inspect.signature(handler).parameters.values())[1:]
+            if any(p.kind is p.VAR_POSITIONAL for p in params):
+                min_args, max_args = 0, None
+            else:
+                min_args = sum(p.default is p.empty for p in params)
+                max_args = len(params)
+            self.callbacks[action] = (handler, min_args, max_args)
+            return handler
+        return decorator
+
+    def state(self, key):
+        """@router.state("custom_profit") async def h(message, st): ... (key=None — обычный текст)."""
+        def decorator(handler):
+            if key in self.states:
+                raise ValueError(f"state {key!r} is already routed")
+            self.states[key] = handler
+            return handler
+        return decorator
+
+    def setup(self, dp, get_state):
+        """Подключить к Dispatcher: один хендлер на все callback'и и один — на текст."""
+        self.get_state = get_state
+        dp.register_callback_query_handler(self.dispatch_callback)
+        dp.register_message_handler(self.dispatch_text, content_types=types.ContentType.TEXT)
+
+    # ---- диспетчеризация ----
+    def _route_stats(self, route):
+        return self._stats.setdefault(route, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+    async def _timed(self, route, handler, *args):
+        started = time.perf_counter()
+        s = self._route_stats(route)
+        try:
+            return await handler(*args)
+        except Exception:
+            s["errors"] += 1
+            raise
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            s["calls"] += 1
+            s["total_ms"] += ms
+            s["max_ms"] = max(s["max_ms"], ms)
+
+    async def dispatch_callback(self, call: types.CallbackQuery):
+        action, _, rest = (call.data or "").partition(":")
+        route = self.callbacks.get(action)
+        if route is None:
+            self._route_stats("cb:?")["calls"] += 1    # кнопка от удалённого маршрута
+            await call.answer()
+            return
+        handler, min_args, max_args = route
+        if not rest or max_args == 0:
+            args = []
+        elif max_args is None:
+            args = rest.split(":")
+        else:
+            args = rest.split(":", max_args - 1)   # последний аргумент забирает остаток
+        if len(args) < min_args:
+            await call.answer("Кнопка устарела.", show_alert=True)
+            return
+        await self._timed(f"cb:{action}", handler, call, *args)
+
+    async def dispatch_text(self, message: types.Message):
+        key, st = await self.get_state(message)
+        handler = self.states.get(key)
+        if handler is None:
+            return
+        await self._timed(f"state:{key}", handler, message, st)
+
+    def stats(self):
+        out = {}
+        for route, s in sorted(self._stats.items()):
+            out[route] = dict(
+                s,
+                total_ms=round(s["total_ms"], 2),
+                max_ms=round(s["max_ms"], 2),
+                avg_ms=round(s["total_ms"] / s["calls"], 2) if s["calls"] else 0.0,
+            )
+        return out
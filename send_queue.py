@@ -0,0 +1,144 @@
+# send_queue.py
+"""
+Исходящие сообщения в Telegram с учётом флуд-лимитов:
+~30 сообщений/с на бота и ~1 сообщение/с в один чат.
+
+RateLimitedBot пропускает все send*/edit*-методы через OutboundScheduler, поэтому
+message.answer(...), bot.send_message(...) и т.п. ограничиваются без правок в хендлерах.
+"""
+import asyncio
+import random
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, NetworkError
+
+# методы Bot API, которые Telegram считает «сообщениями в чат»
+SEND_METHODS = {
+    "sendMessage", "sendDocument", "sendPhoto", "sendMediaGroup", "sendAnimation",
+    "sendVideo", "sendAudio", "sendVoice", "sendSticker", "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+}
+
+
+class TokenBucket:
+    """
+    Ведро токенов в форме GCRA: rate токенов в секунду, не больше burst подряд.
+    reserve() резервирует слот без await, поэтому корректно при конкурентных вызовах в одном loop'е.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.burst = max(1, burst)
+        self._tat = 0.0   # theoretical arrival time следующего токена
+
+    def reserve(self):
+        """Занять слот; вернуть, сколько секунд ждать до него."""
+        now = time.monotonic()
+        tat = max(self._tat, now)
+        self._tat = tat + self.interval
+        return max(0.0, tat - now - (self.burst - 1) * self.interval)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def block_until(self, deadline):
+        """Не выдавать токены до deadline (monotonic) — после 429 RetryAfter."""
+        self._tat = max(self._tat, deadline + (self.burst - 1) * self.interval)
+
+
+class OutboundScheduler:
+    """
+    Общий планировщик отправки: глобальное ведро + ведро на каждый чат.
+    В один чат сообщения уходят строго по очереди (asyncio.Lock честный, FIFO),
+    RetryAfter выжидается автоматически, сетевые ошибки повторяются с экспоненциальной паузой и джиттером.
+    """
+
+    def __init__(self, global_rate=30, global_burst=30, chat_rate=1, chat_burst=3,
+                 max_retries=3, backoff=0.5):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._chat_buckets = {}
+        self._chat_locks = {}
+        self._depth = {}          # chat_id -> сколько сообщений ждёт/отправляется
+        self._stats = {"sent": 0, "failed": 0, "retry_after": 0, "retries": 0, "throttled_time": 0.0}
+
+    def _chat(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_locks[chat_id] = asyncio.Lock()
+        return bucket, self._chat_locks[chat_id]
+
+    async def call(self, chat_id, send, retry=True):
+        """
+        send — функция без аргументов, возвращающая корутину запроса к API.
+        retry=False — не повторять (например, загрузка файла: поток уже прочитан).
+        """
+        bucket, lock = self._chat(chat_id)
+        self._depth[chat_id] = self._depth.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                attempt = 0
+                while True:
+                    started = time.monotonic()
+                    await bucket.acquire()
+                    await self.global_bucket.acquire()
+                    self._stats["throttled_time"] += time.monotonic() - started
+                    try:
+                        result = await send()
+                        self._stats["sent"] += 1
+                        return result
+                    except RetryAfter as e:
+                        self._stats["retry_after"] += 1
+                        delay = float(e.timeout) + random.uniform(0.05, 0.5)
+                        bucket.block_until(time.monotonic() + delay)
+                        if not retry or attempt >= self.max_retries:
+                            raise
+                    except (NetworkError, asyncio.TimeoutError):
+                        if not retry or attempt >= self.max_retries:
+                            raise
+                        await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+                    attempt += 1
+                    self._stats["retries"] += 1
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        finally:
+            left = self._depth.get(chat_id, 1) - 1
+            if left:
+                self._depth[chat_id] = left
+            else:
+                self._depth.pop(chat_id, None)
+
+    def stats(self):
+        s = dict(self._stats)
+        s["throttled_time"] = round(s["throttled_time"], 3)
+        s["queued_total"] = sum(self._depth.values())
+        s["queued_by_chat"] = {str(k): v for k, v in self._depth.items()}
+        s["known_chats"] = len(self._chat_buckets)
+        return s
+
+
+class RateLimitedBot(Bot):
+    """Bot, у которого все «сообщения в чат» идут через OutboundScheduler."""
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or OutboundScheduler()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if method not in SEND_METHODS or chat_id is None:
+            return await super().request(method, data, files, **kwargs)
+        parent = super(RateLimitedBot, self)
+        return await self.scheduler.call(
+            chat_id,
+            lambda: parent.request(method, data, files, **kwargs),
+            retry=not files,
+        )
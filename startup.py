@@ -0,0 +1,37 @@
+# startup.py
+"""
+Тайминги холодного старта: от начала импорта app до первого ответа 200.
+app.py импортирует этот модуль первым, поэтому T0 ~ момент старта воркера.
+"""
+import time
+from contextlib import contextmanager
+
+T0 = time.perf_counter()
+
+
+class StartupReport:
+    """mark() — момент от T0 (пишется один раз), phase() — длительность шага."""
+
+    def __init__(self, t0=T0):
+        self.t0 = t0
+        self.marks = {}    # name -> мс от T0
+        self.phases = {}   # name -> мс
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = round((time.perf_counter() - self.t0) * 1000, 1)
+        return self.marks[name]
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    def as_dict(self):
+        return {"marks_ms": dict(self.marks), "phases_ms": dict(self.phases)}
+
+
+REPORT = StartupReport()
@@ -0,0 +1,131 @@
+# state_store.py
+"""
+Хранилище состояний диалога (USER_STATE) с ограниченным временем жизни.
+
+memory   — LRU+TTL в памяти процесса (один воркер / локальный запуск);
+postgres — таблица dialog_state, общая для всех воркеров gunicorn.
+
+API асинхронный: `await store.get(key)`, `await store.set(key, value)`, `await store.pop(key)`,
+`await store.clear()` — удалить все ключи пространства имён.
+Значения — JSON-сериализуемые dict.
+"""
+import json
+
+import psycopg2.extras
+
+from ttl_cache import TTLCache
+
+
+class MemoryStateStore:
+    def __init__(self, namespace, ttl=3600.0, maxsize=10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    async def set(self, key, value):
+        self._cache.set(key, value)
+
+    async def pop(self, key, default=None):
+        return self._cache.pop(key, default)
+
+    async def contains(self, key):
+        return key in self._cache
+
+    async def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._cache.stats(), backend="memory", namespace=self.namespace)
+
+
+class PostgresStateStore:
+    """
+    Строка на (namespace, key) с expires_at. Просроченные не читаются и удаляются
+    пачкой раз в purge_every записей — таблица не растёт от брошенных диалогов.
+    """
+
+    def __init__(self, namespace, get_conn, run_db, ttl=3600.0, purge_every=200):
+        self.namespace = namespace
+        self.get_conn = get_conn
+        self.run_db = run_db
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+
+    def _get(self, key):
+        with self.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT value FROM dialog_state "
+                "WHERE namespace = %s AND key = %s AND expires_at > now()",
+                (self.namespace, str(key)),
+            )
+            r = cur.fetchone()
+            cur.close()
+        return r[0] if r else None
+
+    def _set(self, key, value):
+        self._writes += 1
+        with self.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO dialog_state (namespace, key, value, expires_at) "
+                "VALUES (%s, %s, %s, now() + %s * interval '1 second') "
+                "ON CONFLICT (namespace, key) DO UPDATE "
+                "SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at",
+                (self.namespace, str(key), psycopg2.extras.Json(value), self.ttl),
+            )
+            if self._writes % self.purge_every == 0:
+                cur.execute("DELETE FROM dialog_state WHERE expires_at <= now()")
+            cur.close()
+
+    def _pop(self, key):
+        with self.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "DELETE FROM dialog_state WHERE namespace = %s AND key = %s "
+                "RETURNING value, expires_at > now()",
+                (self.namespace, str(key)),
+            )
+            r = cur.fetchone()
+            cur.close()
+        return r[0] if r and r[1] else None
+
+    def _clear(self):
+        with self.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM dialog_state WHERE namespace = %s", (self.namespace,))
+            cur.close()
+
+    async def get(self, key, default=None):
+        value = await self.run_db(self._get, key)
+        return default if value is None else value
+
+    async def set(self, key, value):
+        # Json() сериализует при выполнении — проверяем сразу, чтобы ошибка была у вызывающего
+        json.dumps(value)
+        await self.run_db(self._set, key, value)
+
+    async def pop(self, key, default=None):
+        value = await self.run_db(self._pop, key)
+        return default if value is None else value
+
+    async def contains(self, key):
+        return await self.get(key) is not None
+
+    async def clear(self):
+        await self.run_db(self._clear)
+
+    def stats(self):
+        return {"backend": "postgres", "namespace": self.namespace, "ttl": self.ttl, "writes": self._writes}
+
+
+def make_state_store(namespace, backend, get_conn=None, run_db=None, ttl=3600.0, maxsize=10000):
+    if backend == "memory":
+        return MemoryStateStore(namespace, ttl=ttl, maxsize=maxsize)
+    if backend == "postgres":
+        return PostgresStateStore(namespace, get_conn, run_db, ttl=ttl)
+    raise ValueError(f"unknown state backend: {backend!r}")
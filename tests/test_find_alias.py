@@ -0,0 +1,65 @@
+# tests/test_find_alias.py
+"""
+/find: алиас совпадает только точно — похожее название игры не цепляется к чужому лоту.
+
+Нужна отдельная тестовая база Postgres (таблица inventory очищается!):
+
+    TEST_DATABASE_URL=postgresql://... python -m unittest discover -s tests
+
+Без TEST_DATABASE_URL тесты пропускаются.
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL is not set")
+class FindAliasTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+        os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+        import bot
+        cls.bot = bot
+        bot.init_db()
+        bot.reset_csv()
+        dota, rust = bot.insert_lots([
+            {"game": "Dota 2", "buy_price": "1.00", "source_text": "test:dota"},
+            {"game": "Rust", "buy_price": "2.00", "source_text": "test:rust"},
+        ])
+        # алиас «rus» — почти «rust», но у совсем другой игры
+        bot.update_lot(dota["id"], alias="rus")
+        bot.update_lot(rust["id"], alias="qwz")
+        cls.dota_id, cls.rust_id = dota["id"], rust["id"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bot.reset_csv()
+
+    def ids(self, query):
+        return [lot["id"] for lot in self.bot.find_lots(query)]
+
+    def test_near_miss_name_does_not_match_alias(self):
+        found = self.ids("rust")
+        self.assertIn(self.rust_id, found)
+        self.assertNotIn(self.dota_id, found)
+
+    def test_exact_alias_is_first(self):
+        self.assertEqual(self.ids("rus")[0], self.dota_id)
+        self.assertEqual(self.ids("  RUS ")[0], self.dota_id)
+
+    def test_alias_prefix_does_not_match(self):
+        self.assertNotIn(self.dota_id, self.ids("ru"))
+        self.assertNotIn(self.rust_id, self.ids("qw"))
+
+    def test_short_number_finds_id(self):
+        self.assertEqual(self.ids(str(self.dota_id))[0], self.dota_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# tests/test_notification_parser.py
+"""
+Золотой корпус для notification_parser.
+
+golden_notifications.json:
+    baseline  — тексты и результат parse_notification из bot.py до однопроходного парсера
+                (канонические, «почти канонические» уведомления и мусор); текущий парсер
+                обязан выдавать ровно то же.
+    templates — тексты, которые с реестра шаблонов разбирают en_link / key_value: baseline —
+                что давал старый парсер, expected — что ожидается сейчас.
+
+    python -m pytest tests        (или python -m unittest discover -s tests)
+"""
+import json
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import notification_parser as parser  # noqa: E402
+
+with open(os.path.join(HERE, "golden_notifications.json"), encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+
+class GoldenCorpusTest(unittest.TestCase):
+    def check(self, cases):
+        for case in cases:
+            with self.subTest(text=case["text"]):
+                self.assertEqual(parser.parse_notification(case["text"]), case["expected"])
+
+    def test_baseline_unchanged(self):
+        self.check(GOLDEN["baseline"])
+
+    def test_templates(self):
+        self.check(GOLDEN["templates"])
+
+    def test_batch_matches_single(self):
+        cases = GOLDEN["baseline"] + GOLDEN["templates"]
+        self.assertEqual(
+            parser.parse_notifications([c["text"] for c in cases]),
+            [c["expected"] for c in cases],
+        )
+
+    def test_fast_path_matches_legacy(self):
+        # быстрый путь либо отказывается (None), либо совпадает со старым парсером
+        for case in GOLDEN["baseline"]:
+            text = case["text"].strip()
+            fast = parser._parse_fast(text)
+            if fast is not None:
+                with self.subTest(text=text):
+                    self.assertEqual(fast, parser._parse_notification_legacy(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# ttl_cache.py
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Потокобезопасный словарь ограниченного размера: LRU-вытеснение сверх maxsize
+    плюс срок жизни записи ttl секунд (просроченные удаляются лениво).
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expired(self, expires_at, now):
+        return expires_at <= now
+
+    def _purge(self, now):
+        # самые старые по использованию — в начале; просроченные срезаем оттуда же
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if not self._expired(expires_at, now) and len(self._data) <= self.maxsize:
+                break
+            self._data.popitem(last=False)
+            if not self._expired(expires_at, now):
+                self.evictions += 1
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            if self._expired(item[0], now):
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            self._purge(now)
+
+    def add(self, key, value=True):
+        """Записать, только если ключа нет (или он просрочен). True — если записали."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and not self._expired(item[0], now):
+                self._data.move_to_end(key)
+                return False
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._purge(now)
+            return True
+
+    def pop(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        if item is _MISSING or self._expired(item[0], now):
+            return default
+        return item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return len(self._data)
+
+    def stats(self):
+        return {"size": len(self), "maxsize": self.maxsize, "ttl": self.ttl, "evictions": self.evictions}
@@ -0,0 +1,118 @@
+# update_queue.py
+import asyncio
+import time
+import traceback
+
+
+def update_chat_key(data: dict):
+    """Ключ упорядочивания для сырого апдейта Telegram: id чата (или пользователя для callback без сообщения)."""
+    msg = data.get("message") or data.get("edited_message")
+    if msg and msg.get("chat"):
+        return msg["chat"].get("id")
+    cq = data.get("callback_query")
+    if cq:
+        if cq.get("message") and cq["message"].get("chat"):
+            return cq["message"]["chat"].get("id")
+        if cq.get("from"):
+            return cq["from"].get("id")
+    return data.get("update_id")
+
+
+class UpdateQueue:
+    """
+    Ограниченная очередь апдейтов + пул воркеров внутри event loop'а.
+
+    Очередь шардирована по ключу чата: у каждого воркера своя asyncio.Queue,
+    апдейты одного чата всегда попадают к одному воркеру и обрабатываются по порядку,
+    разные чаты — параллельно.
+
+    put() ждёт свободного места не дольше put_timeout и возвращает False, если очередь
+    забита — вебхук тогда отвечает не-2xx, и Telegram доставит апдейт позже (backpressure).
+    """
+
+    def __init__(self, handler, workers=4, maxsize=100, put_timeout=2.0):
+        self.handler = handler          # async def handler(update)
+        self.workers = max(1, workers)
+        self.maxsize = maxsize          # на один шард
+        self.put_timeout = put_timeout
+        self._queues = []
+        self._tasks = []
+        self._accepting = True
+        self._stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "errors": 0,
+            "rejected": 0,
+            "max_depth": 0,
+            "wait_time": 0.0,
+            "max_wait": 0.0,
+        }
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.maxsize) for _ in range(self.workers)]
+        self._tasks = [
+            asyncio.get_running_loop().create_task(self._worker(q), name=f"update-worker-{i}")
+            for i, q in enumerate(self._queues)
+        ]
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    async def put(self, update, key=None) -> bool:
+        if not self._accepting:
+            self._stats["rejected"] += 1
+            return False
+        self._ensure_started()
+        q = self._queues[hash(key) % self.workers]
+        try:
+            await asyncio.wait_for(q.put((update, time.monotonic())), self.put_timeout)
+        except asyncio.TimeoutError:
+            self._stats["rejected"] += 1
+            return False
+        self._stats["enqueued"] += 1
+        self._stats["max_depth"] = max(self._stats["max_depth"], self.depth())
+        return True
+
+    async def _worker(self, q):
+        while True:
+            update, enqueued_at = await q.get()
+            waited = time.monotonic() - enqueued_at
+            self._stats["wait_time"] += waited
+            self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+            try:
+                await self.handler(update)
+                self._stats["processed"] += 1
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(">>> ERROR in update worker:", e)
+                traceback.print_exc()
+            finally:
+                q.task_done()
+
+    async def drain(self, timeout=25.0):
+        """Перестать принимать новые апдейты, дообработать очередь (не дольше timeout) и остановить воркеров."""
+        self._accepting = False
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f">>> update queue drain timed out, dropped {self.depth()} updates")
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        s = dict(self._stats)
+        s["workers"] = self.workers
+        s["depth"] = self.depth()
+        s["shard_depths"] = [q.qsize() for q in self._queues]
+        done = s["processed"] + s["errors"]
+        s["avg_wait_ms"] = round(s["wait_time"] / done * 1000, 2) if done else 0.0
+        s["max_wait_ms"] = round(s.pop("max_wait") * 1000, 2)
+        s["wait_time"] = round(s["wait_time"], 4)
+        s["accepting"] = self._accepting
+        return s